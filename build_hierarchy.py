@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+import sys
+import logging
+import argparse
+
+import numpy as np
+
+from doc_term_matrix import build_doc_term_matrix
+from instrumentation import get_metrics, start_metrics, add_metrics_args
+
+# Builds a topic hierarchy from keyword co-occurrence using subsumption: x is
+# a parent of y if P(x|y) >= threshold and P(y|x) < 1, i.e. x appears in
+# (nearly) every document that y appears in but not the other way around.
+# A parent must also be in more documents than its child (the lower term
+# index wins a tie), so two terms that subsume each other give one edge
+# rather than a cycle.
+# All pairs are scored with sparse matrix products, one block of child
+# columns at a time so that memory is bounded by the block size
+
+# returns parallel arrays (parents, children, p_parent_given_child) for every
+# subsuming pair where the child is in columns [start, end)
+def get_block_subsumptions(term_doc, doc_term, doc_freqs, start, end, threshold):
+    cooc = (term_doc @ doc_term[:, start:end]).tocoo()
+
+    parents = cooc.row
+    children = cooc.col + start
+    counts = cooc.data.astype(np.float64)
+
+    p_parent_given_child = counts / doc_freqs[children]
+    p_child_given_parent = counts / doc_freqs[parents]
+
+    parent_freqs = doc_freqs[parents]
+    child_freqs = doc_freqs[children]
+    outranks = (parent_freqs > child_freqs) | ((parent_freqs == child_freqs) & (parents < children))
+
+    mask = outranks & (p_parent_given_child >= threshold) & (p_child_given_parent < 1.0)
+
+    return (parents[mask], children[mask], p_parent_given_child[mask])
+
+# for each child keep only its most specific parent, the subsuming term with
+# the lowest document frequency. this turns the subsumption relation into a
+# forest, which is what the relationship check expects
+def get_most_specific_parents(parents, children, scores, doc_freqs):
+    # sort by child, then parent doc freq, then highest score first
+    order = np.lexsort((-scores, doc_freqs[parents], children))
+    parents = parents[order]
+    children = children[order]
+
+    first = np.ones(len(children), dtype=bool)
+    first[1:] = children[1:] != children[:-1]
+
+    return (parents[first], children[first])
+
+def build_hierarchy(docs_fp, threshold, min_df, block_size, all_parents=False, delimiter="\t"):
+    logger = logging.getLogger(__name__)
+    metrics = get_metrics()
+
+    with metrics.stage("load"):
+        dtm = build_doc_term_matrix(docs_fp, delimiter=delimiter)
+
+    doc_term = dtm.binary().tocsc()
+    doc_freqs = np.diff(doc_term.indptr)
+
+    # drop rare keywords, they can't subsume anything reliably
+    keep = np.flatnonzero(doc_freqs >= min_df)
+    doc_term = doc_term[:, keep].tocsc()
+    doc_freqs = doc_freqs[keep].astype(np.float64)
+    terms = [dtm.uids[idx] for idx in keep]
+
+    logger.info(f"{doc_term.shape[0]} documents, {len(terms)} keywords with doc freq >= {min_df}")
+
+    term_doc = doc_term.T.tocsr()
+
+    edges = []
+    num_terms = len(terms)
+
+    for start in range(0, num_terms, block_size):
+        end = min(start + block_size, num_terms)
+        with metrics.stage("subsumption_blocks"):
+            (parents, children, scores) = get_block_subsumptions(term_doc, doc_term, doc_freqs,
+                    start, end, threshold)
+
+            if not all_parents and len(children) > 0:
+                (parents, children) = get_most_specific_parents(parents, children, scores, 
+                        doc_freqs)
+
+        metrics.count("keywords_scored", end - start)
+        edges.extend(zip(parents.tolist(), children.tolist()))
+        logger.debug(f"Block {start}-{end}: {len(children)} edges")
+
+    logger.info(f"Found {len(edges)} subsumption edges")
+
+    return [(terms[parent], terms[child]) for (parent, child) in edges]
+
+def write_edge_list(edges, out_fp):
+    with open(out_fp, "w") as out:
+        for (parent, child) in edges:
+            out.write(f"{parent}\t{child}\n")
+
+def initialize_logger(debug=False, quiet=False):
+    level = logging.INFO
+    if debug:
+        level = logging.DEBUG
+
+    # Set up logging
+    logger = logging.getLogger(__name__)
+    logger.setLevel(level)
+    handler = logging.FileHandler("build_hierarchy.log")
+    formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    handler.setFormatter(formatter)
+    logger.addHandler(handler)
+
+    if not quiet:
+        handler = logging.StreamHandler(sys.stdout)
+        handler.setLevel(level)
+        formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+        handler.setFormatter(formatter)
+        logger.addHandler(handler)
+
+    return logger
+
+def get_args():
+    logger = logging.getLogger(__name__)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-i", "--input", help="Path to document keywords file, one document per "
+            "line: doc id followed by its keywords", required=True)
+    parser.add_argument("-o", "--output", help="Output edge list path", default="edge_list")
+    parser.add_argument("-t", "--threshold", help="Minimum P(parent|child), default=0.8",
+            type=float, default=0.8)
+    parser.add_argument("-f", "--min-df", help="Minimum document frequency for a keyword, "
+            "default=5", type=int, default=5)
+    parser.add_argument("-b", "--block-size", help="Number of child keywords scored per "
+            "matrix product, bounds memory, default=2048", type=int, default=2048)
+    parser.add_argument("-d", "--delimiter", help="Field delimiter of the input, default=tab",
+            default="\t")
+    parser.add_argument("-a", "--all-parents", help="Write every subsumption edge instead of "
+            "only the most specific parent of each keyword", action="store_true")
+    add_metrics_args(parser, "build_hierarchy")
+
+    args = parser.parse_args()
+
+    # log delimiter
+    logger.info("###############################")
+    logger.info(f"Document keywords: {args.input}")
+    logger.info(f"Output: {args.output}")
+    logger.info(f"Threshold: {args.threshold}")
+    logger.info(f"Min doc freq: {args.min_df}")
+    logger.info(f"Block size: {args.block_size}")
+
+    return args
+
+if __name__ == "__main__":
+    logger = initialize_logger()
+    args = get_args()
+    metrics = start_metrics("build_hierarchy", args.profile)
+    metrics.track_rate("keywords_scored", "subsumption_blocks")
+
+    edges = build_hierarchy(args.input, args.threshold, args.min_df, args.block_size,
+            args.all_parents, args.delimiter)
+
+    with metrics.stage("write"):
+        write_edge_list(edges, args.output)
+
+    metrics.finish(args.metrics, logger)
@@ -1,12 +1,39 @@
 #!/usr/bin/env python3
+import os
 import sys
 import math
 import logging
+import glob
 import argparse
+from random import Random
+from statistics import NormalDist
 from itertools import permutations
 from collections import deque
-
-from parse_mesh import parse_mesh
+from multiprocessing import get_context, get_all_start_methods
+
+from term_vocab import TermVocabulary
+from edge_list_io import open_text, is_csr_graph, load_csr_graph
+from mesh_distance_cache import get_mesh_distance_table, hash_file
+from component_cache import ComponentCache, get_inputs_key, prune_cache, DEFAULT_MAX_AGE_DAYS
+from descriptor_store import get_descriptor_store
+from columnar_output import FORMATS, can_write_parquet, ColumnarWriter, get_table_path
+from instrumentation import get_metrics, start_metrics, add_metrics_args
+
+# components with an RMSD below this are written out in detail
+RMSD_REPORT_CUTOFF = 2.0
+
+# version of the per-component result dicts, part of the result cache key so
+# that results cached before a change to their fields are recomputed
+RESULT_VERSION = 2
+
+# columns of the tables written with a columnar --output-format, one row per
+# component with multiple MeSH terms, and one per pair of terms of the
+# reported components (the pairs listed under "Dists" in the text output)
+COMPONENT_COLUMNS = [("input", "str"), ("component", "int"), ("num_terms", "int"),
+        ("rmsd", "float"), ("ci_low", "float"), ("ci_high", "float"), ("reported", "bool")]
+PAIR_COLUMNS = [("input", "str"), ("component", "int"), ("term_0", "str"), ("term_1", "str"),
+        ("mesh_term_0", "str"), ("mesh_term_1", "str"), ("hier_dist", "int"),
+        ("mesh_dist", "int")]
 
 # returns the bfs result starting at node. used to get the component
 # of the node
@@ -25,13 +52,35 @@ def bfs(node, adj_list):
 
             for adj in adj_list[this_node]:
                 queue.append(adj)
+
+    get_metrics().count("bfs_nodes_expanded", len(component))
     
     return {n: adj_list[n] for n in component}
 
 def get_intersect(elements, mesh):
     return {ele for ele in elements if ele in mesh}
 
-def get_distance(source, sink, adj_list):
+# terms from elements that are in the lemmatized mesh or its n-grams, 
+# deduplicated. if a vocab is given the membership checks are done on its
+# bitset instead of the two sets
+def get_mesh_intersect(elements, lem_mesh, lem_mesh_bigrams, vocab=None):
+    if vocab is not None:
+        return vocab.mesh_members(elements)
+
+    intersect = list(get_intersect(elements, lem_mesh))
+    intersect.extend(list(get_intersect(elements, lem_mesh_bigrams)))
+    
+    return list(dict.fromkeys(intersect))
+
+# interns all of the hierarchy's terms and marks the ones that have a
+# corresponding lemmatized MeSH term
+def build_hierarchy_vocab(adj_list, lem_mesh, lem_mesh_bigrams):
+    return TermVocabulary(adj_list.keys()).mark_mesh(lem_mesh, lem_mesh_bigrams)
+
+# the number of nodes expanded is counted as bfs_nodes_expanded, or if
+# expanded (a one element list) is given added to it, so that callers
+# running a BFS per pair can count once for all of them
+def get_distance(source, sink, adj_list, expanded=None):
     if source == sink:
         return 0
 
@@ -60,31 +109,76 @@ def get_distance(source, sink, adj_list):
             
             if found:
                 break
+
+    if expanded is None:
+        get_metrics().count("bfs_nodes_expanded", len(visited_nodes))
+    else:
+        expanded[0] += len(visited_nodes)
          
     if not found:
         raise Exception("get_distance problem - sink not found")
 
     return dist
 
-def build_distance_matrix(component, mesh_graph, lem_mesh_map, lem_mesh, lem_mesh_bigrams):
-    intersect = list(get_intersect(component.keys(), lem_mesh))
-    intersect.extend(list(get_intersect(component.keys(), lem_mesh_bigrams)))
-    intersect = list(dict.fromkeys(intersect))
+# MeSH side distance, looked up in the precomputed table if there is one
+def get_mesh_distance(source, sink, mesh_graph, mesh_table=None, expanded=None):
+    if mesh_table is not None:
+        return mesh_table.distance(source, sink)
 
-    hier_dists = []
-    mesh_dists = []
+    return get_distance(source, sink, mesh_graph, expanded)
 
-    for node_0 in intersect:
-        corresponding_mesh_0 = lem_mesh_map[node_0]
-        for node_1 in intersect:
-            corresponding_mesh_1 = lem_mesh_map[node_1]
-            hier_dist = get_distance(node_0, node_1, component)
-            mesh_dist = get_distance(corresponding_mesh_0, corresponding_mesh_1, mesh_graph)
-            
-            hier_dists.append(hier_dist)
-            mesh_dists.append(mesh_dist)
+# Distances between every pair of a component's MeSH mapped terms, in the
+# hierarchy and between the corresponding MeSH descriptors. terms gives the
+# row/column order and the distances are flattened k x k matrices, the form
+# get_rmsd takes. unpacks to (hier_dists, mesh_dists). for approximated
+# components only the terms are filled in
+class ComponentDistances:
+    __slots__ = ("terms", "mesh_uids", "hier_dists", "mesh_dists")
+
+    def __init__(self, terms, mesh_uids, hier_dists=None, mesh_dists=None):
+        self.terms = terms
+        self.mesh_uids = mesh_uids
+        self.hier_dists = hier_dists
+        self.mesh_dists = mesh_dists
+
+    def __iter__(self):
+        return iter((self.hier_dists, self.mesh_dists))
+
+    def __len__(self):
+        return len(self.terms)
+
+    def has_dists(self):
+        return self.hier_dists is not None
+
+    # (hierarchy distance, MeSH distance) between terms idx_0 and idx_1
+    def get_dists(self, idx_0, idx_1):
+        idx = idx_0 * len(self.terms) + idx_1
+        return (self.hier_dists[idx], self.mesh_dists[idx])
 
-    return (hier_dists, mesh_dists)
+# both graphs are undirected, so each pair is only traversed once and the
+# distance is mirrored
+def build_distance_matrix(component, mesh_graph, lem_mesh_map, lem_mesh, lem_mesh_bigrams, 
+        vocab=None, mesh_table=None):
+    intersect = get_mesh_intersect(component.keys(), lem_mesh, lem_mesh_bigrams, vocab)
+    mesh_uids = [lem_mesh_map[node] for node in intersect]
+
+    dim = len(intersect)
+    hier_dists = [0] * (dim * dim)
+    mesh_dists = [0] * (dim * dim)
+    expanded = [0]
+
+    for idx_0 in range(dim):
+        for idx_1 in range(idx_0 + 1, dim):
+            hier_dist = get_distance(intersect[idx_0], intersect[idx_1], component, expanded)
+            mesh_dist = get_mesh_distance(mesh_uids[idx_0], mesh_uids[idx_1], mesh_graph,
+                                          mesh_table, expanded)
+
+            hier_dists[idx_0 * dim + idx_1] = hier_dists[idx_1 * dim + idx_0] = hier_dist
+            mesh_dists[idx_0 * dim + idx_1] = mesh_dists[idx_1 * dim + idx_0] = mesh_dist
+
+    get_metrics().count("bfs_nodes_expanded", expanded[0])
+
+    return ComponentDistances(intersect, mesh_uids, hier_dists, mesh_dists)
 
 def get_components(adj_list):
     unvisited_nodes = set(adj_list.keys())
@@ -104,7 +198,7 @@ def get_components(adj_list):
     return components
 
 
-def get_component_subset(adj_list, lem_mesh, lem_mesh_bigrams, lem_mesh_map):
+def get_component_subset(adj_list, lem_mesh, lem_mesh_bigrams, lem_mesh_map, vocab=None):
     logger = logging.getLogger(__name__)
 
     unvisited_nodes = set(adj_list.keys())    
@@ -121,9 +215,7 @@ def get_component_subset(adj_list, lem_mesh, lem_mesh_bigrams, lem_mesh_map):
             if n != node:
                  unvisited_nodes.remove(n)
         
-        intersect = list(get_intersect(component.keys(), lem_mesh))
-        intersect.extend(list(get_intersect(component.keys(), lem_mesh_bigrams)))
-        intersect = list(dict.fromkeys(intersect))
+        intersect = get_mesh_intersect(component.keys(), lem_mesh, lem_mesh_bigrams, vocab)
         
         corresponding_mesh = list(dict.fromkeys([lem_mesh_map[it] for it in intersect]))
 
@@ -160,6 +252,64 @@ def get_rmsd(dist_matrix_0, dist_matrix_1):
     rolling_sum = rolling_sum / 2.0
 
     return math.sqrt(rolling_sum / N)
+
+# estimates a component's RMSD from num_samples random pairs of its MeSH mapped
+# terms instead of all k^2 of them. the diagonal doesn't count and the matrix
+# is symmetric, so the exact RMSD in get_rmsd is sqrt(mean / 2) where mean is
+# the mean squared difference over distinct pairs. returns the estimate and
+# the bounds of its confidence interval
+#
+# the pairs are drawn from a stream seeded by seed and the component's terms,
+# so a component gets the same estimate regardless of processing order
+def estimate_rmsd(component, mesh_graph, lem_mesh_map, lem_mesh, lem_mesh_bigrams, 
+        num_samples, seed=0, confidence=0.95, vocab=None, mesh_table=None):
+    if num_samples < 2:
+        raise Exception("estimate_rmsd needs at least 2 samples")
+
+    intersect = sorted(get_mesh_intersect(component.keys(), lem_mesh, lem_mesh_bigrams, vocab))
+    rng = Random(f"{seed}:" + "\n".join(intersect))
+
+    sq_diffs = []
+    expanded = [0]
+
+    for _ in range(num_samples):
+        (node_0, node_1) = rng.sample(intersect, 2)
+        hier_dist = get_distance(node_0, node_1, component, expanded)
+        mesh_dist = get_mesh_distance(lem_mesh_map[node_0], lem_mesh_map[node_1], mesh_graph,
+                                      mesh_table, expanded)
+        sq_diffs.append((hier_dist - mesh_dist) ** 2)
+
+    get_metrics().count("bfs_nodes_expanded", expanded[0])
+
+    mean = sum(sq_diffs) / num_samples
+    variance = sum([(x - mean) ** 2 for x in sq_diffs]) / (num_samples - 1)
+    half_width = NormalDist().inv_cdf((1 + confidence) / 2) * math.sqrt(variance / num_samples)
+
+    rmsd = math.sqrt(mean / 2.0)
+    ci_low = math.sqrt(max(mean - half_width, 0.0) / 2.0)
+    ci_high = math.sqrt((mean + half_width) / 2.0)
+
+    return (rmsd, ci_low, ci_high)
+
+# exact RMSD for components with fewer than exact_max_terms MeSH mapped terms
+# (or always, if exact_max_terms is None), sampled estimate for larger ones.
+# returns (rmsd, ci, distances) where ci is None for exact values and
+# distances is the ComponentDistances used, without the matrices if sampled
+def get_component_rmsd(component, mesh_graph, lem_mesh_map, lem_mesh, lem_mesh_bigrams, 
+        exact_max_terms=None, num_samples=5000, seed=0, confidence=0.95, vocab=None, 
+        mesh_table=None):
+    intersect = get_mesh_intersect(component.keys(), lem_mesh, lem_mesh_bigrams, vocab)
+
+    if exact_max_terms is None or len(intersect) <= exact_max_terms:
+        distances = build_distance_matrix(component, mesh_graph, lem_mesh_map, 
+                                          lem_mesh, lem_mesh_bigrams, vocab, mesh_table)
+        return (get_rmsd(distances.hier_dists, distances.mesh_dists), None, distances)
+
+    (rmsd, ci_low, ci_high) = estimate_rmsd(component, mesh_graph, lem_mesh_map, lem_mesh,
+            lem_mesh_bigrams, num_samples, seed, confidence, vocab, mesh_table)
+    distances = ComponentDistances(intersect, [lem_mesh_map[node] for node in intersect])
+
+    return (rmsd, (ci_low, ci_high), distances)
     
 
 # this is used to convert lemmatized mesh into a suitable set for 'in' checking
@@ -208,15 +358,24 @@ def load_lem_mesh(mesh_fp):
 
             lem_mesh.append(line[1])
             lem_uid_map[line[1]] = line[0]
+
+    get_metrics().count("rows_parsed", len(lem_mesh))
     # mesh should be a set because later there are millions of checks to see
     # if an element is in the data structure
     return (set(lem_mesh), lem_uid_map)
 
+# binary CSR graph files written by make_edge_list.py are memory-mapped
+# rather than parsed, TSV edge lists may be gzipped
 def load_from_edge_list(fp):
+    if is_csr_graph(fp):
+        return load_csr_graph(fp)
+
     adj_list = {}
+    num_rows = 0
 
-    with open(fp, "r") as handle:
+    with open_text(fp, "r") as handle:
         for line in handle:
+            num_rows += 1
             line = line.strip("\n").split("\t")
             line = [it.strip() for it in line]
 
@@ -230,42 +389,194 @@ def load_from_edge_list(fp):
             else:
                 adj_list[line[1]] = [line[0]]
 
+    get_metrics().count("rows_parsed", num_rows)
+
     for key in adj_list:
         adj_list[key] = list(dict.fromkeys(adj_list[key]))
     return adj_list
 
-def analyze_component(component, lem_mesh, lem_mesh_bigrams, lem_mesh_map, 
-        desc_data, adj_list, mesh_graph):
+# renders the report for a component from its already computed distances,
+# no graph traversal. the pairwise listing is left out for approximated
+# components, which don't have the full matrices
+def analyze_component(distances, descriptors):
     result = []
 
-    intersect = list(get_intersect(component, lem_mesh))
-    intersect.extend(list(get_intersect(component, lem_mesh_bigrams)))
-    intersect = list(dict.fromkeys(intersect))
+    intersect = distances.terms
 
     result.append("Intersection w/ MeSH (terms from our method that have "
                 "corresponding MeSH terms):")
     result.append("; ".join(intersect))
 
-    corresponding = list(dict.fromkeys([desc_data[lem_mesh_map[t]]['name'] for t in intersect]))
+    corresponding = list(dict.fromkeys([descriptors.name(uid) for uid in distances.mesh_uids]))
     result.append("Corresponding MeSH terms:")
     result.append("; ".join(corresponding))
+
+    if not distances.has_dists():
+        return result
     
     result.append("Dists")
     for term_0_idx in range(len(intersect)):
         for term_1_idx in range(term_0_idx + 1, len(intersect)):
             term_0 = intersect[term_0_idx]
             term_1 = intersect[term_1_idx]
-            term_dist = get_distance(term_0, term_1, adj_list)
-            corr_mesh_0 = lem_mesh_map[term_0]
-            corr_mesh_1 = lem_mesh_map[term_1]
-            mesh_dist = get_distance(corr_mesh_0, corr_mesh_1, mesh_graph)
+            (term_dist, mesh_dist) = distances.get_dists(term_0_idx, term_1_idx)
             
-            mesh_term_0 = desc_data[corr_mesh_0]['name']
-            mesh_term_1 = desc_data[corr_mesh_1]['name']
+            mesh_term_0 = descriptors.name(distances.mesh_uids[term_0_idx])
+            mesh_term_1 = descriptors.name(distances.mesh_uids[term_1_idx])
             result.append(f"{term_0} - {term_1} dist: {term_dist}")
             result.append(f"{mesh_term_0} - {mesh_term_1} dist: {mesh_dist}")
     return result
 
+# the pairs analyze_component lists, as (term_0, term_1, mesh_term_0,
+# mesh_term_1, hier_dist, mesh_dist) rows
+def get_component_pairs(distances, descriptors):
+    if not distances.has_dists():
+        return []
+
+    intersect = distances.terms
+    mesh_names = [descriptors.name(uid) for uid in distances.mesh_uids]
+
+    pairs = []
+    for term_0_idx in range(len(intersect)):
+        for term_1_idx in range(term_0_idx + 1, len(intersect)):
+            (term_dist, mesh_dist) = distances.get_dists(term_0_idx, term_1_idx)
+            pairs.append((intersect[term_0_idx], intersect[term_1_idx], mesh_names[term_0_idx],
+                    mesh_names[term_1_idx], int(term_dist), int(mesh_dist)))
+
+    return pairs
+
+# everything needed to compare one component against MeSH, the MeSH side
+# structures and the RMSD settings
+class ComparisonContext:
+    __slots__ = ("mesh_graph", "lem_mesh_map", "lem_mesh", "lem_mesh_bigrams", "descriptors", 
+            "vocab", "mesh_table", "exact_max_terms", "num_samples", "seed", "confidence")
+
+    def __init__(self, mesh_graph, lem_mesh_map, lem_mesh, lem_mesh_bigrams, descriptors, 
+            vocab=None, mesh_table=None, exact_max_terms=None, num_samples=5000, seed=0, 
+            confidence=0.95):
+        self.mesh_graph = mesh_graph
+        self.lem_mesh_map = lem_mesh_map
+        self.lem_mesh = lem_mesh
+        self.lem_mesh_bigrams = lem_mesh_bigrams
+        self.descriptors = descriptors
+        self.vocab = vocab
+        self.mesh_table = mesh_table
+        self.exact_max_terms = exact_max_terms
+        self.num_samples = num_samples
+        self.seed = seed
+        self.confidence = confidence
+
+    # the settings that change a component's result, part of the cache key
+    def get_settings(self):
+        return {"exact_max_terms": self.exact_max_terms, "num_samples": self.num_samples,
+                "seed": self.seed, "confidence": self.confidence, 
+                "cutoff": RMSD_REPORT_CUTOFF, "version": RESULT_VERSION}
+
+# RMSD for a component and, if it is below the cutoff, the lines written
+# for it to comparison_results and its pairwise distances. returned as a dict
+# so it can be cached
+def process_component(component, ctx):
+    (rmsd, ci, distances) = get_component_rmsd(component, ctx.mesh_graph, ctx.lem_mesh_map, ctx.lem_mesh,
+            ctx.lem_mesh_bigrams, ctx.exact_max_terms, ctx.num_samples, ctx.seed, 
+            ctx.confidence, ctx.vocab, ctx.mesh_table)
+
+    lines = []
+    pairs = []
+    if rmsd < RMSD_REPORT_CUTOFF:
+        lines.append("####")
+        if ci is None:
+            lines.append(f"RMSD: {rmsd}")
+        else:
+            lines.append(f"RMSD: {rmsd} (approximate, {ctx.confidence:.0%} CI: "
+                    f"{ci[0]} - {ci[1]})")
+        lines.extend(analyze_component(distances, ctx.descriptors))
+        pairs = get_component_pairs(distances, ctx.descriptors)
+
+    return {"rmsd": rmsd, "ci": None if ci is None else list(ci), "lines": lines,
+            "num_terms": len(distances), "pairs": pairs}
+
+# the context is handed to each worker once, through the pool initializer.
+# with fork it is inherited rather than pickled
+_worker_ctx = {}
+
+def _init_component_worker(ctx):
+    _worker_ctx["ctx"] = ctx
+    # a forked worker starts with a copy of the parent's counters
+    get_metrics().take_counters()
+
+# the worker's counters for this component go back with the result
+def _process_indexed_component(task):
+    (idx, component) = task
+    result = process_component(component, _worker_ctx["ctx"])
+
+    return (idx, result, get_metrics().take_counters())
+
+def get_pool_context():
+    if "fork" in get_all_start_methods():
+        return get_context("fork")
+
+    return get_context()
+
+# runs process_component over a process pool. the largest components go
+# first so that one big component doesn't end up running alone at the end,
+# results come back in the same order as components
+def process_components_parallel(components, ctx, processes):
+    metrics = get_metrics()
+    results = [None] * len(components)
+
+    tasks = sorted(enumerate(components), key=lambda task: len(task[1]), reverse=True)
+
+    with get_pool_context().Pool(processes=processes, initializer=_init_component_worker, 
+            initargs=(ctx,)) as pool:
+        for (idx, result, counters) in pool.imap_unordered(_process_indexed_component, tasks):
+            results[idx] = result
+            metrics.merge_counters(counters)
+
+    return results
+
+# results for all components, in order. with a cache only new or changed
+# components are computed. with processes > 1 those are spread over a pool,
+# the results are the same as the serial path
+def compare_components(components, ctx, cache=None, processes=1):
+    results = [None] * len(components)
+    keys = [None] * len(components)
+
+    # with a cache, components that are repeated (e.g. in several hierarchies
+    # of a batch) are only computed once
+    todo = []
+    duplicates = []
+    seen_keys = {}
+    for idx, component in enumerate(components):
+        if cache is not None:
+            keys[idx] = cache.get_key(component)
+            if keys[idx] in seen_keys:
+                duplicates.append((idx, seen_keys[keys[idx]]))
+                continue
+            seen_keys[keys[idx]] = idx
+            results[idx] = cache.get(keys[idx])
+        if results[idx] is None:
+            todo.append(idx)
+
+    if processes > 1 and len(todo) > 1:
+        computed = process_components_parallel([components[idx] for idx in todo], ctx, 
+                                               processes)
+    else:
+        computed = [process_component(components[idx], ctx) for idx in todo]
+
+    metrics = get_metrics()
+    metrics.count("components_computed", len(todo))
+    metrics.count("components_reused", len(components) - len(todo))
+
+    for (idx, result) in zip(todo, computed):
+        results[idx] = result
+        if cache is not None:
+            cache.put(keys[idx], result)
+
+    for (idx, first_idx) in duplicates:
+        results[idx] = results[first_idx]
+
+    return results
+
 def initialize_logger(debug=False, quiet=False):
     level = logging.INFO
     if debug:
@@ -292,64 +603,282 @@ def get_args():
     logger = logging.getLogger(__name__)
 
     parser = argparse.ArgumentParser()
-    parser.add_argument("-i", "--input", help="Path to edge list from our method", 
-            default="data/edge_list")
+    parser.add_argument("-i", "--input", help="Path(s) or glob(s) of edge lists from our "
+            "method, several inputs are compared in one batch", nargs="+", 
+            default=["data/edge_list"])
+    parser.add_argument("-o", "--output", help="Output path for a single input, "
+            "default=comparison_results", default="comparison_results")
+    parser.add_argument("-b", "--batch-dir", help="Output directory for several inputs, gets "
+            "one results file per hierarchy and summary.tsv, default=comparison_batch", 
+            default="comparison_batch")
     parser.add_argument("-m", "--mesh", help="Path to MeSH edge list", 
             default="data/mesh_edge_list")
     parser.add_argument("-l", "--lem", help="Path to lemmatized MeSH file with term UIDs", 
             default="data/lem_mesh_map")
     parser.add_argument("-d", "--desc", help="Path to MeSH descriptor file", 
             default="data/desc2020")
+    parser.add_argument("--desc-store", help="Directory for the columnar descriptor stores, "
+            "one per descriptor file by its sha256", default="data/desc2020_store")
+    parser.add_argument("-c", "--mesh-cache", help="Directory for the precomputed MeSH distance "
+            "tables, rebuilt when the MeSH edge list changes", default="data/mesh_dist_cache")
+    parser.add_argument("--no-mesh-cache", help="Compute MeSH distances by BFS on every run "
+            "instead of using the distance table", action="store_true")
+    parser.add_argument("-a", "--approximate", help="Estimate the RMSD of large components from "
+            "a sample of term pairs", action="store_true")
+    parser.add_argument("--exact-max-terms", help="With --approximate, components with at most "
+            "this many MeSH mapped terms are still computed exactly, default=200",
+            type=int, default=200)
+    parser.add_argument("--rmsd-samples", help="Number of term pairs sampled per approximated "
+            "component, default=5000", type=int, default=5000)
+    parser.add_argument("--confidence", help="Confidence level of the reported interval for "
+            "approximated RMSDs, default=0.95", type=float, default=0.95)
+    parser.add_argument("-s", "--seed", help="Seed for the pair sampling, default=0",
+            type=int, default=0)
+    parser.add_argument("-r", "--result-cache", help="Directory for cached per-component "
+            "results, default=data/component_cache", default="data/component_cache")
+    parser.add_argument("--no-result-cache", help="Recompute every component", 
+            action="store_true")
+    parser.add_argument("--result-cache-max-age", help="Remove cached component results not "
+            f"used for this many days, default={DEFAULT_MAX_AGE_DAYS}", type=float,
+            default=DEFAULT_MAX_AGE_DAYS)
+    parser.add_argument("-p", "--processes", help="Number of worker processes for the "
+            "component comparisons, default=1", type=int, default=1)
+    parser.add_argument("--output-format", help="text writes the comparison results as before, "
+            "npy or parquet write columnar tables of the component RMSDs and pair distances "
+            "instead, to {output}_components and {output}_pairs (in the batch directory for "
+            "several inputs), default=text", choices=FORMATS, default="text")
+    add_metrics_args(parser, "relationships")
 
     args = parser.parse_args()
 
     # log delimiter
     logger.info("###############################")
+    logger.info(f"Input: {' '.join(args.input)}")
+    if args.approximate:
+        logger.info(f"Approximate RMSD above {args.exact_max_terms} terms, "
+                f"{args.rmsd_samples} samples, seed {args.seed}")
+
+    if args.rmsd_samples < 2:
+        parser.error("--rmsd-samples must be at least 2 to estimate a confidence interval")
+    if args.output_format == "parquet" and not can_write_parquet():
+        parser.error("--output-format parquet needs pyarrow")
+
+    return args
+
+# expands globs, inputs that aren't globs are kept even if they don't exist
+# so that a missing file is reported when it is opened
+def expand_inputs(patterns):
+    inputs = []
+
+    for pattern in patterns:
+        if glob.has_magic(pattern):
+            inputs.extend(sorted(glob.glob(pattern)))
+        else:
+            inputs.append(pattern)
+
+    return list(dict.fromkeys(inputs))
+
+# one output file per hierarchy, named after the input. inputs with the same
+# file name get their position as a prefix
+def get_batch_output_paths(inputs, batch_dir):
+    names = [os.path.basename(fp) for fp in inputs]
+    counts = {name: names.count(name) for name in names}
+
+    paths = []
+    for idx, name in enumerate(names):
+        if counts[name] > 1:
+            name = f"{idx}_{name}"
+        paths.append(os.path.join(batch_dir, f"{name}.comparison_results"))
+
+    return paths
+
+def write_comparison_results(component_results, fp):
+    with open(fp, "w") as out:
+        for component_result in component_results:
+            for res in component_result["lines"]:
+                out.write(f"{res}\n")
+
+# the components and pairs tables for all of the inputs, streamed to
+# {prefix}_components and {prefix}_pairs in a columnar format
+def write_comparison_tables(inputs, hierarchy_results, prefix, fmt):
+    with ColumnarWriter(get_table_path(f"{prefix}_components", fmt), COMPONENT_COLUMNS, 
+            fmt) as components, ColumnarWriter(get_table_path(f"{prefix}_pairs", fmt), 
+            PAIR_COLUMNS, fmt) as pairs:
+        for (fp, (_, component_results)) in zip(inputs, hierarchy_results):
+            for (idx, res) in enumerate(component_results):
+                (ci_low, ci_high) = (math.nan, math.nan) if res["ci"] is None else res["ci"]
+                components.write_row((fp, idx, res["num_terms"], res["rmsd"], ci_low, ci_high,
+                        len(res["lines"]) > 0))
+                for pair in res["pairs"]:
+                    pairs.write_row((fp, idx) + tuple(pair))
+
+# (mean rmsd, num approximated, num reported) for one hierarchy
+def summarize_results(component_results):
+    rmsds = [component_result["rmsd"] for component_result in component_results]
+    num_approximated = len([res for res in component_results if res["ci"] is not None])
+    num_reported = len([res for res in component_results if res["lines"]])
+
+    mean_rmsd = sum(rmsds) / len(rmsds) if rmsds else float("nan")
+
+    return (mean_rmsd, num_approximated, num_reported)
+
+def write_summary(summary, fp):
+    with open(fp, "w") as out:
+        out.write("input\tnum_components\tnum_mesh_components\tnum_approximated\t"
+                "num_reported\tmean_rmsd\n")
+        for row in summary:
+            out.write("\t".join([str(it) for it in row]) + "\n")
+
+# the MeSH side of a comparison, shared by every hierarchy compared against it
+class MeshSide:
+    __slots__ = ("descriptors", "lem_mesh", "lem_mesh_map", "lem_mesh_bigrams", "mesh_graph", 
+            "mesh_table", "input_hashes")
+
+    # input_hashes are the hash_file hashes of the MeSH edge list, the
+    # lemmatized MeSH file and the descriptor file
+    def __init__(self, descriptors, lem_mesh, lem_mesh_map, lem_mesh_bigrams, mesh_graph, 
+            mesh_table, input_hashes):
+        self.descriptors = descriptors
+        self.lem_mesh = lem_mesh
+        self.lem_mesh_map = lem_mesh_map
+        self.lem_mesh_bigrams = lem_mesh_bigrams
+        self.mesh_graph = mesh_graph
+        self.mesh_table = mesh_table
+        self.input_hashes = input_hashes
+
+# without a mesh_cache_dir MeSH distances are computed by BFS on mesh_graph,
+# otherwise the graph is only loaded if the distance table has to be built.
+# the descriptor store is kept in desc_store_dir if one is given. each input
+# file is hashed once, the descriptor store and the distance table reuse
+# the hashes for their keys
+def load_mesh_side(desc_fp, lem_fp, mesh_fp, mesh_cache_dir=None, desc_store_dir=None):
+    descriptors = get_descriptor_store(desc_fp, desc_store_dir)
+    desc_hash = descriptors.source if descriptors.source is not None else hash_file(desc_fp)
+    mesh_hash = hash_file(mesh_fp)
+
+    # these need to be lists
+    (lem_mesh, lem_uid_map) = load_lem_mesh(lem_fp)
+    (lem_mesh_bigrams, lem_uid_map) = get_bigram_set(lem_mesh, lem_uid_map)
+
+    if mesh_cache_dir is None:
+        mesh_graph = load_from_edge_list(mesh_fp)
+        mesh_table = None
+    else:
+        # only descriptors with a lemmatized term are ever looked up
+        mesh_graph = None
+        mesh_table = get_mesh_distance_table(mesh_fp, lem_uid_map.values(), mesh_cache_dir,
+                                             lambda: load_from_edge_list(mesh_fp), mesh_hash)
+
+    return MeshSide(descriptors, lem_mesh, lem_uid_map, lem_mesh_bigrams, mesh_graph, mesh_table, 
+            [mesh_hash, hash_file(lem_fp), desc_hash])
+
+# compares each hierarchy (adjacency list) against MeSH. returns, for each
+# hierarchy, its total number of components and the results of its components
+# with multiple MeSH terms, in order
+def compare_hierarchies(adj_lists, mesh_side, exact_max_terms=None, num_samples=5000, seed=0,
+        confidence=0.95, result_cache_dir=None, processes=1):
+    logger = logging.getLogger(__name__)
+    metrics = get_metrics()
+
+    # one vocabulary over all of the hierarchies, membership doesn't depend
+    # on which hierarchy a term came from
+    vocab = TermVocabulary()
+    for adj_list in adj_lists:
+        vocab.add_all(adj_list.keys())
+    vocab.mark_mesh(mesh_side.lem_mesh, mesh_side.lem_mesh_bigrams)
+
+    all_components = []
+    num_components = []
+    hierarchy_slices = []
+
+    for adj_list in adj_lists:
+        with metrics.stage("components"):
+            components = get_components(adj_list)
+            components_subset = get_component_subset(adj_list, mesh_side.lem_mesh, 
+                    mesh_side.lem_mesh_bigrams, mesh_side.lem_mesh_map, vocab)
 
-    return parser.parse_args()
+        num_components.append(len(components))
+        hierarchy_slices.append((len(all_components), len(all_components) + len(components_subset)))
+        all_components.extend(components_subset)
+
+    ctx = ComparisonContext(mesh_side.mesh_graph, mesh_side.lem_mesh_map, mesh_side.lem_mesh, 
+            mesh_side.lem_mesh_bigrams, mesh_side.descriptors, vocab, mesh_side.mesh_table, 
+            exact_max_terms, num_samples, seed, confidence)
+
+    cache = None
+    if result_cache_dir is not None:
+        inputs_key = get_inputs_key(mesh_side.input_hashes, ctx.get_settings())
+        cache = ComponentCache(result_cache_dir, inputs_key)
+
+    # the components of every hierarchy go through the pool together
+    with metrics.stage("compare_components"):
+        component_results = compare_components(all_components, ctx, cache, processes)
+
+    if cache is not None:
+        logger.info(f"Component cache: {cache.hits} reused, {cache.misses} computed")
+
+    return [(total, component_results[start:end]) 
+            for (total, (start, end)) in zip(num_components, hierarchy_slices)]
 
 if __name__ == "__main__":
     logger = initialize_logger()
     args = get_args()
+    metrics = start_metrics("check_relationship_similarity", args.profile)
+    metrics.track_rate("components_computed", "compare_components")
 
-    adj_list = load_from_edge_list(args.input)
-    
-    (desc_data, _) = parse_mesh(args.desc)
+    inputs = expand_inputs(args.input)
+    if not inputs:
+        raise Exception("No input edge lists found")
 
-    # these need to be lists
-    (lem_mesh, lem_uid_map) = load_lem_mesh(args.lem)
-    (lem_mesh_bigrams, lem_uid_map) = get_bigram_set(lem_mesh, lem_uid_map)
+    # the MeSH side is loaded once and shared by every hierarchy
+    with metrics.stage("load_mesh"):
+        mesh_side = load_mesh_side(args.desc, args.lem, args.mesh, 
+                None if args.no_mesh_cache else args.mesh_cache, args.desc_store)
 
-    components = get_components(adj_list)
-    components_subset = get_component_subset(adj_list, lem_mesh, lem_mesh_bigrams, lem_uid_map)
+    with metrics.stage("load_hierarchies"):
+        adj_lists = [load_from_edge_list(fp) for fp in inputs]
 
-    logger.info(f"total number of components: {len(components)}")
-    logger.info(f"num components w/ multiple mesh terms: {len(components_subset)}")
+    exact_max_terms = args.exact_max_terms if args.approximate else None
+    result_cache_dir = None if args.no_result_cache else args.result_cache
 
-    mesh_graph = load_from_edge_list(args.mesh)
+    hierarchy_results = compare_hierarchies(adj_lists, mesh_side, exact_max_terms, 
+            args.rmsd_samples, args.seed, args.confidence, result_cache_dir, args.processes)
 
-    rmsds = []
-    results = []
+    if result_cache_dir is not None and os.path.isdir(result_cache_dir):
+        with metrics.stage("prune_result_cache"):
+            (removed, freed) = prune_cache(result_cache_dir, args.result_cache_max_age)
+        if removed:
+            logger.info(f"Pruned {removed} component results ({freed} bytes) unused for "
+                    f"{args.result_cache_max_age} days")
 
-    for component in components_subset:
-        (h_d, m_d) = build_distance_matrix(component, mesh_graph, lem_uid_map, 
-                                            lem_mesh, lem_mesh_bigrams)
-        rmsd = get_rmsd(h_d, m_d)
-        if rmsd < 2.0:
-            results.append("####")
-            results.append(f"RMSD: {rmsd}")
-            result = analyze_component(component, lem_mesh, lem_mesh_bigrams, 
-                    lem_uid_map, desc_data, adj_list, mesh_graph)
-            
-            results.extend(result)
-        rmsds.append(rmsd)
+    if len(inputs) == 1:
+        output_paths = [args.output]
+    else:
+        os.makedirs(args.batch_dir, exist_ok=True)
+        output_paths = get_batch_output_paths(inputs, args.batch_dir)
+
+    summary = []
+
+    for (fp, out_fp, (total, component_results)) in zip(inputs, output_paths, hierarchy_results):
+        (mean_rmsd, num_approximated, num_reported) = summarize_results(component_results)
+
+        logger.info(f"{fp} total number of components: {total}")
+        logger.info(f"{fp} num components w/ multiple mesh terms: {len(component_results)}")
+        if num_approximated > 0:
+            logger.info(f"{fp} RMSD approximated for {num_approximated} components")
+        logger.info(f"{fp} Mean RMSD: {mean_rmsd}")
 
-    #logger.info(rmsds)
-    mean_rmsd = sum(rmsds) / len(rmsds)
-    logger.info(f"Mean RMSD: {mean_rmsd}")
+        if args.output_format == "text":
+            write_comparison_results(component_results, out_fp)
+        summary.append((fp, total, len(component_results), num_approximated, num_reported, 
+                mean_rmsd))
 
-    with open("comparison_results", "w") as out:
-        for res in results:
-            out.write(f"{res}\n")
+    if args.output_format != "text":
+        prefix = args.output if len(inputs) == 1 else os.path.join(args.batch_dir, "comparison")
+        with metrics.stage("write_tables"):
+            write_comparison_tables(inputs, hierarchy_results, prefix, args.output_format)
 
+    if len(inputs) > 1:
+        write_summary(summary, os.path.join(args.batch_dir, "summary.tsv"))
 
+    metrics.finish(args.metrics, logger)
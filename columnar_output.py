@@ -0,0 +1,239 @@
+import os
+import json
+import shutil
+import struct
+
+import numpy as np
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# Columnar tables for results that are analysed downstream (sweep statistics,
+# per-component RMSDs, per-pair distances), instead of re-parsing the text
+# outputs. Rows are buffered and written out in batches, so a table never
+# has to be held in memory. Two formats:
+#
+#   npy      a directory with one .npy file per column, appended to batch by
+#            batch and with the row count patched into the header on close.
+#            string columns are a utf-8 blob ({name}.data.npy) and offsets
+#            ({name}.offsets.npy), like the descriptor store. columns.json
+#            gives the column order and kinds. np.load with mmap_mode reads
+#            any column without copying it
+#   parquet  one Parquet file, written one row group per batch. needs pyarrow
+#
+# a table is written under a temporary name and moved into place on close
+
+FORMATS = ["text", "npy", "parquet"]
+
+# path suffix of a table written with each format
+TABLE_SUFFIXES = {"npy": "_npy", "parquet": ".parquet"}
+
+BATCH_ROWS = 65536
+
+DTYPES = {"int": np.dtype("<i8"), "float": np.dtype("<f8"), "bool": np.dtype("bool")}
+
+# fixed size .npy header (format 1.0), so the row count can be written over
+# it once it is known
+NPY_MAGIC = b"\x93NUMPY\x01\x00"
+NPY_HEADER_LEN = 128
+
+COLUMNS_FP = "columns.json"
+
+def can_write_parquet():
+    return pyarrow is not None
+
+def get_table_path(prefix, fmt):
+    return f"{prefix}{TABLE_SUFFIXES[fmt]}"
+
+def _write_npy_header(handle, dtype, num_rows):
+    header = f"{{'descr': '{dtype.str}', 'fortran_order': False, 'shape': ({num_rows},), }}"
+    header_len = NPY_HEADER_LEN - len(NPY_MAGIC) - 2
+
+    handle.seek(0)
+    handle.write(NPY_MAGIC + struct.pack("<H", header_len) +
+            header.ljust(header_len - 1).encode("latin1") + b"\n")
+
+class ColumnarWriter:
+    __slots__ = ("path", "tmp_path", "columns", "fmt", "batch_rows", "batch", "num_rows",
+            "handles", "string_ends", "parquet_writer", "schema")
+
+    # columns is a list of (name, kind), kind is "int", "float", "bool" or
+    # "str"
+    def __init__(self, path, columns, fmt="npy", batch_rows=BATCH_ROWS):
+        if fmt not in TABLE_SUFFIXES:
+            raise Exception(f"Unknown table format {fmt}")
+
+        self.path = path
+        self.tmp_path = f"{path}.tmp"
+        self.columns = columns
+        self.fmt = fmt
+        self.batch_rows = batch_rows
+        self.batch = []
+        self.num_rows = 0
+        self.handles = {}
+        self.string_ends = {}
+        self.parquet_writer = None
+        self.schema = None
+
+        if fmt == "npy":
+            self._open_npy()
+        else:
+            self._open_parquet()
+
+    def _open_npy(self):
+        if os.path.exists(self.tmp_path):
+            shutil.rmtree(self.tmp_path)
+        os.makedirs(self.tmp_path)
+
+        for (name, kind) in self.columns:
+            if kind == "str":
+                data = open(os.path.join(self.tmp_path, f"{name}.data.npy"), "wb")
+                offsets = open(os.path.join(self.tmp_path, f"{name}.offsets.npy"), "wb")
+                _write_npy_header(data, np.dtype("u1"), 0)
+                _write_npy_header(offsets, DTYPES["int"], 0)
+                # the offsets start at 0, one more entry than there are rows
+                offsets.write(np.zeros(1, dtype=DTYPES["int"]).tobytes())
+                self.handles[name] = (data, offsets)
+                self.string_ends[name] = 0
+            else:
+                handle = open(os.path.join(self.tmp_path, f"{name}.npy"), "wb")
+                _write_npy_header(handle, DTYPES[kind], 0)
+                self.handles[name] = handle
+
+    def _open_parquet(self):
+        if pyarrow is None:
+            raise Exception("Parquet output needs pyarrow, use the npy format instead")
+
+        types = {"int": pyarrow.int64(), "float": pyarrow.float64(), "bool": pyarrow.bool_(),
+                "str": pyarrow.string()}
+        self.schema = pyarrow.schema([(name, types[kind]) for (name, kind) in self.columns])
+        self.parquet_writer = pyarrow.parquet.ParquetWriter(self.tmp_path, self.schema)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        # a failed table isn't moved into place
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    # row is a tuple in column order
+    def write_row(self, row):
+        self.batch.append(row)
+        if len(self.batch) >= self.batch_rows:
+            self.flush()
+
+    def write_rows(self, rows):
+        for row in rows:
+            self.write_row(row)
+
+    def flush(self):
+        if not self.batch:
+            return
+
+        columns = list(zip(*self.batch))
+        if self.fmt == "npy":
+            self._flush_npy(columns)
+        else:
+            self.parquet_writer.write_table(pyarrow.Table.from_pydict(
+                    {name: list(values) for ((name, _), values) in zip(self.columns, columns)},
+                    schema=self.schema))
+
+        self.num_rows += len(self.batch)
+        self.batch = []
+
+    def _flush_npy(self, columns):
+        for ((name, kind), values) in zip(self.columns, columns):
+            if kind == "str":
+                (data, offsets) = self.handles[name]
+                encoded = [value.encode("utf-8") for value in values]
+                ends = self.string_ends[name] + np.cumsum([len(it) for it in encoded],
+                        dtype=DTYPES["int"])
+                data.write(b"".join(encoded))
+                offsets.write(ends.tobytes())
+                self.string_ends[name] = int(ends[-1])
+            else:
+                self.handles[name].write(np.asarray(values, dtype=DTYPES[kind]).tobytes())
+
+    def close(self):
+        self.flush()
+
+        if self.fmt == "npy":
+            for (name, kind) in self.columns:
+                if kind == "str":
+                    (data, offsets) = self.handles[name]
+                    _write_npy_header(data, np.dtype("u1"), self.string_ends[name])
+                    _write_npy_header(offsets, DTYPES["int"], self.num_rows + 1)
+                    data.close()
+                    offsets.close()
+                else:
+                    _write_npy_header(self.handles[name], DTYPES[kind], self.num_rows)
+                    self.handles[name].close()
+
+            with open(os.path.join(self.tmp_path, COLUMNS_FP), "w") as out:
+                json.dump({"columns": self.columns, "num_rows": self.num_rows}, out)
+
+            if os.path.exists(self.path):
+                shutil.rmtree(self.path)
+        else:
+            self.parquet_writer.close()
+
+        os.replace(self.tmp_path, self.path)
+
+    def abort(self):
+        if self.fmt == "npy":
+            for handles in self.handles.values():
+                for handle in (handles if isinstance(handles, tuple) else (handles,)):
+                    handle.close()
+            shutil.rmtree(self.tmp_path, ignore_errors=True)
+        else:
+            self.parquet_writer.close()
+            os.remove(self.tmp_path)
+
+def write_table(rows, path, columns, fmt="npy"):
+    with ColumnarWriter(path, columns, fmt) as writer:
+        writer.write_rows(rows)
+
+# a string column of an npy table, the strings are only decoded when indexed
+class StringColumn:
+    __slots__ = ("data", "offsets")
+
+    def __init__(self, data, offsets):
+        self.data = data
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        return self.data[self.offsets[idx]:self.offsets[idx + 1]].tobytes().decode("utf-8")
+
+    def tolist(self):
+        return [self[idx] for idx in range(len(self))]
+
+# the columns of a table by name. npy columns are memory-mapped arrays (or
+# StringColumns), a Parquet table is returned as a memory-mapped pyarrow Table
+def load_table(path, mmap_mode="r"):
+    if path.endswith(TABLE_SUFFIXES["parquet"]):
+        if pyarrow is None:
+            raise Exception("Reading Parquet needs pyarrow")
+        return pyarrow.parquet.read_table(path, memory_map=True)
+
+    with open(os.path.join(path, COLUMNS_FP), "r") as handle:
+        columns = json.load(handle)["columns"]
+
+    table = {}
+    for (name, kind) in columns:
+        if kind == "str":
+            table[name] = StringColumn(
+                    np.load(os.path.join(path, f"{name}.data.npy"), mmap_mode=mmap_mode),
+                    np.load(os.path.join(path, f"{name}.offsets.npy"), mmap_mode=mmap_mode))
+        else:
+            table[name] = np.load(os.path.join(path, f"{name}.npy"), mmap_mode=mmap_mode)
+
+    return table
@@ -0,0 +1,114 @@
+import os
+import json
+import time
+import hashlib
+
+# Persistent per-component results for check_relationship_similarity. A
+# component's result only depends on its own edges and on the MeSH side
+# inputs, so the key is a hash of the component's canonical edge set and of
+# those inputs. Unchanged components are read back instead of recomputed
+# when the hierarchy is regenerated.
+#
+# Entries are touched when they are read, so their mtime is when they were
+# last used. Without pruning the cache only grows, every changed component
+# and every change of the inputs or settings adds entries; prune_cache() removes
+# the ones that haven't been used for a while
+
+DEFAULT_MAX_AGE_DAYS = 30
+
+# hash of the MeSH/lemma inputs (their hash_file hashes, which the callers
+# already have from the descriptor store and distance table lookups) and of
+# any settings that change the results
+def get_inputs_key(input_hashes, settings):
+    digest = hashlib.sha256()
+
+    for input_hash in input_hashes:
+        digest.update(input_hash.encode())
+
+    digest.update(json.dumps(settings, sort_keys=True).encode())
+
+    return digest.hexdigest()
+
+# the edges are undirected, each one is written once with its terms sorted
+def get_component_key(component, inputs_key):
+    edges = set()
+    for node, adjs in component.items():
+        # isolated nodes don't end up in any edge
+        edges.add((node, node))
+        for adj in adjs:
+            edges.add((node, adj) if node <= adj else (adj, node))
+
+    digest = hashlib.sha256(inputs_key.encode())
+    for (node_0, node_1) in sorted(edges):
+        digest.update(f"{node_0}\t{node_1}\n".encode())
+
+    return digest.hexdigest()
+
+class ComponentCache:
+    __slots__ = ("cache_dir", "inputs_key", "hits", "misses")
+
+    def __init__(self, cache_dir, inputs_key):
+        self.cache_dir = cache_dir
+        self.inputs_key = inputs_key
+        self.hits = 0
+        self.misses = 0
+
+    def get_key(self, component):
+        return get_component_key(component, self.inputs_key)
+
+    def _get_path(self, key):
+        return os.path.join(self.cache_dir, key[:2], f"{key}.json")
+
+    def get(self, key):
+        path = self._get_path(key)
+
+        if not os.path.exists(path):
+            self.misses += 1
+            return None
+
+        try:
+            with open(path, "r") as handle:
+                result = json.load(handle)
+            os.utime(path)
+        except FileNotFoundError:
+            # pruned by another run in the meantime
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return result
+
+    # written to a temp file first so that a killed run never leaves a
+    # partial entry behind
+    def put(self, key, result):
+        path = self._get_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as out:
+            json.dump(result, out)
+
+        os.replace(tmp_path, path)
+
+# removes the entries of cache_dir that haven't been read or written in
+# max_age_days. returns (entries removed, bytes freed)
+def prune_cache(cache_dir, max_age_days=DEFAULT_MAX_AGE_DAYS):
+    cutoff = time.time() - max_age_days * 86400
+    removed = 0
+    freed = 0
+
+    for (dir_path, _, file_names) in os.walk(cache_dir):
+        for file_name in file_names:
+            path = os.path.join(dir_path, file_name)
+            try:
+                stat = os.stat(path)
+                if stat.st_mtime >= cutoff:
+                    continue
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+
+            removed += 1
+            freed += stat.st_size
+
+    return (removed, freed)
@@ -0,0 +1,293 @@
+import os
+import json
+import shutil
+import logging
+import tempfile
+
+import numpy as np
+
+from parse_mesh import parse_mesh
+from mesh_distance_cache import hash_file
+
+# Columnar store of the MeSH descriptors, replacing the dict of per-UID dicts
+# that parse_mesh returns and the term_trees/term_trees_rev dicts built from
+# it. Descriptors are numbered in file order. Strings (UIDs, names, tree
+# positions) live in one utf-8 blob per column with an offsets array, and
+# the tree structure is flat int arrays:
+#
+#   desc_position_offsets  positions of descriptor i are
+#                          desc_position_offsets[i]:desc_position_offsets[i + 1]
+#   position_descs         descriptor of each position
+#   position_parents       parent position of each position, -1 for tree roots
+#   child_offsets/ids      children of each descriptor (CSR), derived from
+#                          position_parents when the store is built
+#
+# Apart from the UID index everything is a numpy array, so a store loaded
+# with mmap is shared between processes through the page cache, and a
+# forked pool worker doesn't copy it (there are no per-descriptor objects
+# whose refcounts would dirty the pages). The store is a read-only drop in
+# for desc_data: store[uid]["name"] and iterating over UIDs work as before
+
+ARRAY_NAMES = ("uid_data", "uid_offsets", "name_data", "name_offsets", "position_data",
+        "position_offsets", "desc_position_offsets", "position_descs", "position_parents",
+        "child_offsets", "child_ids")
+
+# the sha256 of the descriptor file a saved store was built from
+SOURCE_FP = "source.json"
+
+def _pack_strings(strings):
+    encoded = [string.encode("utf-8") for string in strings]
+
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(it) for it in encoded], out=offsets[1:])
+
+    return (np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets)
+
+def _get_string(data, offsets, idx):
+    return data[offsets[idx]:offsets[idx + 1]].tobytes().decode("utf-8")
+
+# view of one descriptor. ["name"] and ["graph_positions"] work like the
+# desc_data dicts
+class Descriptor:
+    __slots__ = ("store", "idx")
+
+    def __init__(self, store, idx):
+        self.store = store
+        self.idx = idx
+
+    @property
+    def uid(self):
+        return self.store.uids[self.idx]
+
+    @property
+    def name(self):
+        return self.store.get_name(self.idx)
+
+    @property
+    def positions(self):
+        return self.store.get_positions(self.idx)
+
+    @property
+    def children(self):
+        return self.store.get_children(self.idx)
+
+    def __getitem__(self, key):
+        if key == "name":
+            return self.name
+        if key == "graph_positions":
+            return "|".join(self.positions)
+        if key == "uid":
+            return self.uid
+
+        raise KeyError(key)
+
+    def __repr__(self):
+        return f"Descriptor({self.uid}, {self.name!r})"
+
+class DescriptorStore:
+    __slots__ = ARRAY_NAMES + ("uids", "uid_index", "store_dir", "source", "_position_index")
+
+    # source is the sha256 of the descriptor file a saved store was built
+    # from, None for a store built in memory
+    def __init__(self, arrays, store_dir=None, source=None):
+        for name in ARRAY_NAMES:
+            setattr(self, name, arrays[name])
+
+        self.uids = [_get_string(self.uid_data, self.uid_offsets, idx)
+                for idx in range(len(self.uid_offsets) - 1)]
+        self.uid_index = {uid: idx for idx, uid in enumerate(self.uids)}
+        self.store_dir = store_dir
+        self.source = source
+        self._position_index = None
+
+    # sent to a worker process, a saved store is re-mapped from its files
+    # rather than copied
+    def __reduce__(self):
+        if self.store_dir is None:
+            return (DescriptorStore, ({name: np.asarray(getattr(self, name))
+                    for name in ARRAY_NAMES},))
+
+        return (load_descriptor_store, (self.store_dir,))
+
+    def __len__(self):
+        return len(self.uids)
+
+    def __iter__(self):
+        return iter(self.uids)
+
+    def __contains__(self, uid):
+        return uid in self.uid_index
+
+    def __getitem__(self, uid):
+        return Descriptor(self, self.uid_index[uid])
+
+    def keys(self):
+        return list(self.uids)
+
+    def get_name(self, idx):
+        return _get_string(self.name_data, self.name_offsets, idx)
+
+    def get_positions(self, idx):
+        return [_get_string(self.position_data, self.position_offsets, pos)
+                for pos in range(self.desc_position_offsets[idx],
+                        self.desc_position_offsets[idx + 1])]
+
+    def get_children(self, idx):
+        return [self.uids[child] for child in
+                self.child_ids[self.child_offsets[idx]:self.child_offsets[idx + 1]].tolist()]
+
+    def name(self, uid):
+        return self.get_name(self.uid_index[uid])
+
+    def positions(self, uid):
+        return self.get_positions(self.uid_index[uid])
+
+    # same UIDs, in the same order, as get_children(uid, term_trees). UIDs
+    # that aren't in the store have no children
+    def children(self, uid):
+        idx = self.uid_index.get(uid)
+        if idx is None:
+            return []
+
+        return self.get_children(idx)
+
+    # the UID at a tree position, replaces term_trees_rev. the position index
+    # is only built if this is used
+    def uid_at(self, position):
+        if self._position_index is None:
+            self._position_index = {_get_string(self.position_data, self.position_offsets, pos):
+                    pos for pos in range(len(self.position_descs))}
+
+        return self.uids[self.position_descs[self._position_index[position]]]
+
+    # UIDs of the parents of a descriptor, over all of its positions
+    def parents(self, uid):
+        idx = self.uid_index[uid]
+        parents = []
+        for pos in range(self.desc_position_offsets[idx], self.desc_position_offsets[idx + 1]):
+            parent = self.position_parents[pos]
+            if parent >= 0:
+                parents.append(self.uids[self.position_descs[parent]])
+
+        return list(dict.fromkeys(parents))
+
+    # writes each array as .npy, and source (the descriptor file's hash) if
+    # given, into a temporary directory next to store_dir and renames it into
+    # place. if another process installed store_dir first, its store is kept
+    def save(self, store_dir, source=None):
+        parent = os.path.dirname(os.path.abspath(store_dir))
+        os.makedirs(parent, exist_ok=True)
+        tmp_dir = tempfile.mkdtemp(prefix=f"{os.path.basename(store_dir)}.", suffix=".tmp",
+                dir=parent)
+
+        try:
+            for name in ARRAY_NAMES:
+                np.save(os.path.join(tmp_dir, f"{name}.npy"), np.asarray(getattr(self, name)))
+            if source is not None:
+                with open(os.path.join(tmp_dir, SOURCE_FP), "w") as out:
+                    json.dump({"sha256": source}, out)
+
+            try:
+                os.replace(tmp_dir, store_dir)
+            except OSError:
+                if not os.path.isdir(store_dir):
+                    raise
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+# builds the store from parse_mesh's desc_data. a descriptor's children are
+# the descriptors with a position one level below one of its positions, in
+# the order get_children gives them (its positions in order, then
+# descriptor order, without repeats)
+def build_descriptor_store(desc_data):
+    uids = list(desc_data.keys())
+
+    names = []
+    positions = []
+    position_descs = []
+    desc_position_offsets = [0]
+
+    for idx, uid in enumerate(uids):
+        names.append(desc_data[uid]["name"])
+        # descriptors that aren't part of any tree have an empty position
+        for position in desc_data[uid]["graph_positions"].split("|"):
+            if position:
+                positions.append(position)
+                position_descs.append(idx)
+        desc_position_offsets.append(len(positions))
+
+    position_index = {position: pos for pos, position in enumerate(positions)}
+    position_parents = [position_index.get(position.rsplit(".", 1)[0], -1)
+            if "." in position else -1 for position in positions]
+
+    # positions are numbered in descriptor order, so each position's child
+    # positions come out in descriptor order too
+    position_children = [[] for _ in positions]
+    for (pos, parent) in enumerate(position_parents):
+        if parent >= 0:
+            position_children[parent].append(pos)
+
+    child_offsets = [0]
+    child_ids = []
+    for idx in range(len(uids)):
+        children = {}
+        for pos in range(desc_position_offsets[idx], desc_position_offsets[idx + 1]):
+            for child_pos in position_children[pos]:
+                if position_descs[child_pos] != idx:
+                    children[position_descs[child_pos]] = None
+        child_ids.extend(children.keys())
+        child_offsets.append(len(child_ids))
+
+    (uid_data, uid_offsets) = _pack_strings(uids)
+    (name_data, name_offsets) = _pack_strings(names)
+    (position_data, position_offsets) = _pack_strings(positions)
+
+    return DescriptorStore({"uid_data": uid_data, "uid_offsets": uid_offsets,
+            "name_data": name_data, "name_offsets": name_offsets,
+            "position_data": position_data, "position_offsets": position_offsets,
+            "desc_position_offsets": np.array(desc_position_offsets, dtype=np.int64),
+            "position_descs": np.array(position_descs, dtype=np.int32),
+            "position_parents": np.array(position_parents, dtype=np.int32),
+            "child_offsets": np.array(child_offsets, dtype=np.int64),
+            "child_ids": np.array(child_ids, dtype=np.int32)})
+
+def load_descriptor_store(store_dir, mmap_mode="r"):
+    arrays = {name: np.load(os.path.join(store_dir, f"{name}.npy"), mmap_mode=mmap_mode)
+            for name in ARRAY_NAMES}
+
+    return DescriptorStore(arrays, store_dir, get_store_source(store_dir))
+
+def get_store_source(store_dir):
+    try:
+        with open(os.path.join(store_dir, SOURCE_FP), "r") as handle:
+            return json.load(handle)["sha256"]
+    except (OSError, ValueError, KeyError):
+        return None
+
+# the store for a descriptor file, kept in store_dir under the sha256 of the
+# file and loaded (memory-mapped) from there if it has been built before,
+# otherwise parsed, built and saved. without a store_dir it is built in
+# memory every time
+def get_descriptor_store(desc_fp, store_dir=None):
+    logger = logging.getLogger(__name__)
+
+    if store_dir is None:
+        (desc_data, _) = parse_mesh(desc_fp)
+        return build_descriptor_store(desc_data)
+
+    source = hash_file(desc_fp)
+    key_dir = os.path.join(store_dir, source)
+
+    if get_store_source(key_dir) == source:
+        logger.info(f"Loading descriptor store from {key_dir}")
+        return load_descriptor_store(key_dir)
+
+    # left over without a source, e.g. copied in by hand
+    if os.path.isdir(key_dir):
+        shutil.rmtree(key_dir)
+
+    logger.info(f"Building descriptor store {key_dir} from {desc_fp}")
+    (desc_data, _) = parse_mesh(desc_fp)
+    build_descriptor_store(desc_data).save(key_dir, source)
+
+    return load_descriptor_store(key_dir)
@@ -0,0 +1,199 @@
+import os
+import logging
+import hashlib
+from array import array
+
+import numpy as np
+from scipy import sparse
+
+from mesh_distance_cache import hash_file
+from instrumentation import get_metrics
+
+# Document x descriptor matrix for the PubMed doc-term file. Rows are
+# documents (PMIDs), columns are descriptor UIDs and values are the number of
+# times the UID is listed for the document, so the column sums are the same
+# counts that load_term_freqs gives
+class DocTermMatrix:
+    __slots__ = ("matrix", "uids", "pmids", "uid_index", "pmid_index", "_binary")
+
+    def __init__(self, matrix, uids, pmids):
+        self.matrix = matrix.tocsr()
+        self.uids = list(uids)
+        self.pmids = list(pmids)
+        self.uid_index = {uid: idx for idx, uid in enumerate(self.uids)}
+        self.pmid_index = {pmid: idx for idx, pmid in enumerate(self.pmids)}
+        self._binary = None
+
+    @property
+    def shape(self):
+        return self.matrix.shape
+
+    # 0/1 version of the matrix, a document either has a descriptor or not.
+    # used for co-occurrence so repeated UIDs in a row aren't double counted
+    def binary(self):
+        if self._binary is None:
+            binary = self.matrix.copy()
+            binary.data = np.ones_like(binary.data)
+            self._binary = binary
+
+        return self._binary
+
+    def get_columns(self, uids):
+        return [self.uid_index[uid] for uid in uids if uid in self.uid_index]
+
+    def get_rows(self, pmids):
+        return [self.pmid_index[pmid] for pmid in pmids if pmid in self.pmid_index]
+
+    # marginal counts for every column, same output as load_term_freqs.
+    # descriptors in desc_uids that never occur get a count of 0
+    def term_freqs(self, desc_uids=()):
+        term_freqs = {uid: 0 for uid in desc_uids}
+
+        counts = np.asarray(self.matrix.sum(axis=0)).ravel()
+        term_freqs.update(zip(self.uids, counts.tolist()))
+
+        return term_freqs
+
+    # number of documents each descriptor appears in
+    def doc_freqs(self):
+        counts = np.diff(self.matrix.tocsc().indptr)
+        return dict(zip(self.uids, counts.tolist()))
+
+    # marginal counts restricted to a subset of documents, e.g. the
+    # specialized articles
+    def subset_term_freqs(self, pmids):
+        rows = self.get_rows(pmids)
+        counts = np.asarray(self.matrix[rows].sum(axis=0)).ravel()
+        return dict(zip(self.uids, counts.tolist()))
+
+    # pairwise co-occurrence (number of documents with both descriptors) for
+    # a set of UIDs. returns the UIDs found in the matrix, in the order of the
+    # rows/columns of the returned sparse matrix. the diagonal is the doc freq
+    def cooccurrence(self, uids, pmids=None):
+        columns = self.get_columns(uids)
+        sub = self.binary()[:, columns]
+
+        if pmids is not None:
+            sub = sub[self.get_rows(pmids)]
+
+        sub = sub.tocsc()
+        found = [self.uids[col] for col in columns]
+
+        return (found, (sub.T @ sub).tocsr())
+
+    # P(column term | row term) for a set of UIDs, as a dense array
+    def conditional_freqs(self, uids, pmids=None):
+        (found, cooc) = self.cooccurrence(uids, pmids)
+        cooc = cooc.toarray().astype(np.float64)
+
+        diag = cooc.diagonal().copy()
+        diag[diag == 0] = 1.0
+
+        return (found, cooc / diag[:, np.newaxis])
+
+    # written through a handle so that np.savez doesn't append .npz to fp,
+    # and renamed into place. key, if given, is stored with the arrays
+    def save(self, fp, key=None):
+        matrix = self.matrix
+        arrays = {"data": matrix.data, "indices": matrix.indices, "indptr": matrix.indptr,
+                "shape": np.array(matrix.shape), "uids": np.array(self.uids, dtype=str),
+                "pmids": np.array(self.pmids, dtype=str)}
+        if key is not None:
+            arrays["key"] = np.array(key)
+
+        tmp_fp = f"{fp}.{os.getpid()}.tmp"
+        with open(tmp_fp, "wb") as out:
+            np.savez(out, **arrays)
+        os.replace(tmp_fp, fp)
+
+# streams the doc-term counts csv (pmid,uid,uid,...) into CSR arrays without
+# keeping the lines around. desc_uids, if given, fixes the first columns so
+# that descriptors that never occur still get a count of 0
+def build_doc_term_matrix(counts_fp, desc_uids=(), delimiter=","):
+    logger = logging.getLogger(__name__)
+
+    uid_index = {}
+    uids = []
+    for uid in desc_uids:
+        if uid not in uid_index:
+            uid_index[uid] = len(uids)
+            uids.append(uid)
+
+    pmids = []
+    indices = array("i")
+    indptr = array("q", [0])
+
+    with open(counts_fp, "r") as handle:
+        for line in handle:
+            line = line.strip("\n").split(delimiter)
+
+            if not line[0]:
+                continue
+
+            for uid in line[1:]:
+                if not uid:
+                    continue
+                col = uid_index.get(uid)
+                if col is None:
+                    col = len(uids)
+                    uid_index[uid] = col
+                    uids.append(uid)
+                indices.append(col)
+
+            pmids.append(line[0])
+            indptr.append(len(indices))
+
+    get_metrics().count("rows_parsed", len(pmids))
+
+    indices = np.frombuffer(indices, dtype=np.int32)
+    indptr = np.frombuffer(indptr, dtype=np.int64)
+    data = np.ones(len(indices), dtype=np.int32)
+
+    matrix = sparse.csr_matrix((data, indices, indptr), shape=(len(pmids), len(uids)))
+    # repeated UIDs in a row become a single entry with their count
+    matrix.sum_duplicates()
+
+    logger.info(f"Doc-term matrix: {matrix.shape[0]} docs, {matrix.shape[1]} terms, "
+            f"{matrix.nnz} entries")
+
+    return DocTermMatrix(matrix, uids, pmids)
+
+def load_doc_term_matrix(fp):
+    with np.load(fp, allow_pickle=False) as arrays:
+        shape = tuple(arrays["shape"])
+        matrix = sparse.csr_matrix((arrays["data"], arrays["indices"], arrays["indptr"]),
+                shape=shape)
+        uids = arrays["uids"].tolist()
+        pmids = arrays["pmids"].tolist()
+
+    return DocTermMatrix(matrix, uids, pmids)
+
+# the matrix depends on the counts file and on the fixed first columns
+def get_matrix_key(counts_fp, desc_uids):
+    digest = hashlib.sha256()
+    digest.update(f"{os.path.getsize(counts_fp)}\n{hash_file(counts_fp)}\n".encode())
+    digest.update("\n".join(desc_uids).encode())
+
+    return digest.hexdigest()
+
+def load_matrix_key(fp):
+    with np.load(fp, allow_pickle=False) as arrays:
+        return str(arrays["key"]) if "key" in arrays.files else None
+
+# loads the persisted matrix if it was built from this counts file and
+# desc_uids, otherwise builds it and saves it for next time
+def get_doc_term_matrix(counts_fp, matrix_fp, desc_uids=()):
+    logger = logging.getLogger(__name__)
+
+    desc_uids = list(desc_uids)
+    key = get_matrix_key(counts_fp, desc_uids)
+
+    if os.path.exists(matrix_fp) and load_matrix_key(matrix_fp) == key:
+        logger.info(f"Loading doc-term matrix from {matrix_fp}")
+        return load_doc_term_matrix(matrix_fp)
+
+    logger.info(f"Building doc-term matrix from {counts_fp}")
+    dtm = build_doc_term_matrix(counts_fp, desc_uids)
+    dtm.save(matrix_fp, key)
+
+    return dtm
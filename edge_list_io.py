@@ -0,0 +1,132 @@
+import gzip
+
+import numpy as np
+
+# Binary CSR graph file, an alternative to the TSV edge list that can be
+# memory-mapped instead of parsed. Layout (little endian):
+#
+#   magic           8 bytes
+#   num_nodes       uint64
+#   num_neighbors   uint64
+#   names_len       uint64
+#   offsets         int64[num_nodes + 1]    neighbors of node i are
+#   neighbors       int32[num_neighbors]    neighbors[offsets[i]:offsets[i + 1]]
+#   (padding to 8 bytes)
+#   name_offsets    int64[num_nodes + 1]    utf-8 name of node i is
+#   names           uint8[names_len]        names[name_offsets[i]:name_offsets[i + 1]]
+#
+# The graph is undirected, every edge is stored in both directions
+CSR_MAGIC = b"THCSR001"
+CSR_HEADER_LEN = 32
+
+# opens gzipped files transparently, based on the extension
+def open_text(fp, mode="r"):
+    if fp.endswith(".gz"):
+        return gzip.open(fp, mode + "t", encoding="utf-8")
+
+    return open(fp, mode, encoding="utf-8")
+
+def is_csr_graph(fp):
+    with open(fp, "rb") as handle:
+        return handle.read(len(CSR_MAGIC)) == CSR_MAGIC
+
+def _padding(num_bytes):
+    return (8 - num_bytes % 8) % 8
+
+# edges are (source_id, sink_id) pairs over node IDs 0..len(names)-1. the
+# neighbor order of each node is the order the edges were first seen in,
+# the same as load_from_edge_list gives
+def write_csr_graph(sources, sinks, names, fp):
+    num_nodes = len(names)
+    sources = np.asarray(sources, dtype=np.int64)
+    sinks = np.asarray(sinks, dtype=np.int64)
+
+    # both directions, interleaved so that the order of appearance is kept
+    src = np.empty(len(sources) * 2, dtype=np.int64)
+    dst = np.empty(len(sources) * 2, dtype=np.int64)
+    src[0::2] = sources
+    src[1::2] = sinks
+    dst[0::2] = sinks
+    dst[1::2] = sources
+
+    # dedup (src, dst) keeping the first occurrence, then group by src
+    (_, first) = np.unique(src * max(num_nodes, 1) + dst, return_index=True)
+    first.sort()
+    src = src[first]
+    dst = dst[first]
+    order = np.argsort(src, kind="stable")
+    neighbors = dst[order].astype(np.int32)
+
+    offsets = np.zeros(num_nodes + 1, dtype=np.int64)
+    np.cumsum(np.bincount(src, minlength=num_nodes), out=offsets[1:])
+
+    encoded = [name.encode("utf-8") for name in names]
+    name_offsets = np.zeros(num_nodes + 1, dtype=np.int64)
+    np.cumsum([len(name) for name in encoded], out=name_offsets[1:])
+    names_blob = b"".join(encoded)
+
+    header = np.array([num_nodes, len(neighbors), len(names_blob)], dtype="<u8")
+
+    with open(fp, "wb") as out:
+        out.write(CSR_MAGIC)
+        out.write(header.tobytes())
+        out.write(offsets.astype("<i8").tobytes())
+        out.write(neighbors.astype("<i4").tobytes())
+        out.write(b"\0" * _padding(neighbors.nbytes))
+        out.write(name_offsets.astype("<i8").tobytes())
+        out.write(names_blob)
+
+# Read-only adjacency list backed by a memory-mapped CSR graph file. It can be
+# used anywhere a dict adj_list from load_from_edge_list is, adj_list[term]
+# gives the neighboring terms
+class CSRGraph:
+    __slots__ = ("offsets", "neighbors", "names", "node_ids")
+
+    def __init__(self, fp):
+        with open(fp, "rb") as handle:
+            if handle.read(len(CSR_MAGIC)) != CSR_MAGIC:
+                raise Exception(f"{fp} is not a CSR graph file")
+            (num_nodes, num_neighbors, names_len) = np.frombuffer(handle.read(24), dtype="<u8")
+
+        num_nodes = int(num_nodes)
+        num_neighbors = int(num_neighbors)
+        pos = CSR_HEADER_LEN
+
+        self.offsets = np.memmap(fp, dtype="<i8", mode="r", offset=pos, shape=(num_nodes + 1,))
+        pos += self.offsets.nbytes
+
+        self.neighbors = np.memmap(fp, dtype="<i4", mode="r", offset=pos, shape=(num_neighbors,))
+        pos += self.neighbors.nbytes + _padding(num_neighbors * 4)
+
+        name_offsets = np.memmap(fp, dtype="<i8", mode="r", offset=pos, shape=(num_nodes + 1,))
+        pos += name_offsets.nbytes
+
+        names_blob = bytes(np.memmap(fp, dtype=np.uint8, mode="r", offset=pos,
+            shape=(int(names_len),))) if names_len else b""
+
+        self.names = [names_blob[name_offsets[idx]:name_offsets[idx + 1]].decode("utf-8")
+                for idx in range(num_nodes)]
+        self.node_ids = {name: idx for idx, name in enumerate(self.names)}
+
+    def __len__(self):
+        return len(self.names)
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __contains__(self, term):
+        return term in self.node_ids
+
+    def __getitem__(self, term):
+        node_id = self.node_ids[term]
+        names = self.names
+        return [names[idx] for idx in self.neighbor_ids(node_id).tolist()]
+
+    def keys(self):
+        return self.node_ids.keys()
+
+    def neighbor_ids(self, node_id):
+        return self.neighbors[self.offsets[node_id]:self.offsets[node_id + 1]]
+
+def load_csr_graph(fp):
+    return CSRGraph(fp)
@@ -0,0 +1,363 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import socket
+import asyncio
+import inspect
+import logging
+import argparse
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from evaluate import (load_list, load_mesh, get_bigram_set, is_bigram_corpus, encode_trial_data,
+        check_intersection, run_eval_trials, compute_p_val)
+from get_informative_terms import get_informative_terms, load_specialized_term_set
+from check_relationship_similarity import (load_mesh_side, load_from_edge_list,
+        compare_hierarchies, summarize_results)
+from doc_term_matrix import get_doc_term_matrix
+from descriptor_store import get_descriptor_store
+from instrumentation import get_metrics, start_metrics, add_metrics_args
+
+# Local evaluation daemon. Loads MeSH files, corpora and count tables once and
+# keeps them in memory (LRU, reloaded if a file changes) so that repeated
+# evaluate, informative-term and component-RMSD queries don't pay the loading
+# cost. The protocol is one JSON object per line over a Unix socket:
+#
+#   request:  {"op": "evaluate", "corpus": ..., "result": ..., "mesh": ..., ...}
+#   response: {"ok": true, "result": ...} or {"ok": false, "error": "..."}
+#
+# Requests are run on a thread pool so the asyncio front end keeps serving
+# other clients while one is computing
+
+DEFAULT_SOCKET = "eval_server.sock"
+
+# a dataset's key includes the mtimes of its files so that it is reloaded if
+# one of them changes
+def get_file_key(*fps):
+    return tuple((fp, os.path.getmtime(fp)) for fp in fps)
+
+# LRU cache of loaded datasets (or results). loads of the same key are done
+# once, other threads asking for it wait for that load
+class LRUCache:
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.key_locks = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, load):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            key_lock = self.key_locks.setdefault(key, threading.Lock())
+
+        with key_lock:
+            with self.lock:
+                if key in self.entries:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return self.entries[key]
+
+            # the key's lock is dropped even if the load fails, threads
+            # already waiting on it then try the load themselves
+            try:
+                value = load()
+
+                with self.lock:
+                    self.misses += 1
+                    self.entries[key] = value
+                    while len(self.entries) > self.max_entries:
+                        self.entries.popitem(last=False)
+            finally:
+                with self.lock:
+                    self.key_locks.pop(key, None)
+
+        return value
+
+    def stats(self):
+        with self.lock:
+            return {"entries": len(self.entries), "max_entries": self.max_entries,
+                    "hits": self.hits, "misses": self.misses}
+
+# the corpus encoded against mesh (converted to the bigram set for bigram
+# corpora), ready for run_eval_trials
+class TrialData:
+    __slots__ = ("eval_mesh", "vocab", "corpus_ids", "mesh_flags")
+
+    def __init__(self, corpus_fp, mesh_fp):
+        corpus = load_list(corpus_fp)
+        mesh = load_mesh(mesh_fp)
+
+        if is_bigram_corpus(corpus):
+            mesh = get_bigram_set(mesh)
+
+        self.eval_mesh = mesh
+        (self.vocab, self.corpus_ids) = encode_trial_data(corpus, mesh)
+        self.mesh_flags = self.vocab.mesh_flags()
+
+class EvalService:
+    def __init__(self, max_datasets=8, max_results=256):
+        self.datasets = LRUCache(max_datasets)
+        self.results = LRUCache(max_results)
+
+    def get_dataset(self, key, load):
+        return self.datasets.get(key, load)
+
+    def evaluate(self, corpus, mesh, result=None, keywords=None, trials=100000, seed=None):
+        data = self.get_dataset(("trial_data",) + get_file_key(corpus, mesh),
+                lambda: TrialData(corpus, mesh))
+
+        method_result = keywords if keywords is not None else load_list(result)
+
+        method_intersect_len = check_intersection(method_result, data.eval_mesh)
+        random_intersect_results = run_eval_trials(data.corpus_ids, data.mesh_flags,
+                len(method_result), trials, seed)
+
+        return {"p": float(compute_p_val(method_intersect_len, random_intersect_results)),
+                "method_intersect_len": method_intersect_len,
+                "result_len": len(method_result),
+                "random_mean": sum(random_intersect_results) / len(random_intersect_results),
+                "random_max": max(random_intersect_results)}
+
+    def informative_terms(self, threshold, desc="data/desc2020",
+            counts="data/pm_doc_term_counts.csv", matrix="data/pm_doc_term_counts.npz",
+            articles="data/specialized_3yrs_solutions_uids.tsv"):
+        descriptors = self.get_dataset(("descriptors",) + get_file_key(desc),
+                lambda: get_descriptor_store(desc))
+        term_freqs = self.get_dataset(("term_freqs",) + get_file_key(desc, counts),
+                lambda: get_doc_term_matrix(counts, matrix, descriptors.keys())
+                        .term_freqs(descriptors.keys()))
+        target_subset = self.get_dataset(("specialized",) + get_file_key(articles),
+                lambda: load_specialized_term_set(articles))
+
+        informative_terms = get_informative_terms(term_freqs, descriptors, threshold)
+        terms_out = [term for term in informative_terms if term in target_subset]
+
+        return {"num_informative": len(informative_terms), "uids": terms_out,
+                "names": [descriptors.name(term) for term in terms_out]}
+
+    def component_rmsd(self, edge_list, mesh="data/mesh_edge_list", lem="data/lem_mesh_map",
+            desc="data/desc2020", mesh_cache="data/mesh_dist_cache", approximate=False,
+            exact_max_terms=200, rmsd_samples=5000, seed=0, confidence=0.95,
+            result_cache=None):
+        mesh_side = self.get_dataset(("mesh_side", mesh_cache) + get_file_key(desc, lem, mesh),
+                lambda: load_mesh_side(desc, lem, mesh, mesh_cache))
+        adj_list = self.get_dataset(("hierarchy",) + get_file_key(edge_list),
+                lambda: load_from_edge_list(edge_list))
+
+        [(total, component_results)] = compare_hierarchies([adj_list], mesh_side,
+                exact_max_terms if approximate else None, rmsd_samples, seed, confidence,
+                result_cache)
+        (mean_rmsd, num_approximated, num_reported) = summarize_results(component_results)
+
+        return {"num_components": total, "num_mesh_components": len(component_results),
+                "num_approximated": num_approximated, "num_reported": num_reported,
+                "mean_rmsd": mean_rmsd,
+                "rmsds": [res["rmsd"] for res in component_results]}
+
+    def stats(self):
+        return {"datasets": self.datasets.stats(), "results": self.results.stats(),
+                "metrics": get_metrics().summary()}
+
+    # unseeded evaluations are random, everything else is deterministic
+    # given its parameters and files, so the whole result is cached
+    def handle(self, request):
+        request = dict(request)
+        op = request.pop("op", None)
+
+        if op == "ping":
+            return "pong"
+        if op == "stats":
+            return self.stats()
+
+        handlers = {"evaluate": self.evaluate, "informative_terms": self.informative_terms,
+                "component_rmsd": self.component_rmsd}
+        if op not in handlers:
+            raise Exception(f"Unknown op: {op}")
+
+        metrics = get_metrics()
+        metrics.count(f"{op}_requests")
+
+        with metrics.stage(op):
+            if op == "evaluate" and request.get("seed") is None:
+                return handlers[op](**request)
+
+            # the defaults are filled in so that the files a request uses
+            # without naming them are part of the key too
+            bound = inspect.signature(handlers[op]).bind(**request)
+            bound.apply_defaults()
+            request = bound.arguments
+
+            fps = [val for val in request.values() if isinstance(val, str) and os.path.isfile(val)]
+            key = (op, json.dumps(request, sort_keys=True)) + get_file_key(*fps)
+
+            return self.results.get(key, lambda: handlers[op](**request))
+
+class EvalServer:
+    def __init__(self, socket_path, service, threads=4):
+        self.socket_path = socket_path
+        self.service = service
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+        self.stop_event = None
+
+    async def handle_client(self, reader, writer):
+        logger = logging.getLogger(__name__)
+        loop = asyncio.get_running_loop()
+
+        try:
+            stopping = False
+            while not stopping:
+                line = await reader.readline()
+                if not line:
+                    break
+
+                try:
+                    request = json.loads(line)
+                    if request.get("op") == "shutdown":
+                        response = {"ok": True, "result": "shutting down"}
+                        stopping = True
+                    else:
+                        result = await loop.run_in_executor(self.executor, self.service.handle,
+                                request)
+                        response = {"ok": True, "result": result}
+                except Exception as e:
+                    logger.exception("Request failed")
+                    response = {"ok": False, "error": str(e)}
+
+                writer.write((json.dumps(response) + "\n").encode())
+                await writer.drain()
+        except asyncio.CancelledError:
+            # the server is stopping while this client is idle
+            pass
+        finally:
+            writer.close()
+
+        if stopping:
+            self.stop_event.set()
+
+    async def serve(self):
+        logger = logging.getLogger(__name__)
+
+        self.stop_event = asyncio.Event()
+
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+        server = await asyncio.start_unix_server(self.handle_client, path=self.socket_path)
+        logger.info(f"Listening on {self.socket_path}")
+
+        async with server:
+            await self.stop_event.wait()
+
+        self.executor.shutdown(wait=False)
+        os.remove(self.socket_path)
+        logger.info("Server stopped")
+
+# blocking client, keeps one connection open for all of its requests
+class EvalClient:
+    def __init__(self, socket_path=DEFAULT_SOCKET, timeout=None):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        self.sock.connect(socket_path)
+        self.handle = self.sock.makefile("rwb")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.handle.close()
+        self.sock.close()
+
+    def request(self, op, **params):
+        params["op"] = op
+        self.handle.write((json.dumps(params) + "\n").encode())
+        self.handle.flush()
+
+        response = json.loads(self.handle.readline())
+        if not response["ok"]:
+            raise Exception(f"eval server error: {response['error']}")
+
+        return response["result"]
+
+    def ping(self):
+        return self.request("ping")
+
+    def stats(self):
+        return self.request("stats")
+
+    def shutdown(self):
+        return self.request("shutdown")
+
+    def evaluate(self, corpus, mesh, result=None, keywords=None, trials=100000, seed=None):
+        return self.request("evaluate", corpus=corpus, mesh=mesh, result=result,
+                keywords=keywords, trials=trials, seed=seed)
+
+    def informative_terms(self, threshold, **paths):
+        return self.request("informative_terms", threshold=threshold, **paths)
+
+    def component_rmsd(self, edge_list, **params):
+        return self.request("component_rmsd", edge_list=edge_list, **params)
+
+def initialize_logger(debug=False, quiet=False):
+    level = logging.INFO
+    if debug:
+        level = logging.DEBUG
+
+    # Set up logging
+    logger = logging.getLogger(__name__)
+    logger.setLevel(level)
+    handler = logging.FileHandler("eval_server.log")
+    formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    handler.setFormatter(formatter)
+    logger.addHandler(handler)
+
+    if not quiet:
+        handler = logging.StreamHandler(sys.stdout)
+        handler.setLevel(level)
+        formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+        handler.setFormatter(formatter)
+        logger.addHandler(handler)
+
+    return logger
+
+def get_args():
+    logger = logging.getLogger(__name__)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-s", "--socket", help=f"Unix socket path, default={DEFAULT_SOCKET}",
+            default=DEFAULT_SOCKET)
+    parser.add_argument("-d", "--max-datasets", help="Number of loaded datasets kept in memory, "
+            "default=8", type=int, default=8)
+    parser.add_argument("-r", "--max-results", help="Number of cached query results, "
+            "default=256", type=int, default=256)
+    parser.add_argument("-t", "--threads", help="Number of requests computed at once, "
+            "default=4", type=int, default=4)
+    add_metrics_args(parser, "eval_server")
+
+    args = parser.parse_args()
+
+    logger.info("###############################")
+    logger.info(f"Socket: {args.socket}")
+    logger.info(f"Max datasets: {args.max_datasets}")
+
+    return args
+
+if __name__ == "__main__":
+    logger = initialize_logger()
+    args = get_args()
+    metrics = start_metrics("eval_server", args.profile)
+
+    service = EvalService(args.max_datasets, args.max_results)
+    asyncio.run(EvalServer(args.socket, service, args.threads).serve())
+
+    # written once the server has been shut down
+    metrics.finish(args.metrics, logger)
@@ -1,28 +1,75 @@
 #!/usr/bin/env python3
+import os
 import sys
 import math
 import logging
 import argparse
-from random import choice
+from random import choice, Random
 from itertools import permutations
+from multiprocessing import Pool, get_context, get_all_start_methods
 
-from scipy.stats import normaltest
-from scipy.special import ndtr
+import numpy as np
+from numpy.random import SeedSequence
+
+from term_vocab import TermVocabulary
+from instrumentation import get_metrics, start_metrics, add_metrics_args
+
+# number of trials in each independently seeded chunk. this is fixed (and
+# not derived from the number of workers) so that a seeded evaluation gives
+# the same trials regardless of how the chunks are distributed
+TRIAL_CHUNK_SIZE = 10000
+
+# scipy is only imported by the code paths that need it (the normality check,
+# which is only logged), importing scipy.stats takes over a second and tens
+# of MB in every process that loads this module, pool workers included
+
+# modules imported once by the forkserver, workers forked from it start with
+# them loaded
+WORKER_PRELOAD = ["evaluate"]
+
+# the forkserver is a new python started by the first pool, it doesn't get
+# our sys.path and skips preload modules it can't import, so this directory
+# goes on the PYTHONPATH it inherits. this is done once on import rather than
+# around each pool, other threads may be starting subprocesses at any time
+def _add_module_dir_to_python_path():
+    module_dir = os.path.dirname(os.path.abspath(__file__))
+    paths = [it for it in os.environ.get("PYTHONPATH", "").split(os.pathsep) if it]
+
+    if module_dir not in paths:
+        os.environ["PYTHONPATH"] = os.pathsep.join([module_dir] + paths)
+
+_add_module_dir_to_python_path()
 
 
 def check_intersection(elements, mesh):
+    get_metrics().count("set_lookups", len(elements))
     return len({el for el in elements if el in mesh})
 
-def get_random_elements(corpus, number):
+# element_ids must be distinct, mesh_flags is TermVocabulary.mesh_flags()
+def check_id_intersection(element_ids, mesh_flags):
+    return sum([mesh_flags[el] for el in element_ids])
+
+# interns the corpus (and any extra terms, e.g. the method results) and marks
+# which IDs are in mesh. returns the vocabulary and the encoded corpus
+def encode_trial_data(corpus, mesh, extra_terms=()):
+    vocab = TermVocabulary(corpus)
+    vocab.add_all(extra_terms)
+    vocab.mark_mesh(mesh)
+
+    return (vocab, vocab.encode(corpus))
+
+def get_random_elements(corpus, number, rng=None):
     if len(corpus) < number:
         raise Exception("Corpus is smaller than required number of elements for evaluation")
 
+    pick = choice if rng is None else rng.choice
+
     elements = set()
 
     # add a random keyword until there are the required number
     # keywords is a set so there will be no duplicates
     while len(elements) < number:
-        elements.add(choice(corpus))
+        elements.add(pick(corpus))
 
     return elements
 
@@ -50,28 +97,135 @@ def get_bigram_set(mesh):
 # NOTE: currently this is just going to assume keywords/bigrams based 
 # on the split length
 def run_trials(corpus, mesh, num_elements, num_trials):
-    logger = logging.getLogger(__name__)
+    (vocab, corpus_ids) = encode_trial_data(corpus, mesh)
+    
+    return run_encoded_trials(corpus_ids, vocab.mesh_flags(), num_elements, num_trials)
 
+# trials over the interned corpus, each random element is an int ID and 
+# membership is a single index into mesh_flags
+def run_encoded_trials(corpus_ids, mesh_flags, num_elements, num_trials, rng=None):
     random_intersect_results = []
     
     for _ in range(num_trials):
-        elements = get_random_elements(corpus, num_elements)
-        random_intersect_results.append(check_intersection(elements, mesh))
+        elements = get_random_elements(corpus_ids, num_elements, rng)
+        random_intersect_results.append(check_id_intersection(elements, mesh_flags))
     
     return random_intersect_results
+
+# splits num_trials into fixed size chunks, each with its own child seed
+# spawned from seed. the chunking only depends on num_trials so chunk i
+# always sees the same random stream
+def get_trial_chunks(seed, num_trials, chunk_size=TRIAL_CHUNK_SIZE):
+    num_chunks = math.ceil(num_trials / chunk_size)
+    child_seeds = SeedSequence(seed).spawn(num_chunks)
+
+    chunks = []
+    for idx, child_seed in enumerate(child_seeds):
+        chunk_trials = min(chunk_size, num_trials - idx * chunk_size)
+        chunks.append((child_seed, chunk_trials))
+
+    return chunks
+
+def get_chunk_rng(child_seed):
+    return Random(child_seed.generate_state(4).tobytes())
+
+def run_trial_chunk(corpus_ids, mesh_flags, num_elements, num_trials, child_seed):
+    return run_encoded_trials(corpus_ids, mesh_flags, num_elements, num_trials, 
+            get_chunk_rng(child_seed))
+
+# the encoded corpus and mesh flags are sent to each worker once through the
+# pool initializer rather than with every chunk
+_worker_data = {}
+
+def init_trial_worker(corpus_ids, mesh_flags):
+    _worker_data["corpus_ids"] = corpus_ids
+    _worker_data["mesh_flags"] = mesh_flags
+
+# a pool whose workers are forked from a forkserver that has already imported
+# WORKER_PRELOAD. unlike fork, workers don't inherit (and duplicate) whatever
+# the parent has built up, unlike spawn they don't import anything again.
+# falls back to the default start method where there is no forkserver
+def get_worker_pool(processes, initializer=None, initargs=()):
+    if "forkserver" not in get_all_start_methods():
+        return Pool(processes, initializer, initargs)
+
+    ctx = get_context("forkserver")
+    ctx.set_forkserver_preload(WORKER_PRELOAD)
+
+    return ctx.Pool(processes, initializer, initargs)
+
+def _run_worker_chunk(num_elements, num_trials, child_seed):
+    return run_trial_chunk(_worker_data["corpus_ids"], _worker_data["mesh_flags"], 
+            num_elements, num_trials, child_seed)
+
+def _run_pool_chunks(pool, num_elements, chunks):
+    random_intersect_results = []
+
+    futures = [pool.apply_async(_run_worker_chunk, (num_elements, chunk_trials, child_seed))
+            for (child_seed, chunk_trials) in chunks]
+    for res in futures:
+        random_intersect_results.extend(res.get())
+
+    return random_intersect_results
+
+# seeded version of run_encoded_trials. results are identical for a given seed 
+# whatever the number of workers, chunks are always gathered in order. pool,
+# if given, is a pool already initialized with init_trial_worker for this
+# corpus_ids and mesh_flags, and is used instead of starting one
+def run_seeded_trials(corpus_ids, mesh_flags, num_elements, num_trials, seed, workers=1,
+        pool=None):
+    chunks = get_trial_chunks(seed, num_trials)
+
+    if pool is not None:
+        return _run_pool_chunks(pool, num_elements, chunks)
+
+    random_intersect_results = []
+
+    if workers > 1 and len(chunks) > 1:
+        with get_worker_pool(min(workers, len(chunks)), init_trial_worker,
+                (corpus_ids, mesh_flags)) as pool:
+            random_intersect_results = _run_pool_chunks(pool, num_elements, chunks)
+    else:
+        for (child_seed, chunk_trials) in chunks:
+            random_intersect_results.extend(run_trial_chunk(corpus_ids, mesh_flags, 
+                num_elements, chunk_trials, child_seed))
+
+    return random_intersect_results
     
-def compute_p_val(method_intersect_len, random_intersect_results):
+# mean and standard deviation of the random intersect lengths, the null
+# distribution the method results are scored against
+def get_null_stats(random_intersect_results):
     logger = logging.getLogger(__name__)
 
-    # check for normality of random_intersect_results
-    k2, p = normaltest(random_intersect_results)
-    logger.info(f"normaltest p-val: {p}")
+    # check for normality of random_intersect_results. it is only logged, so
+    # it is skipped where nothing would be logged (e.g. in pool workers)
+    if logger.isEnabledFor(logging.INFO):
+        from scipy.stats import normaltest
+        k2, p = normaltest(random_intersect_results)
+        logger.info(f"normaltest p-val: {p}")
    
     x_bar = sum(random_intersect_results) / len(random_intersect_results)
     
     numer = sum([(x - x_bar) ** 2 for x in random_intersect_results])
     std_dev = math.sqrt(numer / (len(random_intersect_results) - 1))
-    
+
+    return (x_bar, std_dev)
+
+# standard normal CDF, computed the way scipy.special.ndtr does so that
+# scipy isn't needed for the p-values
+def ndtr(z):
+    x = z * math.sqrt(0.5)
+    if abs(x) < math.sqrt(0.5):
+        return 0.5 + 0.5 * math.erf(x)
+
+    y = 0.5 * math.erfc(abs(x))
+    return 1 - y if x > 0 else y
+
+# method_intersect_len may be an array, the p-values then are too
+def get_p_val(method_intersect_len, x_bar, std_dev):
+    if isinstance(method_intersect_len, np.ndarray):
+        return np.array([get_p_val(val, x_bar, std_dev) for val in method_intersect_len.tolist()])
+
     if std_dev > 0:
         z = (method_intersect_len - x_bar) / std_dev
     else:
@@ -79,10 +233,16 @@ def compute_p_val(method_intersect_len, random_intersect_results):
 
     return 1 - ndtr(z)
 
+def compute_p_val(method_intersect_len, random_intersect_results):
+    (x_bar, std_dev) = get_null_stats(random_intersect_results)
+
+    return get_p_val(method_intersect_len, x_bar, std_dev)
+
 def load_mesh(mesh_fp):
     with open(mesh_fp, encoding="ISO-8859-1", mode="r") as handle:
         mesh = [line.strip("\n") for line in handle]
-    
+
+    get_metrics().count("rows_parsed", len(mesh))
     # mesh should be a set because later there are millions of checks to see
     # if an element is in the data structure
     return set(mesh)
@@ -95,7 +255,8 @@ def load_list(fp):
             line = line.strip("\n")
             if line:
                 items.append(line)
-    
+
+    get_metrics().count("rows_parsed", len(items))
     return items
 
 def initialize_logger(debug=False, quiet=False):
@@ -125,11 +286,20 @@ def get_args():
 
     parser = argparse.ArgumentParser()
     parser.add_argument("-c", "--corpus", help="Path to input corpus file", required=True)
-    parser.add_argument("-r", "--result", help="Path to results from our method", required=True)
+    parser.add_argument("-r", "--result", help="Path to results from our method. with several, "
+            "all of them are scored together and the table is written to --output", nargs="+",
+            required=True)
     parser.add_argument("-m", "--mesh", help="Path to lemmatized MeSH file", required=True)
     parser.add_argument("-t", "--trials", help="Number of random trials to run, default=100000",
             type=int, default=100000)
-    
+    parser.add_argument("-s", "--seed", help="Seed for the random trials, results are reproducible "
+            "for a given seed regardless of the number of workers", type=int, default=None)
+    parser.add_argument("-w", "--workers", help="Number of worker processes for the random trials, "
+            "requires --seed, default=1", type=int, default=1)
+    parser.add_argument("-o", "--output", help="Path of the results table when several results "
+            "are given, default=eval_results", default="eval_results")
+    add_metrics_args(parser, "eval")
+
     args = parser.parse_args()
    
     # log delimiter
@@ -138,28 +308,62 @@ def get_args():
     logger.info(f"Method results: {args.result}")
     logger.info(f"MeSH file: {args.mesh}")
     logger.info(f"Num. trials: {args.trials}")
+    logger.info(f"Seed: {args.seed}")
+    logger.info(f"Workers: {args.workers}")
+
+    if args.workers > 1 and args.seed is None:
+        parser.error("--workers requires --seed")
+
+    return args
 
-    return parser.parse_args()
+# bigram corpora are detected from the split length of the first entry
+def is_bigram_corpus(corpus):
+    return len(corpus[0].split()) == 2
+
+def run_eval_trials(corpus_ids, mesh_flags, num_elements, n_trials, seed=None, workers=1,
+        pool=None):
+    metrics = get_metrics()
+    metrics.count("trials", n_trials)
+    metrics.count("set_lookups", n_trials * num_elements)
+
+    if seed is None:
+        return run_encoded_trials(corpus_ids, mesh_flags, num_elements, n_trials)
+
+    return run_seeded_trials(corpus_ids, mesh_flags, num_elements, n_trials, seed, workers,
+            pool)
 
 # thresh is just for the experiment!!!
-def evaluate(corpus, method_result, mesh, n_trials, thresh, verbose=True):
+#
+# if seed is given the trials are drawn from independent seeded streams and
+# can be split over worker processes, otherwise the global random state is used
+def evaluate(corpus, method_result, mesh, n_trials, thresh, verbose=True, seed=None, workers=1):
     if verbose:
         logger = logging.getLogger(__name__)
     
     # bigram detection
-    if len(corpus[0].split()) == 2:
+    if is_bigram_corpus(corpus):
         if verbose:
             logger.info("Bigrams detected")
         mesh = get_bigram_set(mesh)
     
+    metrics = get_metrics()
+
+    # intern everything once, after this no strings are hashed
+    with metrics.stage("encode"):
+        (vocab, corpus_ids) = encode_trial_data(corpus, mesh, method_result)
+        mesh_flags = vocab.mesh_flags()
+
     # get result metric for our method
-    method_intersect_len = check_intersection(method_result, mesh)
+    method_intersect_len = vocab.count_mesh(vocab.encode(method_result))
     
     # run trials
-    random_intersect_results = run_trials(corpus, mesh, len(method_result), n_trials)
+    with metrics.stage("trials"):
+        random_intersect_results = run_eval_trials(corpus_ids, mesh_flags, len(method_result), 
+                n_trials, seed, workers)
     random_mean = sum(random_intersect_results) / len(random_intersect_results)
 
-    p = compute_p_val(method_intersect_len, random_intersect_results)
+    with metrics.stage("p_val"):
+        p = compute_p_val(method_intersect_len, random_intersect_results)
 
     if verbose:
         logger.info(f"Method intersect length: {method_intersect_len}")
@@ -169,14 +373,120 @@ def evaluate(corpus, method_result, mesh, n_trials, thresh, verbose=True):
 
     return (thresh, p, method_intersect_len, len(method_result), random_mean, max(random_intersect_results))
 
+# interns the corpus once for evaluating many results against the same mesh
+# in a pool (see init_trial_worker and evaluate_in_worker). returns the mesh
+# used, the bigram version of it for a bigram corpus, the encoded corpus and
+# the mesh flags
+def prepare_eval_data(corpus, mesh):
+    if is_bigram_corpus(corpus):
+        mesh = get_bigram_set(mesh)
+
+    (vocab, corpus_ids) = encode_trial_data(corpus, mesh)
+
+    return (mesh, corpus_ids, vocab.mesh_flags())
+
+# evaluate in a pool worker set up with init_trial_worker. only the numbers
+# are sent per task, the caller counts the method intersect length (with
+# check_intersection against the mesh from prepare_eval_data)
+def evaluate_in_worker(method_intersect_len, num_elements, n_trials, thresh, seed=None):
+    random_intersect_results = run_eval_trials(_worker_data["corpus_ids"], 
+            _worker_data["mesh_flags"], num_elements, n_trials, seed)
+    random_mean = sum(random_intersect_results) / len(random_intersect_results)
+
+    p = compute_p_val(method_intersect_len, random_intersect_results)
+
+    return (thresh, p, method_intersect_len, num_elements, random_mean, max(random_intersect_results))
+
+# scores many method results against one corpus and mesh. results of the same
+# size share one null distribution, so the trials are run once per distinct
+# size rather than once per result, and the intersections of all the results
+# are counted in one vectorized pass. method_results maps a name to each
+# result, one row per result is returned in the same order, laid out like
+# evaluate's with the name in place of thresh. with a seed, every size uses
+# it, so each row is the same as evaluate with that seed would give
+def evaluate_many(corpus, method_results, mesh, n_trials, seed=None, workers=1):
+    logger = logging.getLogger(__name__)
+    metrics = get_metrics()
+
+    if is_bigram_corpus(corpus):
+        logger.info("Bigrams detected")
+        mesh = get_bigram_set(mesh)
+
+    names = list(method_results.keys())
+
+    with metrics.stage("encode"):
+        vocab = TermVocabulary(corpus)
+        corpus_ids = vocab.encode(corpus)
+        encoded_results = [vocab.encode(method_results[name], add=True) for name in names]
+        vocab.mark_mesh(mesh)
+        mesh_flags = vocab.mesh_flags()
+
+    with metrics.stage("intersect"):
+        intersect_lens = vocab.count_mesh_many(encoded_results)
+
+    # result indices by size
+    sizes = {}
+    for idx, name in enumerate(names):
+        sizes.setdefault(len(method_results[name]), []).append(idx)
+
+    logger.info(f"{len(names)} results of {len(sizes)} distinct sizes")
+
+    # one pool for all of the sizes, so the workers are started and sent the
+    # corpus once
+    pool = None
+    num_chunks = math.ceil(n_trials / TRIAL_CHUNK_SIZE)
+    if seed is not None and workers > 1 and num_chunks > 1:
+        pool = get_worker_pool(min(workers, num_chunks), init_trial_worker,
+                (corpus_ids, mesh_flags))
+
+    rows = [None] * len(names)
+    try:
+        for size, idxs in sorted(sizes.items()):
+            with metrics.stage("trials"):
+                random_intersect_results = run_eval_trials(corpus_ids, mesh_flags, size,
+                        n_trials, seed, workers, pool)
+
+            with metrics.stage("p_val"):
+                (x_bar, std_dev) = get_null_stats(random_intersect_results)
+                p_vals = get_p_val(intersect_lens[idxs], x_bar, std_dev)
+
+            random_max = max(random_intersect_results)
+            for idx, p in zip(idxs, p_vals.tolist()):
+                rows[idx] = (names[idx], p, int(intersect_lens[idx]), size, x_bar, random_max)
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+    return rows
+
+def write_many_results(rows, fp):
+    with open(fp, "w") as out:
+        out.write("result\tpval\tresult_intersect_len\tresult_len\trand_inter_mean_len\trand_inter_max\n")
+        for row in rows:
+            out.write(f"{row[0]}\t{row[1]}\t{row[2]}\t{row[3]}\t{row[4]}\t{row[5]}\n")
+
 if __name__ == "__main__":
     logger = initialize_logger()
 
     args = get_args()
+    metrics = start_metrics("evaluate", args.profile)
+    metrics.track_rate("trials", "trials")
 
     # load in things
-    corpus = load_list(args.corpus)
-    method_results = load_list(args.result)
-    mesh = load_mesh(args.mesh)
+    with metrics.stage("load"):
+        corpus = load_list(args.corpus)
+        method_results = {fp: load_list(fp) for fp in args.result}
+        mesh = load_mesh(args.mesh)
     
-    _ = evaluate(corpus, method_result, mesh, args.trials)
+    if len(method_results) == 1:
+        _ = evaluate(corpus, method_results[args.result[0]], mesh, args.trials, None, 
+                seed=args.seed, workers=args.workers)
+    else:
+        rows = evaluate_many(corpus, method_results, mesh, args.trials, seed=args.seed, 
+                workers=args.workers)
+        for row in rows:
+            logger.info(f"{row[0]}: p {row[1]}, intersect {row[2]} of {row[3]}, "
+                    f"random mean {row[4]}, max {row[5]}")
+        write_many_results(rows, args.output)
+
+    metrics.finish(args.metrics, logger)
@@ -3,7 +3,11 @@ import sys
 import logging
 import argparse
 
-from parse_mesh import parse_mesh
+from doc_term_matrix import get_doc_term_matrix
+from descriptor_store import get_descriptor_store
+from mesh_distance_cache import hash_file
+from term_freq_store import TermFreqStore
+from instrumentation import get_metrics, start_metrics, add_metrics_args
 
 def get_children(uid, term_trees):
     ''' Gets a list of children for a term. Because there isn't actually a graph
@@ -38,25 +42,87 @@ def get_children(uid, term_trees):
     
     return out
 
-def get_informative_terms(term_freqs, term_trees, cutoff):
+# descriptors is a DescriptorStore, children come from its precomputed
+# child lists rather than a scan of every position
+def get_informative_terms(term_freqs, descriptors, cutoff):
     informative_terms = []
     
     candidate_terms = [uid for uid, freq in term_freqs.items() if freq > cutoff]
+    get_metrics().count("children_lookups", len(candidate_terms))
 
     for uid in candidate_terms:
-        children = get_children(uid, term_trees)
-        
-        all_children_below_cutoff = len([c for c in children if term_freqs[c] < cutoff]) == 0
-        if len(children) > 0 and all_children_below_cutoff:
+        if is_informative_term(uid, term_freqs, descriptors, cutoff):
             informative_terms.append(uid)
 
     return informative_terms
 
+# a term is informative if it is above the cutoff and has children, none of
+# which are below it
+def is_informative_term(uid, term_freqs, descriptors, cutoff):
+    if term_freqs.get(uid, 0) <= cutoff:
+        return False
+
+    children = descriptors.children(uid)
+        
+    all_children_below_cutoff = len([c for c in children if term_freqs[c] < cutoff]) == 0
+    return len(children) > 0 and all_children_below_cutoff
+
+# a term's status only depends on its own frequency and its children's, so
+# when only some frequencies changed only those UIDs and their parents are
+# looked at again. the stored result is recomputed in full if the cutoff or
+# the descriptor file changed. returns the informative terms in descriptor
+# order, the order get_informative_terms gives
+def update_informative_terms(freq_store, descriptors, cutoff, desc_fp):
+    logger = logging.getLogger(__name__)
+
+    term_freqs = freq_store.term_freqs(descriptors.keys())
+    # the descriptor file's sha256, as the descriptor store is keyed on
+    source = descriptors.source if descriptors.source is not None else hash_file(desc_fp)
+    key = f"{cutoff}:{source}"
+
+    if freq_store.get_meta("informative_key") != key:
+        logger.info("No stored informative terms for this cutoff and descriptor file, "
+                "computing all of them")
+        informative = set(get_informative_terms(term_freqs, descriptors, cutoff))
+        freq_store.set_informative(key, informative, replace=True)
+    else:
+        changed = freq_store.get_changed_uids()
+        candidates = set(changed)
+        for uid in changed:
+            if uid in descriptors:
+                candidates.update(descriptors.parents(uid))
+
+        get_metrics().count("children_lookups", len(candidates))
+        logger.info(f"{len(changed)} frequencies changed, rechecking {len(candidates)} terms")
+
+        added = [uid for uid in candidates if is_informative_term(uid, term_freqs, descriptors, 
+                cutoff)]
+        removed = candidates.difference(added)
+        freq_store.set_informative(key, added, removed)
+        informative = freq_store.get_informative()
+
+    return [uid for uid in descriptors if uid in informative]
+
+# positions on the graph for each UID, and the UID at each position
+def get_term_trees(desc_data):
+    term_trees = {}
+    term_trees_rev = {}
+
+    for uid in desc_data:
+        term_trees[uid] = desc_data[uid]["graph_positions"].split("|")
+        
+        for graph_position in desc_data[uid]["graph_positions"].split("|"):
+            term_trees_rev[graph_position] = uid
+
+    return (term_trees, term_trees_rev)
+
 def load_term_freqs(desc_uids, counts_fp):
     term_freqs = {uid: 0 for uid in desc_uids}
+    num_rows = 0
 
     with open(counts_fp, "r") as handle:
         for line in handle:
+            num_rows += 1
             line = line.strip("\n").split(",")[1:]
             
             for uid in line:
@@ -65,6 +131,8 @@ def load_term_freqs(desc_uids, counts_fp):
                 else:
                     term_freqs[uid] = 1
 
+    get_metrics().count("rows_parsed", num_rows)
+
     return term_freqs
 
 def load_specialized_term_set(fp):
@@ -77,10 +145,10 @@ def load_specialized_term_set(fp):
 
     return set(terms)
 
-def write_output(terms_out, out_fp, desc_data):
+def write_output(terms_out, out_fp, descriptors):
     with open(out_fp, "w") as out:
         for term in terms_out:
-            out.write(f"{desc_data[term]['name']}\n")
+            out.write(f"{descriptors.name(term)}\n")
 
 def initialize_logger(debug=False, quiet=False):
     level = logging.INFO
@@ -110,42 +178,74 @@ def get_args():
     parser = argparse.ArgumentParser()
     parser.add_argument("-m", "--mesh", help="Path to MeSH descriptor file", 
             default="data/desc2020")
+    parser.add_argument("-d", "--desc-store", help="Directory for the columnar descriptor "
+            "stores, one per descriptor file by its sha256", default="data/desc2020_store")
     parser.add_argument("-c", "--counts", help="Path to term counts csv", 
             default="data/pm_doc_term_counts.csv")
+    parser.add_argument("-x", "--matrix", help="Path to the doc-term matrix .npz built from the "
+            "term counts, rebuilt when the counts file changes",
+            default="data/pm_doc_term_counts.npz")
+    parser.add_argument("-s", "--freq-store", help="SQLite frequency store to keep term "
+            "frequencies and informative terms in, updated incrementally instead of counting "
+            "the counts file on every run. loaded from the counts file the first time", 
+            default=None)
+    parser.add_argument("-u", "--update", help="With --freq-store, document rows files "
+            "(same format as the counts file) to add, rows of known PMIDs replace them", 
+            nargs="+", default=[])
+    parser.add_argument("--deleted", help="With --freq-store, files of PMIDs (one per line) "
+            "to remove", nargs="+", default=[])
     parser.add_argument("-a", "--articles", help="Path to term counts for articles subset",
             default="data/specialized_3yrs_solutions_uids.tsv")
     parser.add_argument("-o", "--output", help="Output file path",
             default="data/seed_topics")
     parser.add_argument("-t", "--threshold", help="Cutoff value", type=int, required=True)
+    add_metrics_args(parser, "get_informative_terms")
     args = parser.parse_args()
 
     logger.info("###############################")
     logger.info(f"MeSH descriptor: {args.mesh}")
     logger.info(f"Term counts file: {args.counts}")
+    logger.info(f"Doc-term matrix: {args.matrix}")
+    logger.info(f"Frequency store: {args.freq_store}")
     logger.info(f"Articles subset: {args.articles}")
     logger.info(f"Cutoff value: {args.threshold}")
 
+    if (args.update or args.deleted) and args.freq_store is None:
+        parser.error("--update and --deleted require --freq-store")
+
     return args
 
 if __name__ == "__main__":
     logger = initialize_logger()
 
     args = get_args()
+    metrics = start_metrics("get_informative_terms", args.profile)
+    metrics.track_rate("children_lookups", "informative_terms")
 
-    desc_data, desc_uids = parse_mesh(args.mesh)
+    with metrics.stage("descriptors"):
+        descriptors = get_descriptor_store(args.mesh, args.desc_store)
+        desc_uids = descriptors.keys()
 
-    term_trees = {}
-    term_trees_rev = {}
+    if args.freq_store is None:
+        with metrics.stage("term_freqs"):
+            dtm = get_doc_term_matrix(args.counts, args.matrix, desc_uids)
+            term_freqs = dtm.term_freqs(desc_uids)
 
-    for uid in desc_data:
-        term_trees[uid] = desc_data[uid]["graph_positions"].split("|")
-        
-        for graph_position in desc_data[uid]["graph_positions"].split("|"):
-            term_trees_rev[graph_position] = uid
-            
-    term_freqs = load_term_freqs(desc_uids, args.counts)
+        with metrics.stage("informative_terms"):
+            informative_terms = get_informative_terms(term_freqs, descriptors, args.threshold)
+    else:
+        with TermFreqStore(args.freq_store) as freq_store:
+            with metrics.stage("ingest"):
+                if freq_store.num_docs() == 0:
+                    freq_store.ingest(args.counts)
+                for fp in args.update:
+                    freq_store.ingest(fp)
+                for fp in args.deleted:
+                    freq_store.delete(fp)
 
-    informative_terms = get_informative_terms(term_freqs, term_trees, args.threshold)
+            with metrics.stage("informative_terms"):
+                informative_terms = update_informative_terms(freq_store, descriptors, 
+                        args.threshold, args.mesh)
     
     logger.info(f"Found {len(informative_terms)} informative terms")
 
@@ -154,4 +254,6 @@ if __name__ == "__main__":
     terms_out = [term for term in informative_terms if term in target_subset]
     logger.info(f"{len(terms_out)} informative terms are in the subset")
 
-    write_output(terms_out, args.output, desc_data)
+    write_output(terms_out, args.output, descriptors)
+
+    metrics.finish(args.metrics, logger)
@@ -0,0 +1,190 @@
+import os
+import sys
+import json
+import time
+import pstats
+import cProfile
+import threading
+import tracemalloc
+from time import perf_counter
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Run metrics shared by the scripts: wall time per stage, peak RSS, and
+# counters (trials run, BFS nodes expanded, set lookups, rows parsed, ...).
+# There is one Metrics per process, library code adds to it through
+# get_metrics() so nothing has to be threaded through the call chains.
+# Counters are incremented once per call with a count, never per element,
+# so they cost nothing measurable in the hot loops. Pool workers have their
+# own Metrics, they hand their counters back with take_counters() and the
+# parent merges them, or the parent counts the work it handed out
+
+# ru_maxrss is in kilobytes on Linux and in bytes on macOS
+RSS_UNIT = 1 if sys.platform == "darwin" else 1024
+
+PROFILE_TOP_N = 25
+
+def get_peak_rss():
+    if resource is None:
+        return None
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * RSS_UNIT
+
+def get_children_peak_rss():
+    if resource is None:
+        return None
+
+    return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * RSS_UNIT
+
+# pool task reporting which worker ran it and that worker's peak RSS
+def get_worker_peak_rss(_=None):
+    return (os.getpid(), get_peak_rss())
+
+class Metrics:
+    __slots__ = ("name", "start", "stages", "counters", "rates", "profile", "profiler", "lock")
+
+    def __init__(self, name=None, profile=None):
+        self.name = name
+        self.start = perf_counter()
+        # stage name: [calls, seconds, peak rss at the end of the stage]
+        self.stages = {}
+        self.counters = {}
+        # (counter, stage) pairs reported as throughput
+        self.rates = []
+        self.profile = profile
+        self.profiler = None
+        # the pipeline and the eval server update it from several threads
+        self.lock = threading.Lock()
+
+        if profile == "cpu":
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        elif profile == "memory":
+            tracemalloc.start()
+
+    @contextmanager
+    def stage(self, name):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            seconds = perf_counter() - start
+            with self.lock:
+                stage = self.stages.setdefault(name, [0, 0.0, None])
+                stage[0] += 1
+                stage[1] += seconds
+                stage[2] = get_peak_rss()
+
+    def count(self, name, num=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + num
+
+    # returns the counters so far and starts new ones
+    def take_counters(self):
+        with self.lock:
+            (counters, self.counters) = (self.counters, {})
+        return counters
+
+    def merge_counters(self, counters):
+        for name, num in counters.items():
+            self.count(name, num)
+
+    # reports counter per second of stage in the summary
+    def track_rate(self, counter, stage):
+        self.rates.append((counter, stage))
+
+    # per second rate of a counter over the time spent in a stage
+    def rate(self, counter, stage):
+        seconds = self.stages[stage][1] if stage in self.stages else 0.0
+        if seconds == 0.0 or counter not in self.counters:
+            return None
+
+        return self.counters[counter] / seconds
+
+    def summary(self):
+        return {"name": self.name,
+                "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "wall_seconds": perf_counter() - self.start,
+                "peak_rss_bytes": get_peak_rss(),
+                "children_peak_rss_bytes": get_children_peak_rss(),
+                "stages": {name: {"calls": calls, "seconds": seconds, "peak_rss_bytes": rss}
+                        for name, (calls, seconds, rss) in self.stages.items()},
+                "counters": dict(self.counters),
+                "rates": {f"{counter}_per_second_{stage}": self.rate(counter, stage)
+                        for (counter, stage) in self.rates}}
+
+    # stops profiling, writes the JSON summary to fp (if given) and logs it.
+    # the cProfile stats go next to it, the top tracemalloc allocation sites
+    # go into the summary
+    def finish(self, fp=None, logger=None):
+        summary = self.summary()
+
+        if self.profile == "cpu":
+            self.profiler.disable()
+            stats = pstats.Stats(self.profiler)
+            if fp is not None:
+                stats.dump_stats(f"{fp}.prof")
+            summary["profile"] = [{"function": f"{path}:{line}({func})", "calls": calls,
+                    "total_seconds": total, "cumulative_seconds": cumulative}
+                    for ((path, line, func), (_, calls, total, cumulative, _)) in
+                    sorted(stats.stats.items(), key=lambda it: it[1][3],
+                            reverse=True)[:PROFILE_TOP_N]]
+        elif self.profile == "memory":
+            (_, peak) = tracemalloc.get_traced_memory()
+            snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+            summary["traced_peak_bytes"] = peak
+            summary["profile"] = [{"site": str(stat.traceback), "size_bytes": stat.size,
+                    "count": stat.count}
+                    for stat in snapshot.statistics("lineno")[:PROFILE_TOP_N]]
+
+        if fp is not None:
+            with open(fp, "w") as out:
+                json.dump(summary, out, indent=2)
+
+        if logger is not None:
+            for line in format_summary(summary):
+                logger.info(line)
+
+        return summary
+
+def format_summary(summary):
+    lines = [f"Wall time: {summary['wall_seconds']:.2f}s"]
+
+    if summary["peak_rss_bytes"] is not None:
+        lines.append(f"Peak RSS: {summary['peak_rss_bytes'] / 2**20:.1f} MiB")
+
+    for name, stage in summary["stages"].items():
+        lines.append(f"Stage {name}: {stage['seconds']:.2f}s ({stage['calls']} calls)")
+
+    for name, val in summary["counters"].items():
+        lines.append(f"Counter {name}: {val}")
+
+    for name, val in summary["rates"].items():
+        if val is not None:
+            lines.append(f"Rate {name}: {val:.1f}")
+
+    return lines
+
+_metrics = Metrics()
+
+def get_metrics():
+    return _metrics
+
+# starts a fresh Metrics for a script run, profile is None, "cpu" or "memory"
+def start_metrics(name, profile=None):
+    global _metrics
+    _metrics = Metrics(name, profile)
+
+    return _metrics
+
+# the options every script gets
+def add_metrics_args(parser, name):
+    parser.add_argument("--metrics", help="Path of the JSON metrics summary, "
+            f"default={name}_metrics.json", default=f"{name}_metrics.json")
+    parser.add_argument("--profile", help="Capture a cProfile (cpu) or tracemalloc (memory) "
+            "profile into the metrics summary", choices=["cpu", "memory"], default=None)
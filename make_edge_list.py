@@ -1,16 +1,75 @@
 #!/usr/bin/env python3
+import argparse
 
-if __name__ == "__main__":
-    with open("edge_list", "w") as out:    
-        with open("keyword_4_level_result.txt", "r") as handle:
+from edge_list_io import open_text, write_csr_graph
+from instrumentation import get_metrics, start_metrics, add_metrics_args
+
+# yields each section of the hierarchy result file, a section is the list of
+# terms between delimiter lines (starting with '=' or '*'). the last section
+# is yielded even if the file doesn't end with a delimiter
+def iter_sections(handle):
+    section = []
+
+    for line in handle:
+        if line.startswith("=") or line.startswith("*"):
+            if section:
+                yield section
             section = []
+        else:
+            section.append(line.strip("\n"))
+
+    if section:
+        yield section
+
+# adjacent terms in a section are connected
+def iter_edges(handle):
+    metrics = get_metrics()
+
+    for section in iter_sections(handle):
+        metrics.count("rows_parsed", len(section))
+        for idx, term in enumerate(section):
+            if idx + 1 < len(section):
+                yield (term, section[idx + 1])
+
+def write_tsv(edges, out_fp):
+    with open_text(out_fp, "w") as out:
+        for (term_0, term_1) in edges:
+            out.write(f"{term_0}\t{term_1}\n")
+
+# names are stripped the way load_from_edge_list strips the fields of a tsv
+# edge list, so both formats give the same graph
+def write_csr(edges, out_fp):
+    node_ids = {}
+    sources = []
+    sinks = []
+
+    for (term_0, term_1) in edges:
+        sources.append(node_ids.setdefault(term_0.strip(), len(node_ids)))
+        sinks.append(node_ids.setdefault(term_1.strip(), len(node_ids)))
+
+    write_csr_graph(sources, sinks, list(node_ids.keys()), out_fp)
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-i", "--input", help="Path to hierarchy result file, may be gzipped",
+            default="keyword_4_level_result.txt")
+    parser.add_argument("-o", "--output", help="Output path, gzipped if it ends in .gz "
+            "(tsv only)", default="edge_list")
+    parser.add_argument("-f", "--format", help="Output format, tsv edge list or binary csr "
+            "graph that check_relationship_similarity.py can memory-map, default=tsv",
+            choices=["tsv", "csr"], default="tsv")
+    add_metrics_args(parser, "make_edge_list")
+
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = get_args()
+    metrics = start_metrics("make_edge_list", args.profile)
+
+    with metrics.stage("convert"), open_text(args.input, "r") as handle:
+        if args.format == "csr":
+            write_csr(iter_edges(handle), args.output)
+        else:
+            write_tsv(iter_edges(handle), args.output)
 
-            for line in handle:
-                if line.startswith("=") or line.startswith("*"):
-                    if section:
-                        for idx, term in enumerate(section):
-                            if idx + 1 < len(section):
-                                out.write(f"{term}\t{section[idx + 1]}\n")
-                    section = []
-                else:
-                    section.append(line.strip("\n"))
+    metrics.finish(args.metrics)
@@ -0,0 +1,157 @@
+import os
+import logging
+import hashlib
+
+import numpy as np
+from scipy import sparse
+from scipy.sparse.csgraph import shortest_path
+
+# distances are stored as uint8, MeSH is shallow enough that real distances
+# never get close to this
+UNREACHABLE = 255
+
+# number of source descriptors per shortest path call, bounds the size of the
+# intermediate float distance block
+SOURCE_BLOCK_SIZE = 256
+
+def hash_file(fp):
+    digest = hashlib.sha256()
+
+    with open(fp, "rb") as handle:
+        for chunk in iter(lambda: handle.read(1 << 20), b""):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+# the table depends on the MeSH graph (mesh_hash is the hash_file of the
+# edge list) and on which descriptors are in it
+def get_table_key(mesh_hash, uids):
+    digest = hashlib.sha256()
+    digest.update(mesh_hash.encode())
+    digest.update("\n".join(uids).encode())
+
+    return digest.hexdigest()
+
+# All-pairs MeSH distances for a fixed set of descriptors (the ones that have
+# a lemmatized term), memory-mapped from disk. distance() is a drop in for
+# get_distance(uid_0, uid_1, mesh_graph)
+class MeshDistanceTable:
+    __slots__ = ("uids", "uid_index", "dists", "table_fp")
+
+    def __init__(self, uids, dists, table_fp=None):
+        self.uids = uids
+        self.uid_index = {uid: idx for idx, uid in enumerate(uids)}
+        self.dists = dists
+        self.table_fp = table_fp
+
+    # when sent to a worker process the table is re-mapped from its file
+    # rather than copied
+    def __reduce__(self):
+        if self.table_fp is None:
+            return (MeshDistanceTable, (self.uids, np.asarray(self.dists)))
+
+        return (_map_table, (self.uids, self.table_fp))
+
+    def __contains__(self, uid):
+        return uid in self.uid_index
+
+    def distance(self, uid_0, uid_1):
+        if uid_0 == uid_1:
+            return 0
+
+        dist = int(self.dists[self.uid_index[uid_0], self.uid_index[uid_1]])
+
+        if dist == UNREACHABLE:
+            raise Exception("get_distance problem - sink not found")
+
+        return dist
+
+def _get_sparse_graph(mesh_graph):
+    node_ids = {node: idx for idx, node in enumerate(mesh_graph.keys())}
+
+    rows = []
+    cols = []
+    for node, adjs in mesh_graph.items():
+        node_id = node_ids[node]
+        for adj in adjs:
+            rows.append(node_id)
+            cols.append(node_ids[adj])
+
+    data = np.ones(len(rows), dtype=np.int8)
+    graph = sparse.csr_matrix((data, (rows, cols)), shape=(len(node_ids), len(node_ids)))
+
+    return (graph, node_ids)
+
+# BFS distances from each descriptor in uids to every other one, written
+# straight into a memory-mapped matrix a block of sources at a time
+def build_mesh_distance_table(mesh_graph, uids, fp):
+    logger = logging.getLogger(__name__)
+
+    (graph, node_ids) = _get_sparse_graph(mesh_graph)
+
+    # descriptors that aren't in the graph can only reach themselves
+    in_graph = [idx for idx, uid in enumerate(uids) if uid in node_ids]
+    graph_cols = np.array([node_ids[uids[idx]] for idx in in_graph], dtype=np.int64)
+
+    tmp_fp = f"{fp}.tmp"
+    dists = np.lib.format.open_memmap(tmp_fp, mode="w+", dtype=np.uint8,
+            shape=(len(uids), len(uids)))
+    dists[:] = UNREACHABLE
+    np.fill_diagonal(dists, 0)
+
+    in_graph = np.array(in_graph, dtype=np.int64)
+    for start in range(0, len(in_graph), SOURCE_BLOCK_SIZE):
+        block = in_graph[start:start + SOURCE_BLOCK_SIZE]
+        block_dists = shortest_path(graph, directed=False, unweighted=True,
+                indices=graph_cols[start:start + SOURCE_BLOCK_SIZE])[:, graph_cols]
+        block_dists[np.isinf(block_dists)] = UNREACHABLE
+        block_dists = np.minimum(block_dists, UNREACHABLE)
+
+        dists[np.ix_(block, in_graph)] = block_dists.astype(np.uint8)
+
+    dists.flush()
+    del dists
+    os.replace(tmp_fp, fp)
+
+    logger.info(f"Built MeSH distance table for {len(uids)} descriptors")
+
+def write_uids(uids, fp):
+    with open(fp, "w") as out:
+        for uid in uids:
+            out.write(f"{uid}\n")
+
+def load_uids(fp):
+    with open(fp, "r") as handle:
+        return [line.strip("\n") for line in handle]
+
+def _map_table(uids, table_fp):
+    return MeshDistanceTable(uids, np.load(table_fp, mmap_mode="r"), table_fp)
+
+def load_mesh_distance_table(table_fp, uids_fp):
+    return _map_table(load_uids(uids_fp), table_fp)
+
+# returns the distance table for uids, keyed by the MeSH edge list hash. if
+# there is no table for this key (first run, or MeSH changed) it is built,
+# load_mesh_graph is only called in that case. mesh_hash can be passed in if
+# the caller has already hashed the edge list
+def get_mesh_distance_table(mesh_fp, uids, cache_dir, load_mesh_graph, mesh_hash=None):
+    logger = logging.getLogger(__name__)
+
+    if mesh_hash is None:
+        mesh_hash = hash_file(mesh_fp)
+
+    uids = sorted(set(uids))
+    key = get_table_key(mesh_hash, uids)
+
+    table_fp = os.path.join(cache_dir, f"{key}.npy")
+    uids_fp = os.path.join(cache_dir, f"{key}.uids")
+
+    if not (os.path.exists(table_fp) and os.path.exists(uids_fp)):
+        logger.info(f"No MeSH distance table for {mesh_fp}, building {table_fp}")
+        os.makedirs(cache_dir, exist_ok=True)
+        write_uids(uids, uids_fp)
+        build_mesh_distance_table(load_mesh_graph(), uids, table_fp)
+    else:
+        logger.info(f"Using MeSH distance table {table_fp}")
+
+    return load_mesh_distance_table(table_fp, uids_fp)
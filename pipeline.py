@@ -0,0 +1,418 @@
+#!/usr/bin/env python3
+import os
+import ast
+import sys
+import json
+import shutil
+import hashlib
+import logging
+import argparse
+import tempfile
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from mesh_distance_cache import hash_file
+from instrumentation import get_metrics, start_metrics, add_metrics_args
+
+# Incremental runner for the analysis pipeline. Each stage runs one of the
+# scripts in a scratch directory with its inputs and parameters given on the
+# command line. Its outputs are stored in a content-addressed cache under a
+# key made of the script (and the local modules it imports), the parameters
+# and the hashes of the inputs, so a stage is only re-run when one of those
+# changes. Independent stages run concurrently.
+#
+# A stage is declared as
+#
+#   {"name": "relationships",
+#    "script": "check_relationship_similarity.py",
+#    "inputs": {"--input": "@hierarchy/edge_list", "--mesh": "$mesh_edge_list"},
+#    "params": {"--seed": 0},
+#    "outputs": {"--output": "comparison_results"},
+#    "files": []}
+#
+# input values are "@stage/name" (an output of another stage), "$name" (a
+# path from the config's "inputs") or a plain path. "outputs" are passed to
+# the script as file names in its scratch directory, "files" are outputs the
+# script writes under a fixed name (e.g. thresh_exp_res). every stage also
+# writes its metrics summary, stage_metrics.json, which is kept with its outputs
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+STAGE_METRICS = "stage_metrics.json"
+
+# the modules of this directory that a script imports, directly or through
+# other modules, including the script itself. a stage's output depends on
+# all of them
+def get_local_modules(script_fp):
+    modules = []
+    pending = [os.path.abspath(script_fp)]
+
+    while pending:
+        fp = pending.pop()
+        if fp in modules:
+            continue
+        modules.append(fp)
+
+        with open(fp, "r") as handle:
+            tree = ast.parse(handle.read(), fp)
+
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                names = [alias.name for alias in node.names]
+            elif isinstance(node, ast.ImportFrom) and node.level == 0 and node.module:
+                names = [node.module]
+            else:
+                continue
+
+            for name in names:
+                module_fp = os.path.join(SCRIPT_DIR, f"{name.split('.')[0]}.py")
+                if os.path.isfile(module_fp):
+                    pending.append(module_fp)
+
+    return sorted(modules)
+
+# the stages of the usual workflow. the hierarchy stage converts an
+# externally generated hierarchy if there is one, otherwise builds one from
+# document keywords
+def get_default_stages(inputs, cache_dir):
+    stages = [
+        {"name": "informative_terms", "script": "get_informative_terms.py",
+            "inputs": {"--mesh": "$desc", "--counts": "$doc_term_counts",
+                "--articles": "$specialized_articles"},
+            "params": {"--threshold": 1000,
+                "--desc-store": os.path.join(cache_dir, "desc_store")},
+            "outputs": {"--output": "seed_topics", "--matrix": "pm_doc_term_counts.npz"}},
+        {"name": "relationships", "script": "check_relationship_similarity.py",
+            "inputs": {"--input": "@hierarchy/edge_list", "--mesh": "$mesh_edge_list",
+                "--lem": "$lem_mesh_map", "--desc": "$desc"},
+            "params": {"--mesh-cache": os.path.join(cache_dir, "mesh_dist_cache"),
+                "--desc-store": os.path.join(cache_dir, "desc_store"),
+                "--result-cache": os.path.join(cache_dir, "component_cache")},
+            "outputs": {"--output": "comparison_results"}},
+        {"name": "thresh_exp", "script": "thresh_exp.py",
+            "inputs": {"--general": "$general_counts", "--special": "$special_counts",
+                "--corpus": "$special_corpus", "--mesh": "$lem_mesh"},
+            "params": {},
+            "files": ["thresh_exp_res"]},
+    ]
+
+    if "hierarchy_result" in inputs:
+        stages.append({"name": "hierarchy", "script": "make_edge_list.py",
+            "inputs": {"--input": "$hierarchy_result"},
+            "params": {},
+            "outputs": {"--output": "edge_list"}})
+    else:
+        stages.append({"name": "hierarchy", "script": "build_hierarchy.py",
+            "inputs": {"--input": "$documents"},
+            "params": {},
+            "outputs": {"--output": "edge_list"}})
+
+    return stages
+
+def get_dependencies(stage):
+    return {val[1:].split("/")[0] for val in stage["inputs"].values() if val.startswith("@")}
+
+# stage names in an order where every stage comes after its dependencies
+def get_stage_order(stages):
+    order = []
+    visiting = set()
+    by_name = {stage["name"]: stage for stage in stages}
+
+    def visit(name):
+        if name in order:
+            return
+        if name in visiting:
+            raise Exception(f"Pipeline has a dependency cycle at {name}")
+        if name not in by_name:
+            raise Exception(f"Unknown stage: {name}")
+
+        visiting.add(name)
+        for dep in sorted(get_dependencies(by_name[name])):
+            visit(dep)
+        visiting.remove(name)
+        order.append(name)
+
+    for stage in stages:
+        visit(stage["name"])
+
+    return order
+
+class ArtifactCache:
+    def __init__(self, cache_dir):
+        self.objects_dir = os.path.join(cache_dir, "objects")
+        self.stages_dir = os.path.join(cache_dir, "stages")
+        os.makedirs(self.objects_dir, exist_ok=True)
+        os.makedirs(self.stages_dir, exist_ok=True)
+
+    def get_object_path(self, digest):
+        return os.path.join(self.objects_dir, digest[:2], digest)
+
+    # moves fp into the store under its content hash. the extension is kept,
+    # scripts go by it for gzip and .npz files
+    def put_object(self, fp):
+        name = os.path.basename(fp)
+        extension = name[name.index("."):] if "." in name else ""
+        digest = hash_file(fp) + extension
+        path = self.get_object_path(digest)
+
+        if os.path.exists(path):
+            os.remove(fp)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            shutil.move(fp, path)
+
+        return digest
+
+    # the output name -> object hash manifest of a stage run, or None
+    def get_manifest(self, key):
+        path = os.path.join(self.stages_dir, f"{key}.json")
+
+        if not os.path.exists(path):
+            return None
+
+        with open(path, "r") as handle:
+            manifest = json.load(handle)
+
+        if not all(os.path.exists(self.get_object_path(digest)) for digest in manifest.values()):
+            return None
+
+        return manifest
+
+    def put_manifest(self, key, manifest):
+        path = os.path.join(self.stages_dir, f"{key}.json")
+        tmp_path = f"{path}.tmp"
+
+        with open(tmp_path, "w") as out:
+            json.dump(manifest, out, sort_keys=True)
+
+        os.replace(tmp_path, path)
+
+class PipelineRunner:
+    def __init__(self, stages, inputs, cache_dir, output_dir, jobs=2, force=()):
+        self.stages = {stage["name"]: stage for stage in stages}
+        self.inputs = inputs
+        self.cache = ArtifactCache(cache_dir)
+        self.output_dir = output_dir
+        self.jobs = jobs
+        self.force = set(force)
+        # stage name -> output name -> object path, filled as stages finish
+        self.outputs = {}
+        self.file_hashes = {}
+
+    def resolve_input(self, val):
+        if val.startswith("@"):
+            (stage_name, output_name) = val[1:].split("/", 1)
+            return self.outputs[stage_name][output_name]
+
+        if val.startswith("$"):
+            name = val[1:]
+            if name not in self.inputs:
+                raise Exception(f"Pipeline input {name} is not set in the config")
+            return os.path.abspath(self.inputs[name])
+
+        return os.path.abspath(val)
+
+    def get_file_hash(self, fp):
+        if fp not in self.file_hashes:
+            self.file_hashes[fp] = hash_file(fp)
+
+        return self.file_hashes[fp]
+
+    def get_stage_key(self, stage, input_paths):
+        script = os.path.join(SCRIPT_DIR, stage["script"])
+
+        key_data = {
+            "script": {os.path.relpath(fp, SCRIPT_DIR): self.get_file_hash(fp)
+                    for fp in get_local_modules(script)},
+            "inputs": {flag: self.get_file_hash(fp) for flag, fp in input_paths.items()},
+            "params": stage.get("params", {}),
+            "outputs": stage.get("outputs", {}),
+            "files": stage.get("files", []),
+        }
+
+        return hashlib.sha256(json.dumps(key_data, sort_keys=True).encode()).hexdigest()
+
+    def run_stage(self, name):
+        logger = logging.getLogger(__name__)
+
+        stage = self.stages[name]
+        input_paths = {flag: self.resolve_input(val) for flag, val in stage["inputs"].items()}
+        key = self.get_stage_key(stage, input_paths)
+
+        manifest = None if name in self.force else self.cache.get_manifest(key)
+
+        metrics = get_metrics()
+
+        if manifest is not None:
+            logger.info(f"{name}: inputs unchanged, reusing cached outputs")
+            metrics.count("stages_reused")
+        else:
+            logger.info(f"{name}: running {stage['script']}")
+            with metrics.stage(name):
+                manifest = self.execute_stage(stage, input_paths)
+            self.cache.put_manifest(key, manifest)
+            metrics.count("stages_run")
+
+        self.materialize(name, manifest)
+
+        return {output_name: self.cache.get_object_path(digest)
+                for output_name, digest in manifest.items()}
+
+    def execute_stage(self, stage, input_paths):
+        command = [sys.executable, os.path.join(SCRIPT_DIR, stage["script"])]
+
+        for flag, fp in input_paths.items():
+            command.extend([flag, fp])
+        for flag, val in stage.get("params", {}).items():
+            if val is True:
+                command.append(flag)
+            elif val is not False and val is not None:
+                command.extend([flag, str(val)])
+        for flag, output_name in stage.get("outputs", {}).items():
+            command.extend([flag, output_name])
+        command.extend(["--metrics", STAGE_METRICS])
+
+        output_names = list(stage.get("outputs", {}).values()) + list(stage.get("files", []))
+
+        with tempfile.TemporaryDirectory(prefix=f"{stage['name']}_") as work_dir:
+            log_fp = os.path.join(work_dir, "stage.log")
+            with open(log_fp, "w") as log:
+                completed = subprocess.run(command, cwd=work_dir, stdout=log,
+                        stderr=subprocess.STDOUT)
+
+            if completed.returncode != 0:
+                with open(log_fp, "r") as handle:
+                    tail = handle.readlines()[-20:]
+                raise Exception(f"Stage {stage['name']} failed ({completed.returncode}):\n"
+                        + "".join(tail))
+
+            manifest = {}
+            for output_name in output_names:
+                fp = os.path.join(work_dir, output_name)
+                if not os.path.exists(fp):
+                    raise Exception(f"Stage {stage['name']} did not write {output_name}")
+                manifest[output_name] = self.cache.put_object(fp)
+
+            manifest["stage.log"] = self.cache.put_object(log_fp)
+            manifest[STAGE_METRICS] = self.cache.put_object(os.path.join(work_dir, 
+                    STAGE_METRICS))
+
+        return manifest
+
+    # copies of the outputs under output_dir/<stage>/ for people to look at,
+    # downstream stages read the cached objects
+    def materialize(self, name, manifest):
+        stage_dir = os.path.join(self.output_dir, name)
+        os.makedirs(stage_dir, exist_ok=True)
+
+        for output_name, digest in manifest.items():
+            shutil.copyfile(self.cache.get_object_path(digest),
+                    os.path.join(stage_dir, output_name))
+
+    # runs the given stages (and what they depend on), as many at a time as
+    # jobs allows
+    def run(self, targets=None):
+        by_name = self.stages
+        order = get_stage_order(list(by_name.values()))
+
+        if targets:
+            needed = set()
+            stack = list(targets)
+            while stack:
+                name = stack.pop()
+                if name not in needed:
+                    needed.add(name)
+                    stack.extend(get_dependencies(by_name[name]))
+            order = [name for name in order if name in needed]
+
+        pending = list(order)
+        running = {}
+
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            while pending or running:
+                for name in list(pending):
+                    if get_dependencies(by_name[name]).issubset(self.outputs.keys()):
+                        pending.remove(name)
+                        running[executor.submit(self.run_stage, name)] = name
+
+                if not running:
+                    raise Exception(f"Stages can't be scheduled: {', '.join(pending)}")
+
+                (done, _) = wait(running.keys(), return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    self.outputs[name] = future.result()
+
+        return self.outputs
+
+def load_config(fp):
+    with open(fp, "r") as handle:
+        config = json.load(handle)
+
+    cache_dir = os.path.abspath(config.get("cache_dir", ".pipeline_cache"))
+    output_dir = config.get("output_dir", "pipeline_out")
+    inputs = config.get("inputs", {})
+
+    stages = config.get("stages") or get_default_stages(inputs, cache_dir)
+
+    # per-stage parameter overrides, e.g. {"informative_terms": {"--threshold": 500}}
+    for stage in stages:
+        stage.setdefault("params", {}).update(config.get("params", {}).get(stage["name"], {}))
+
+    return (stages, inputs, cache_dir, output_dir)
+
+def initialize_logger(debug=False, quiet=False):
+    level = logging.INFO
+    if debug:
+        level = logging.DEBUG
+
+    # Set up logging
+    logger = logging.getLogger(__name__)
+    logger.setLevel(level)
+    handler = logging.FileHandler("pipeline.log")
+    formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    handler.setFormatter(formatter)
+    logger.addHandler(handler)
+
+    if not quiet:
+        handler = logging.StreamHandler(sys.stdout)
+        handler.setLevel(level)
+        formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+        handler.setFormatter(formatter)
+        logger.addHandler(handler)
+
+    return logger
+
+def get_args():
+    logger = logging.getLogger(__name__)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-c", "--config", help="Path to pipeline config json", required=True)
+    parser.add_argument("-s", "--stages", help="Only run these stages (and their dependencies)",
+            nargs="+", default=None)
+    parser.add_argument("-j", "--jobs", help="Number of stages run at once, default=2",
+            type=int, default=2)
+    parser.add_argument("-f", "--force", help="Re-run these stages even if cached", nargs="+",
+            default=[])
+    add_metrics_args(parser, "pipeline")
+
+    args = parser.parse_args()
+
+    logger.info("###############################")
+    logger.info(f"Config: {args.config}")
+
+    return args
+
+if __name__ == "__main__":
+    logger = initialize_logger()
+    args = get_args()
+    metrics = start_metrics("pipeline", args.profile)
+
+    (stages, inputs, cache_dir, output_dir) = load_config(args.config)
+
+    runner = PipelineRunner(stages, inputs, cache_dir, output_dir, args.jobs, args.force)
+    runner.run(args.stages)
+
+    logger.info(f"Outputs written to {output_dir}")
+
+    metrics.finish(args.metrics, logger)
@@ -0,0 +1,368 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import random
+import logging
+import argparse
+import platform
+import statistics
+import subprocess
+import tracemalloc
+from time import perf_counter
+from datetime import datetime
+from multiprocessing import get_context
+
+import synthetic_data
+from evaluate import (run_trials, get_bigram_set, evaluate_many, prepare_eval_data,
+        init_trial_worker, get_worker_pool)
+from instrumentation import get_worker_peak_rss
+from thresh_exp import select_keywords
+from get_informative_terms import get_children, get_term_trees
+from descriptor_store import build_descriptor_store
+from check_relationship_similarity import (get_components, build_distance_matrix,
+        get_bigram_set as get_mesh_bigram_set)
+
+# Times and memory-profiles the hot paths on synthetic data (see
+# synthetic_data.py) at several sizes. Each case has a setup, which builds
+# its inputs and isn't measured, and a run. Timings are the wall time of
+# each repeat, memory is the tracemalloc peak of one extra run (tracing slows
+# things down, so it isn't done while timing). A run can return extra
+# measurements (e.g. the RSS of pool workers), those of the last timed run
+# are kept. Results are written as JSON so that runs of two versions can be
+# compared with --compare
+
+DEFAULT_SIZES = [0.25, 1.0, 4.0]
+
+def setup_get_children(scale, seed):
+    (desc_data, desc_uids) = synthetic_data.make_mesh_tree(int(1000 * scale), seed=seed)
+    (term_trees, _) = get_term_trees(desc_data)
+    uids = random.Random(seed).sample(desc_uids, min(50, len(desc_uids)))
+
+    return {"term_trees": term_trees, "uids": uids,
+            "params": {"num_descriptors": len(desc_uids), "num_lookups": len(uids)}}
+
+def run_get_children(state):
+    for uid in state["uids"]:
+        get_children(uid, state["term_trees"])
+
+def setup_store_children(scale, seed):
+    state = setup_get_children(scale, seed)
+    (desc_data, _) = synthetic_data.make_mesh_tree(int(1000 * scale), seed=seed)
+    state["store"] = build_descriptor_store(desc_data)
+
+    return state
+
+def run_store_children(state):
+    for uid in state["uids"]:
+        state["store"].children(uid)
+
+def setup_build_store(scale, seed):
+    (desc_data, desc_uids) = synthetic_data.make_mesh_tree(int(20000 * scale), seed=seed)
+
+    return {"desc_data": desc_data, "params": {"num_descriptors": len(desc_uids)}}
+
+def run_build_store(state):
+    build_descriptor_store(state["desc_data"])
+
+def setup_run_trials(scale, seed):
+    rng = random.Random(seed)
+    (desc_data, _) = synthetic_data.make_mesh_tree(int(2000 * scale), seed=seed)
+    mesh = set(synthetic_data.get_lem_mesh(desc_data).values())
+
+    terms = synthetic_data.get_words(int(5000 * scale), rng) + sorted(mesh)
+    corpus = synthetic_data.make_corpus(terms, int(50000 * scale), seed=seed)
+
+    return {"corpus": corpus, "mesh": mesh, "num_elements": 200, "num_trials": 1000,
+            "params": {"corpus_size": len(corpus), "mesh_size": len(mesh),
+                    "num_elements": 200, "num_trials": 1000}}
+
+def run_run_trials(state):
+    run_trials(state["corpus"], state["mesh"], state["num_elements"], state["num_trials"])
+
+# many candidate results of a few sizes, the trials are shared per size
+def setup_evaluate_many(scale, seed):
+    state = setup_run_trials(scale, seed)
+    rng = random.Random(seed)
+
+    terms = sorted(set(state["corpus"]))
+    state["results"] = {f"result_{idx}": rng.sample(terms, rng.choice([50, 100, 200]))
+            for idx in range(int(40 * scale))}
+    state["params"]["num_results"] = len(state["results"])
+
+    return state
+
+def run_evaluate_many(state):
+    evaluate_many(state["corpus"], state["results"], state["mesh"], state["num_trials"], seed=0)
+
+# a fresh python importing evaluate, what every spawned worker pays
+def setup_import_evaluate(scale, seed):
+    return {"params": {}}
+
+def run_import_evaluate(state):
+    subprocess.run([sys.executable, "-c", "import evaluate"], check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)))
+
+# the time until every worker of a pool has run a task, and the workers'
+# peak RSS, with the trial data thresh_exp hands its workers. fork is the
+# plain Pool, the workers copy the parent, forkserver is get_worker_pool
+def get_pool_startup(start_method, scale, seed, processes=4):
+    state = setup_run_trials(scale, seed)
+    (_, corpus_ids, mesh_flags) = prepare_eval_data(state["corpus"], state["mesh"])
+
+    start = perf_counter()
+    if start_method == "forkserver":
+        pool = get_worker_pool(processes, init_trial_worker, (corpus_ids, mesh_flags))
+    else:
+        pool = get_context(start_method).Pool(processes, init_trial_worker,
+                (corpus_ids, mesh_flags))
+
+    worker_rss = {}
+    with pool:
+        # the workers that are up first take every task of a map, so tasks
+        # are handed out until each worker has reported once
+        while len(worker_rss) < processes:
+            worker_rss.update(pool.map(get_worker_peak_rss, range(processes), chunksize=1))
+        startup_seconds = perf_counter() - start
+
+    return {"startup_seconds": startup_seconds, "workers": len(worker_rss),
+            "worker_peak_rss_bytes": statistics.mean(worker_rss.values())}
+
+# measured in a fresh python, so that the workers start like thresh_exp's
+# rather than from this process with every case's imports and data
+def setup_pool_startup(start_method):
+    def setup(scale, seed):
+        return {"start_method": start_method, "scale": scale, "seed": seed,
+                "params": {"processes": 4}}
+
+    return setup
+
+def run_pool_startup(state):
+    code = ("import json, run_benchmarks; print(json.dumps(run_benchmarks.get_pool_startup("
+            f"{state['start_method']!r}, {state['scale']}, {state['seed']})))")
+    out = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True,
+            check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+
+    return json.loads(out.splitlines()[-1])
+
+def setup_select_keywords(scale, seed):
+    rng = random.Random(seed)
+    words = synthetic_data.get_words(int(20000 * scale), rng)
+    special = rng.sample(words, len(words) // 4)
+
+    general_counts = dict(zip(words, (int(1e6 * w) + 1 for w in
+            synthetic_data.get_zipf_weights(len(words)))))
+    special_counts = dict(zip(special, (int(1e5 * w) + 1 for w in
+            synthetic_data.get_zipf_weights(len(special)))))
+
+    return {"general": general_counts, "special": special_counts,
+            "len_general": sum(general_counts.values()),
+            "len_special": sum(special_counts.values()),
+            "params": {"num_general": len(general_counts), "num_special": len(special_counts)}}
+
+def run_select_keywords(state):
+    # select_keywords adds to the general counts, so it gets a copy
+    for _ in select_keywords(state["special"], state["len_special"], dict(state["general"]),
+            state["len_general"], 1, 100):
+        pass
+
+def setup_get_bigram_set(scale, seed):
+    (desc_data, _) = synthetic_data.make_mesh_tree(int(20000 * scale), seed=seed)
+    mesh = set(synthetic_data.get_lem_mesh(desc_data).values())
+
+    return {"mesh": mesh, "params": {"mesh_size": len(mesh)}}
+
+def run_get_bigram_set(state):
+    get_bigram_set(state["mesh"])
+
+def get_hierarchy(scale, seed):
+    rng = random.Random(seed)
+    (desc_data, _) = synthetic_data.make_mesh_tree(int(2000 * scale), seed=seed)
+    lemmas = list(synthetic_data.get_lem_mesh(desc_data).values())
+
+    terms = synthetic_data.get_words(int(2000 * scale), rng) + lemmas
+    edges = synthetic_data.make_hierarchy_edges(terms, int(40 * scale), 40, seed=seed)
+
+    adj_list = {}
+    for (parent, child) in edges:
+        adj_list.setdefault(parent, []).append(child)
+        adj_list.setdefault(child, []).append(parent)
+
+    return (desc_data, adj_list)
+
+def setup_get_components(scale, seed):
+    (_, adj_list) = get_hierarchy(scale, seed)
+
+    return {"adj_list": adj_list, "params": {"num_nodes": len(adj_list)}}
+
+def run_get_components(state):
+    get_components(state["adj_list"])
+
+def setup_build_distance_matrix(scale, seed):
+    (desc_data, adj_list) = get_hierarchy(scale, seed)
+
+    mesh_graph = {}
+    for (parent, child) in synthetic_data.get_mesh_edges(desc_data):
+        mesh_graph.setdefault(parent, []).append(child)
+        mesh_graph.setdefault(child, []).append(parent)
+
+    lem_mesh_map = {lemma: uid for uid, lemma in synthetic_data.get_lem_mesh(desc_data).items()}
+    lem_mesh = set(lem_mesh_map.keys())
+    (lem_mesh_bigrams, lem_mesh_map) = get_mesh_bigram_set(lem_mesh, lem_mesh_map)
+
+    # the few largest components, that's where the time goes
+    components = sorted(get_components(adj_list), key=len, reverse=True)[:5]
+
+    return {"components": components, "mesh_graph": mesh_graph, "lem_mesh_map": lem_mesh_map,
+            "lem_mesh": lem_mesh, "lem_mesh_bigrams": lem_mesh_bigrams,
+            "params": {"num_components": len(components),
+                    "component_sizes": [len(comp) for comp in components]}}
+
+def run_build_distance_matrix(state):
+    for component in state["components"]:
+        build_distance_matrix(component, state["mesh_graph"], state["lem_mesh_map"],
+                state["lem_mesh"], state["lem_mesh_bigrams"])
+
+# name: (setup, run)
+CASES = {
+    "get_children": (setup_get_children, run_get_children),
+    "store_children": (setup_store_children, run_store_children),
+    "build_store": (setup_build_store, run_build_store),
+    "run_trials": (setup_run_trials, run_run_trials),
+    "evaluate_many": (setup_evaluate_many, run_evaluate_many),
+    "import_evaluate": (setup_import_evaluate, run_import_evaluate),
+    "fork_pool_startup": (setup_pool_startup("fork"), run_pool_startup),
+    "preloaded_pool_startup": (setup_pool_startup("forkserver"), run_pool_startup),
+    "select_keywords": (setup_select_keywords, run_select_keywords),
+    "get_bigram_set": (setup_get_bigram_set, run_get_bigram_set),
+    "get_components": (setup_get_components, run_get_components),
+    "build_distance_matrix": (setup_build_distance_matrix, run_build_distance_matrix),
+}
+
+def get_git_rev():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# one untimed warm up run first
+def measure(run, state, repeats):
+    random.seed(0)
+    run(state)
+
+    times = []
+    extra = None
+    for _ in range(repeats):
+        random.seed(0)
+        start = perf_counter()
+        extra = run(state)
+        times.append(perf_counter() - start)
+
+    random.seed(0)
+    tracemalloc.start()
+    run(state)
+    (_, peak) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return (times, peak, extra)
+
+def run_benchmarks(cases, sizes, repeats, seed=0):
+    logger = logging.getLogger(__name__)
+
+    results = []
+    for name in cases:
+        (setup, run) = CASES[name]
+        for scale in sizes:
+            state = setup(scale, seed)
+            (times, peak, extra) = measure(run, state, repeats)
+
+            logger.info(f"{name} scale={scale}: min {min(times):.4f}s, "
+                    f"median {statistics.median(times):.4f}s, peak {peak / 2**20:.1f} MiB")
+            if extra is not None:
+                logger.info(f"{name} scale={scale}: {extra}")
+
+            results.append({"case": name, "scale": scale, "params": state["params"],
+                    "times": times, "min": min(times), "median": statistics.median(times),
+                    "peak_bytes": peak, "extra": extra})
+
+    return {"git_rev": get_git_rev(), "python": platform.python_version(),
+            "platform": platform.platform(), "date": datetime.now().isoformat(),
+            "repeats": repeats, "seed": seed, "results": results}
+
+# ratios of median times and peak memory, new over old, for the cases and
+# sizes in both
+def compare_results(old, new):
+    old_results = {(res["case"], res["scale"]): res for res in old["results"]}
+
+    rows = []
+    for res in new["results"]:
+        prev = old_results.get((res["case"], res["scale"]))
+        if prev is None:
+            continue
+        rows.append((res["case"], res["scale"], res["median"] / prev["median"],
+                res["peak_bytes"] / max(prev["peak_bytes"], 1)))
+
+    return rows
+
+def initialize_logger(debug=False, quiet=False):
+    level = logging.INFO
+    if debug:
+        level = logging.DEBUG
+
+    # Set up logging
+    logger = logging.getLogger(__name__)
+    logger.setLevel(level)
+    handler = logging.FileHandler("benchmarks.log")
+    formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    handler.setFormatter(formatter)
+    logger.addHandler(handler)
+
+    if not quiet:
+        handler = logging.StreamHandler(sys.stdout)
+        handler.setLevel(level)
+        formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+        handler.setFormatter(formatter)
+        logger.addHandler(handler)
+
+    return logger
+
+def get_args():
+    logger = logging.getLogger(__name__)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-c", "--cases", help="Cases to run, default=all", nargs="+",
+            choices=list(CASES.keys()), default=list(CASES.keys()))
+    parser.add_argument("-s", "--sizes", help="Scale factors of the synthetic data, "
+            f"default={DEFAULT_SIZES}", nargs="+", type=float, default=DEFAULT_SIZES)
+    parser.add_argument("-r", "--repeats", help="Timed runs per case and size, default=5",
+            type=int, default=5)
+    parser.add_argument("--seed", help="Seed for the synthetic data, default=0", type=int,
+            default=0)
+    parser.add_argument("-o", "--output", help="Output JSON path", default="benchmarks.json")
+    parser.add_argument("--compare", help="Previous benchmarks JSON to compare against")
+
+    args = parser.parse_args()
+
+    logger.info("###############################")
+    logger.info(f"Cases: {args.cases}")
+    logger.info(f"Sizes: {args.sizes}")
+    logger.info(f"Repeats: {args.repeats}")
+
+    return args
+
+if __name__ == "__main__":
+    logger = initialize_logger()
+    args = get_args()
+
+    results = run_benchmarks(args.cases, args.sizes, args.repeats, args.seed)
+
+    with open(args.output, "w") as out:
+        json.dump(results, out, indent=2)
+
+    if args.compare:
+        with open(args.compare, "r") as handle:
+            old = json.load(handle)
+
+        for (case, scale, time_ratio, mem_ratio) in compare_results(old, results):
+            logger.info(f"{case} scale={scale}: time x{time_ratio:.2f}, memory x{mem_ratio:.2f}")
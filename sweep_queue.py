@@ -0,0 +1,432 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import math
+import time
+import socket
+import logging
+import argparse
+import subprocess
+from collections import Counter
+
+from numpy.random import SeedSequence
+
+import thresh_exp
+import thresh_exp_bigrams
+from evaluate import (load_mesh, load_list, is_bigram_corpus, get_bigram_set, prepare_eval_data,
+        get_trial_chunks, run_trial_chunk, check_intersection, compute_p_val, TRIAL_CHUNK_SIZE)
+from columnar_output import FORMATS, can_write_parquet
+from instrumentation import get_metrics, start_metrics, add_metrics_args
+
+# Runs a thresh_exp (or thresh_exp_bigrams) sweep on several machines that
+# share a directory, e.g. over NFS. The coordinator publishes one task per
+# sweep point (top N keywords) and trial chunk into the queue directory:
+#
+#   sweep.json      inputs and settings of the sweep
+#   keywords.json   the (keywords, thresh) sets, only needed for the merge
+#   pending/        tasks waiting for a worker
+#   leased/         claimed tasks, named {task}@{worker}
+#   results/        the histogram of intersect lengths of each finished task
+#
+# A worker claims a task by renaming it from pending/ into leased/. rename is
+# atomic on a local file system and on NFS, so exactly one worker gets each
+# task and no lock daemon is needed. The lease is the mtime of the leased
+# file, a task whose lease is older than lease_seconds (its worker died or
+# hung) is renamed back into pending/ by whichever worker notices first.
+# Results are written to a temporary file and renamed into place, so a
+# partial result is never seen. A task can end up being run twice (its lease
+# expired while its worker was still busy), but chunks are seeded the same
+# way as evaluate's, so both runs write the same result.
+#
+# Each sweep point gets the seed [seed, thresh], the same as thresh_exp with
+# --seed, and is split into the same TRIAL_CHUNK_SIZE chunks, so the merged
+# output draws exactly the trials of a local seeded run. The p-values can
+# differ from it in the last digits since the variance is summed over the
+# merged histogram rather than the trials in order
+
+SWEEP_FP = "sweep.json"
+KEYWORDS_FP = "keywords.json"
+PENDING_DIR = "pending"
+LEASED_DIR = "leased"
+RESULTS_DIR = "results"
+
+DEFAULT_LEASE_SECONDS = 600
+POLL_SECONDS = 5
+
+def get_sweep_module(bigrams):
+    return thresh_exp_bigrams if bigrams else thresh_exp
+
+def get_task_name(thresh, chunk):
+    return f"{thresh:05d}_{chunk:05d}"
+
+def get_num_chunks(num_trials, chunk_size=TRIAL_CHUNK_SIZE):
+    return math.ceil(num_trials / chunk_size)
+
+def get_worker_name():
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+# writes through a temporary file in the same directory so the rename is
+# atomic
+def write_json(data, fp):
+    tmp_fp = f"{fp}.{get_worker_name()}.tmp"
+    with open(tmp_fp, "w") as out:
+        json.dump(data, out)
+    os.replace(tmp_fp, fp)
+
+def load_json(fp):
+    with open(fp, "r") as handle:
+        return json.load(handle)
+
+def load_sweep(queue_dir):
+    return (load_json(os.path.join(queue_dir, SWEEP_FP)),
+            load_json(os.path.join(queue_dir, KEYWORDS_FP)))
+
+# selects the keywords and writes a task for every sweep point and chunk
+def publish(queue_dir, gen_kw_path, special_kw_path, special_corpus_path, mesh_path,
+        min_spec_freq, bigrams=False, num_trials=None, seed=None,
+        lease_seconds=DEFAULT_LEASE_SECONDS):
+    logger = logging.getLogger(__name__)
+    metrics = get_metrics()
+
+    if os.path.exists(os.path.join(queue_dir, SWEEP_FP)):
+        raise Exception(f"{queue_dir} already holds a sweep")
+
+    module = get_sweep_module(bigrams)
+    if num_trials is None:
+        num_trials = module.NUM_TRIALS
+    # an unseeded sweep still needs one seed that all the workers share, it
+    # is kept in sweep.json so the sweep can be reproduced
+    if seed is None:
+        seed = SeedSequence().entropy
+
+    with metrics.stage("select_keywords"):
+        keyword_sets = module.get_keyword_sets(gen_kw_path, special_kw_path, min_spec_freq)
+
+    for name in (PENDING_DIR, LEASED_DIR, RESULTS_DIR):
+        os.makedirs(os.path.join(queue_dir, name), exist_ok=True)
+
+    num_chunks = get_num_chunks(num_trials)
+    for (keywords, thresh) in keyword_sets:
+        for chunk in range(num_chunks):
+            write_json({"thresh": thresh, "chunk": chunk, "num_elements": len(keywords)},
+                    os.path.join(queue_dir, PENDING_DIR, get_task_name(thresh, chunk)))
+
+    write_json([[keywords, thresh] for (keywords, thresh) in keyword_sets],
+            os.path.join(queue_dir, KEYWORDS_FP))
+    # written last, workers wait for it
+    write_json({"corpus": os.path.abspath(special_corpus_path), "mesh": os.path.abspath(mesh_path),
+            "general": os.path.abspath(gen_kw_path), "special": os.path.abspath(special_kw_path),
+            "freq": min_spec_freq, "bigrams": bigrams, "num_trials": num_trials, "seed": seed,
+            "chunk_size": TRIAL_CHUNK_SIZE, "lease_seconds": lease_seconds},
+            os.path.join(queue_dir, SWEEP_FP))
+
+    logger.info(f"Published {len(keyword_sets) * num_chunks} tasks ({len(keyword_sets)} sweep "
+            f"points of {num_chunks} chunks) to {queue_dir}")
+
+def get_lease_task(lease_name):
+    return lease_name.split("@", 1)[0]
+
+# moves tasks whose lease is older than lease_seconds back to pending/, or
+# drops them if their result has been written in the meantime. returns the
+# number requeued
+def requeue_expired(queue_dir, lease_seconds):
+    logger = logging.getLogger(__name__)
+
+    now = time.time()
+    requeued = 0
+    for lease_name in os.listdir(os.path.join(queue_dir, LEASED_DIR)):
+        lease_fp = os.path.join(queue_dir, LEASED_DIR, lease_name)
+        task = get_lease_task(lease_name)
+        try:
+            if os.path.getmtime(lease_fp) + lease_seconds > now:
+                continue
+            if os.path.exists(os.path.join(queue_dir, RESULTS_DIR, task)):
+                os.remove(lease_fp)
+                continue
+            os.rename(lease_fp, os.path.join(queue_dir, PENDING_DIR, task))
+        except FileNotFoundError:
+            # its worker finished, or another worker got there first
+            continue
+
+        logger.info(f"Lease {lease_name} expired, requeued {task}")
+        requeued += 1
+
+    get_metrics().count("leases_expired", requeued)
+    return requeued
+
+# claims the first pending task. returns (task, lease path) or None if
+# there are no pending tasks
+def claim_task(queue_dir, worker):
+    for task in sorted(os.listdir(os.path.join(queue_dir, PENDING_DIR))):
+        if task.endswith(".tmp"):
+            continue
+        task_fp = os.path.join(queue_dir, PENDING_DIR, task)
+        lease_fp = os.path.join(queue_dir, LEASED_DIR, f"{task}@{worker}")
+        try:
+            # the lease starts now, not when the task was published or its
+            # last lease expired. rename keeps the mtime, so the task is
+            # touched first, otherwise requeue_expired could take it back
+            # as soon as it is claimed
+            os.utime(task_fp)
+            os.rename(task_fp, lease_fp)
+        except FileNotFoundError:
+            # claimed by another worker
+            continue
+
+        return (task, lease_fp)
+
+    return None
+
+# loads the corpus and mesh once, then runs tasks until the queue is empty.
+# with max_tasks the worker stops after that many
+def work(queue_dir, max_tasks=None, poll_seconds=POLL_SECONDS):
+    logger = logging.getLogger(__name__)
+    metrics = get_metrics()
+
+    while not os.path.exists(os.path.join(queue_dir, SWEEP_FP)):
+        logger.info(f"Waiting for a sweep to be published to {queue_dir}")
+        time.sleep(poll_seconds)
+
+    (sweep, _) = load_sweep(queue_dir)
+    worker = get_worker_name()
+
+    with metrics.stage("load"):
+        (_, corpus_ids, mesh_flags) = prepare_eval_data(load_list(sweep["corpus"]),
+                load_mesh(sweep["mesh"]))
+
+    # child seeds of each sweep point, spawned once
+    point_chunks = {}
+
+    done = 0
+    while max_tasks is None or done < max_tasks:
+        requeue_expired(queue_dir, sweep["lease_seconds"])
+
+        claimed = claim_task(queue_dir, worker)
+        if claimed is None:
+            if not os.listdir(os.path.join(queue_dir, LEASED_DIR)):
+                break
+            # the rest is leased, wait in case a lease expires
+            time.sleep(poll_seconds)
+            continue
+
+        (task, lease_fp) = claimed
+        result_fp = os.path.join(queue_dir, RESULTS_DIR, task)
+        if os.path.exists(result_fp):
+            os.remove(lease_fp)
+            continue
+
+        try:
+            task_data = load_json(lease_fp)
+        except FileNotFoundError:
+            # the lease was already taken back
+            continue
+        (thresh, chunk) = (task_data["thresh"], task_data["chunk"])
+        if thresh not in point_chunks:
+            point_chunks[thresh] = get_trial_chunks(thresh_exp.get_point_seed(sweep["seed"],
+                    thresh), sweep["num_trials"], sweep["chunk_size"])
+        (child_seed, chunk_trials) = point_chunks[thresh][chunk]
+
+        with metrics.stage("trials"):
+            random_intersect_results = run_trial_chunk(corpus_ids, mesh_flags,
+                    task_data["num_elements"], chunk_trials, child_seed)
+
+        write_json({"thresh": thresh, "chunk": chunk, "worker": worker,
+                "counts": sorted(Counter(random_intersect_results).items())}, result_fp)
+        try:
+            os.remove(lease_fp)
+        except FileNotFoundError:
+            # the lease expired and was requeued while this ran
+            pass
+
+        metrics.count("trials", chunk_trials)
+        metrics.count("set_lookups", chunk_trials * task_data["num_elements"])
+        metrics.count("tasks_done")
+        done += 1
+
+    logger.info(f"Worker {worker} finished after {done} tasks")
+
+# tasks in each state
+def get_status(queue_dir):
+    (sweep, keyword_sets) = load_sweep(queue_dir)
+
+    now = time.time()
+    leases = os.listdir(os.path.join(queue_dir, LEASED_DIR))
+    expired = 0
+    for lease_name in leases:
+        try:
+            if os.path.getmtime(os.path.join(queue_dir, LEASED_DIR, lease_name)) + \
+                    sweep["lease_seconds"] <= now:
+                expired += 1
+        except FileNotFoundError:
+            continue
+
+    num_chunks = get_num_chunks(sweep["num_trials"], sweep["chunk_size"])
+
+    return {"tasks": len(keyword_sets) * num_chunks,
+            "pending": len(os.listdir(os.path.join(queue_dir, PENDING_DIR))),
+            "leased": len(leases), "expired": expired,
+            "done": len([name for name in os.listdir(os.path.join(queue_dir, RESULTS_DIR))
+                    if not name.endswith(".tmp")])}
+
+# combines the chunk histograms of every sweep point into the rows that
+# evaluate returns and writes them like thresh_exp does
+def merge(queue_dir, out_fp=None, output_format="text"):
+    logger = logging.getLogger(__name__)
+    metrics = get_metrics()
+
+    (sweep, keyword_sets) = load_sweep(queue_dir)
+    module = get_sweep_module(sweep["bigrams"])
+    if out_fp is None:
+        out_fp = module.RESULTS_FP
+
+    num_chunks = get_num_chunks(sweep["num_trials"], sweep["chunk_size"])
+
+    missing = [get_task_name(thresh, chunk) for (_, thresh) in keyword_sets
+            for chunk in range(num_chunks)
+            if not os.path.exists(os.path.join(queue_dir, RESULTS_DIR,
+                    get_task_name(thresh, chunk)))]
+    if missing:
+        raise Exception(f"{len(missing)} tasks are not done yet, e.g. {missing[0]}")
+
+    with metrics.stage("load"):
+        mesh = load_mesh(sweep["mesh"])
+        if is_bigram_corpus(load_list(sweep["corpus"])):
+            mesh = get_bigram_set(mesh)
+
+    results = []
+    with metrics.stage("merge"):
+        for (keywords, thresh) in keyword_sets:
+            counts = Counter()
+            for chunk in range(num_chunks):
+                task_result = load_json(os.path.join(queue_dir, RESULTS_DIR,
+                        get_task_name(thresh, chunk)))
+                counts.update(dict(task_result["counts"]))
+
+            random_intersect_results = []
+            for (val, count) in sorted(counts.items()):
+                random_intersect_results.extend([val] * count)
+
+            method_intersect_len = check_intersection(keywords, mesh)
+            p = compute_p_val(method_intersect_len, random_intersect_results)
+
+            results.append((thresh, p, method_intersect_len, len(keywords),
+                    sum(random_intersect_results) / len(random_intersect_results),
+                    max(random_intersect_results)))
+
+    with metrics.stage("write"):
+        module.write_results(sorted(results, key=lambda res: res[0]), out_fp, output_format)
+
+    logger.info(f"Merged {len(results)} sweep points into {out_fp}")
+
+# stands in for several nodes: runs num_workers worker processes on this
+# machine, then merges
+def run_local(queue_dir, num_workers, out_fp=None, poll_seconds=POLL_SECONDS,
+        output_format="text"):
+    logger = logging.getLogger(__name__)
+
+    script = os.path.abspath(__file__)
+    procs = [subprocess.Popen([sys.executable, script, "work", "-q", queue_dir, "--poll",
+            str(poll_seconds), "--metrics", os.path.join(queue_dir, f"worker_{idx}_metrics.json")])
+            for idx in range(num_workers)]
+
+    failed = [proc.args for proc in procs if proc.wait() != 0]
+    if failed:
+        logger.warning(f"{len(failed)} workers exited with an error")
+
+    merge(queue_dir, out_fp, output_format)
+
+def initialize_logger(debug=False, quiet=False):
+    level = logging.INFO
+    if debug:
+        level = logging.DEBUG
+
+    # Set up logging
+    logger = logging.getLogger(__name__)
+    logger.setLevel(level)
+    handler = logging.FileHandler("sweep_queue.log")
+    formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    handler.setFormatter(formatter)
+    logger.addHandler(handler)
+
+    if not quiet:
+        handler = logging.StreamHandler(sys.stdout)
+        handler.setLevel(level)
+        formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+        handler.setFormatter(formatter)
+        logger.addHandler(handler)
+
+    return logger
+
+def get_args():
+    logger = logging.getLogger(__name__)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("command", help="publish a sweep, work on its tasks, merge the results, "
+            "show the status of the queue, or publish and run it with local workers",
+            choices=["publish", "work", "merge", "status", "local"])
+    parser.add_argument("-q", "--queue", help="Path to the queue directory, on storage shared "
+            "by all the nodes", required=True)
+    parser.add_argument("-g", "--general", help="Path to general keywords counts input")
+    parser.add_argument("-s", "--special", help="Path to special keywords counts input")
+    parser.add_argument("-c", "--corpus", help="Path to special corpus")
+    parser.add_argument("-m", "--mesh", help="Path to lemmatized MeSH file")
+    parser.add_argument("-f", "--freq", help="Minimum occurrence frequency for special keywords, "
+            "default=100", type=int, default=100)
+    parser.add_argument("-b", "--bigrams", help="Run the thresh_exp_bigrams sweep",
+            action="store_true")
+    parser.add_argument("-t", "--trials", help="Number of random trials per sweep point, "
+            "default is the sweep's own", type=int, default=None)
+    parser.add_argument("--seed", help="Seed for the random trials, default is a random one "
+            "(stored in the queue)", type=int, default=None)
+    parser.add_argument("-l", "--lease", help="Seconds before a claimed task is given to another "
+            f"worker, default={DEFAULT_LEASE_SECONDS}", type=int, default=DEFAULT_LEASE_SECONDS)
+    parser.add_argument("-w", "--workers", help="Number of worker processes for local, default=4",
+            type=int, default=4)
+    parser.add_argument("--max-tasks", help="Stop a worker after this many tasks", type=int,
+            default=None)
+    parser.add_argument("--poll", help="Seconds between checks of the queue while waiting, "
+            f"default={POLL_SECONDS}", type=float, default=POLL_SECONDS)
+    parser.add_argument("-o", "--output", help="Path of the merged results, default is the "
+            "sweep's own (thresh_exp_res or thresh_exp_res_bigrams)", default=None)
+    parser.add_argument("--output-format", help="Format of the merged results, text (tab "
+            "separated) or a columnar table (npy directory or parquet), default=text",
+            choices=FORMATS, default="text")
+    add_metrics_args(parser, "sweep_queue")
+
+    args = parser.parse_args()
+
+    logger.info("###############################")
+    logger.info(f"Command: {args.command}")
+    logger.info(f"Queue: {args.queue}")
+
+    if args.command in ("publish", "local") and not (args.general and args.special and
+            args.corpus and args.mesh):
+        parser.error(f"{args.command} requires --general, --special, --corpus and --mesh")
+
+    if args.output_format == "parquet" and not can_write_parquet():
+        parser.error("--output-format parquet needs pyarrow")
+
+    return args
+
+if __name__ == "__main__":
+    logger = initialize_logger()
+    args = get_args()
+    metrics = start_metrics("sweep_queue", args.profile)
+    metrics.track_rate("trials", "trials")
+
+    if args.command in ("publish", "local"):
+        publish(args.queue, args.general, args.special, args.corpus, args.mesh, args.freq,
+                args.bigrams, args.trials, args.seed, args.lease)
+
+    if args.command == "work":
+        work(args.queue, args.max_tasks, args.poll)
+    elif args.command == "merge":
+        merge(args.queue, args.output, args.output_format)
+    elif args.command == "status":
+        for name, val in get_status(args.queue).items():
+            logger.info(f"{name}: {val}")
+    elif args.command == "local":
+        run_local(args.queue, args.workers, args.output, args.poll, args.output_format)
+
+    metrics.finish(args.metrics, logger)
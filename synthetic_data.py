@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+import os
+import argparse
+from random import Random
+
+# Generators for synthetic stand-ins of the real inputs (desc2020, the PubMed
+# doc-term counts, keyword counts, corpora, hierarchy results) so that the
+# hot paths can be benchmarked without the real data. Everything is driven
+# by a seed and a few scale parameters. Term frequencies follow a Zipf-like
+# distribution, which is roughly what the real keyword counts look like
+
+def get_words(num_words, rng):
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    words = set()
+
+    while len(words) < num_words:
+        words.add("".join(rng.choice(letters) for _ in range(rng.randint(4, 10))))
+
+    return sorted(words)
+
+def get_zipf_weights(num_items, exponent=1.1):
+    return [1.0 / ((rank + 1) ** exponent) for rank in range(num_items)]
+
+# desc_data in the form parse_mesh returns, {uid: {"name": ...,
+# "graph_positions": "A01.001|C02.003"}}, and the list of UIDs. the trees
+# are grown breadth first with up to max_children children per node and
+# a fraction of descriptors get a second position in another tree
+def make_mesh_tree(num_descriptors, num_trees=16, max_children=12, multi_position_frac=0.1,
+        seed=0):
+    rng = Random(seed)
+    words = get_words(num_descriptors * 2, rng)
+
+    uids = [f"D{idx:06d}" for idx in range(num_descriptors)]
+    positions = {uid: [] for uid in uids}
+
+    # (position, uid) of nodes that can still get children
+    frontier = []
+    for tree_idx in range(min(num_trees, num_descriptors)):
+        position = f"{chr(ord('A') + tree_idx % 26)}{tree_idx // 26 + 1:02d}"
+        positions[uids[tree_idx]].append(position)
+        frontier.append(position)
+
+    next_idx = len(frontier)
+    while next_idx < num_descriptors:
+        parent = frontier.pop(0)
+        for child_idx in range(rng.randint(1, max_children)):
+            if next_idx >= num_descriptors:
+                break
+            position = f"{parent}.{child_idx + 1:03d}"
+            positions[uids[next_idx]].append(position)
+            frontier.append(position)
+            next_idx += 1
+
+    # descriptors that are in several trees
+    all_positions = [pos for uid in uids for pos in positions[uid]]
+    for uid in uids:
+        if rng.random() < multi_position_frac:
+            parent = rng.choice(all_positions)
+            positions[uid].append(f"{parent}.{rng.randint(500, 999):03d}")
+
+    desc_data = {}
+    for idx, uid in enumerate(uids):
+        name = " ".join(words[2 * idx:2 * idx + rng.randint(1, 2)]).capitalize()
+        desc_data[uid] = {"name": name, "graph_positions": "|".join(positions[uid])}
+
+    return (desc_data, uids)
+
+# parent - child UID pairs, the format of mesh_edge_list. the tree roots
+# are joined under root_uid so that every pair of descriptors has a distance
+def get_mesh_edges(desc_data, root_uid="D999999"):
+    position_uids = {}
+    for uid, data in desc_data.items():
+        for position in data["graph_positions"].split("|"):
+            position_uids[position] = uid
+
+    edges = []
+    for position, uid in position_uids.items():
+        if "." in position:
+            parent = position_uids.get(position.rsplit(".", 1)[0])
+            if parent is not None:
+                edges.append((parent, uid))
+        else:
+            edges.append((root_uid, uid))
+
+    return edges
+
+def write_mesh_edge_list(desc_data, fp):
+    with open(fp, "w") as out:
+        for (parent, child) in get_mesh_edges(desc_data):
+            out.write(f"{parent}\t{child}\n")
+
+# lemmatized names are just the lower cased names here
+def get_lem_mesh(desc_data):
+    return {uid: data["name"].lower() for uid, data in desc_data.items()}
+
+# uid,lemmatized name lines, the format of lem_mesh_map
+def write_lem_mesh_map(desc_data, fp):
+    with open(fp, "w") as out:
+        for uid, lemma in get_lem_mesh(desc_data).items():
+            out.write(f"{uid},{lemma}\n")
+
+# one lemmatized name per line, the mesh file evaluate.py takes
+def write_lem_mesh(desc_data, fp):
+    with open(fp, "w") as out:
+        for lemma in get_lem_mesh(desc_data).values():
+            out.write(f"{lemma}\n")
+
+# pmid,uid,uid,... lines like pm_doc_term_counts.csv
+def write_doc_term_counts(desc_uids, fp, num_docs, mean_terms=8, seed=0):
+    rng = Random(seed)
+    weights = get_zipf_weights(len(desc_uids))
+
+    with open(fp, "w") as out:
+        for doc_idx in range(num_docs):
+            num_terms = max(1, int(rng.expovariate(1.0 / mean_terms)))
+            terms = rng.choices(desc_uids, weights=weights, k=num_terms)
+            out.write(",".join([str(10000000 + doc_idx)] + terms) + "\n")
+
+# keyword counts in the layout thresh_exp.load_data reads, a header with the
+# total token count as its 5th field and then "keyword count" lines (or
+# "word word count" for bigrams)
+def write_keyword_counts(terms, fp, total_tokens, seed=0):
+    rng = Random(seed)
+    weights = get_zipf_weights(len(terms))
+    total_weight = sum(weights)
+
+    order = list(terms)
+    rng.shuffle(order)
+
+    with open(fp, "w") as out:
+        out.write(f"# total token count {total_tokens}\n")
+        for term, weight in zip(order, weights):
+            count = max(1, int(total_tokens * weight / total_weight))
+            out.write(f"{term} {count}\n")
+
+# keywords (or bigrams) with repeats, one per line, the corpus evaluate.py takes
+def make_corpus(terms, size, seed=0):
+    rng = Random(seed)
+    return rng.choices(terms, weights=get_zipf_weights(len(terms)), k=size)
+
+def write_list(items, fp):
+    with open(fp, "w") as out:
+        for item in items:
+            out.write(f"{item}\n")
+
+def make_bigrams(words, num_bigrams, seed=0):
+    rng = Random(seed)
+    bigrams = set()
+
+    while len(bigrams) < num_bigrams:
+        bigrams.add(f"{rng.choice(words)} {rng.choice(words)}")
+
+    return sorted(bigrams)
+
+# a hierarchy as an edge list: num_components random trees over terms, each
+# with about component_size nodes. a fraction of the terms are MeSH lemmas
+# so that the components have something to compare
+def make_hierarchy_edges(terms, num_components, component_size, seed=0):
+    rng = Random(seed)
+    pool = list(terms)
+    rng.shuffle(pool)
+
+    edges = []
+    pos = 0
+    for _ in range(num_components):
+        size = max(2, int(rng.gauss(component_size, component_size / 4)))
+        nodes = pool[pos:pos + size]
+        pos += size
+        if len(nodes) < 2:
+            break
+        for idx in range(1, len(nodes)):
+            edges.append((nodes[rng.randrange(idx)], nodes[idx]))
+
+    return edges
+
+def write_edge_list(edges, fp):
+    with open(fp, "w") as out:
+        for (parent, child) in edges:
+            out.write(f"{parent}\t{child}\n")
+
+# the hierarchy result format make_edge_list.py converts, sections of terms
+# separated by delimiter lines
+def write_hierarchy_result(edges, fp):
+    with open(fp, "w") as out:
+        for (parent, child) in edges:
+            out.write("=====\n")
+            out.write(f"{parent}\n{child}\n")
+
+# writes a full synthetic data set to out_dir. scale multiplies all sizes
+def write_dataset(out_dir, scale=1.0, seed=0):
+    os.makedirs(out_dir, exist_ok=True)
+    rng = Random(seed)
+
+    num_descriptors = int(2000 * scale)
+    (desc_data, desc_uids) = make_mesh_tree(num_descriptors, seed=seed)
+    write_mesh_edge_list(desc_data, os.path.join(out_dir, "mesh_edge_list"))
+    write_lem_mesh_map(desc_data, os.path.join(out_dir, "lem_mesh_map"))
+    write_lem_mesh(desc_data, os.path.join(out_dir, "lem_mesh"))
+    write_doc_term_counts(desc_uids, os.path.join(out_dir, "pm_doc_term_counts.csv"),
+            int(20000 * scale), seed=seed)
+
+    lemmas = list(get_lem_mesh(desc_data).values())
+    words = get_words(int(5000 * scale), rng)
+    keywords = words + rng.sample(lemmas, len(lemmas) // 2)
+
+    write_keyword_counts(keywords, os.path.join(out_dir, "general_kw_counts"),
+            int(5000000 * scale), seed=seed)
+    write_keyword_counts(rng.sample(keywords, len(keywords) // 2),
+            os.path.join(out_dir, "special_kw_counts"), int(500000 * scale), seed=seed + 1)
+    write_list(make_corpus(keywords, int(50000 * scale), seed=seed),
+            os.path.join(out_dir, "special_corpus"))
+
+    edges = make_hierarchy_edges(keywords, int(50 * scale), 40, seed=seed)
+    write_edge_list(edges, os.path.join(out_dir, "edge_list"))
+    write_hierarchy_result(edges, os.path.join(out_dir, "keyword_4_level_result.txt"))
+
+    return desc_data
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-o", "--output", help="Output directory", default="synthetic_data")
+    parser.add_argument("-s", "--scale", help="Size multiplier, default=1.0", type=float,
+            default=1.0)
+    parser.add_argument("--seed", help="Random seed, default=0", type=int, default=0)
+
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = get_args()
+    write_dataset(args.output, args.scale, args.seed)
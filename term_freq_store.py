@@ -0,0 +1,227 @@
+import os
+import sqlite3
+import logging
+from collections import Counter
+
+from mesh_distance_cache import hash_file
+from instrumentation import get_metrics
+
+# Incrementally maintained descriptor frequencies (the column sums of
+# pm_doc_term_counts.csv) in a SQLite file. Batches of document rows
+# (pmid,uid,uid,... like the counts file, e.g. converted PubMed update files)
+# are ingested one at a time: rows for new PMIDs are added, rows for known
+# PMIDs are compared with what is stored and only revised documents change
+# the frequencies, and deletion lists remove documents. Each batch is applied
+# in one transaction and logged by content hash, so re-ingesting a file is a
+# no-op and a failed ingest leaves the store as it was.
+#
+# UIDs whose frequency changed are collected in changed_uids until the
+# informative terms are next brought up to date (see
+# get_informative_terms.update_informative_terms), which then only has to
+# look at those UIDs and their parents
+
+# PMIDs looked up per query when comparing a batch against the stored rows,
+# stays below SQLite's bound parameter limit
+LOOKUP_CHUNK_SIZE = 500
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS docs (pmid TEXT PRIMARY KEY, uids TEXT NOT NULL, batch INTEGER);
+CREATE TABLE IF NOT EXISTS freqs (uid TEXT PRIMARY KEY, freq INTEGER NOT NULL);
+CREATE TABLE IF NOT EXISTS batches (id INTEGER PRIMARY KEY, kind TEXT, source TEXT,
+    file_hash TEXT UNIQUE, added INTEGER, revised INTEGER, deleted INTEGER);
+CREATE TABLE IF NOT EXISTS changed_uids (uid TEXT PRIMARY KEY);
+CREATE TABLE IF NOT EXISTS informative (uid TEXT PRIMARY KEY);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+"""
+
+def iter_doc_rows(fp, delimiter=","):
+    with open(fp, "r") as handle:
+        for line in handle:
+            line = line.strip("\n").split(delimiter)
+            if line[0]:
+                yield (line[0], [uid for uid in line[1:] if uid])
+
+def load_pmids(fp):
+    with open(fp, "r") as handle:
+        return [line.strip() for line in handle if line.strip()]
+
+class TermFreqStore:
+    def __init__(self, fp):
+        self.fp = fp
+        self.conn = sqlite3.connect(fp)
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def num_docs(self):
+        return self.conn.execute("SELECT COUNT(*) FROM docs").fetchone()[0]
+
+    def has_batch(self, file_hash):
+        return self.conn.execute("SELECT 1 FROM batches WHERE file_hash = ?",
+                (file_hash,)).fetchone() is not None
+
+    def get_stored_rows(self, pmids):
+        rows = {}
+        for start in range(0, len(pmids), LOOKUP_CHUNK_SIZE):
+            chunk = pmids[start:start + LOOKUP_CHUNK_SIZE]
+            placeholders = ",".join("?" * len(chunk))
+            rows.update(self.conn.execute(f"SELECT pmid, uids FROM docs WHERE pmid IN "
+                    f"({placeholders})", chunk))
+
+        return rows
+
+    def _log_batch(self, kind, fp, file_hash, added, revised, deleted):
+        cursor = self.conn.execute("INSERT INTO batches (kind, source, file_hash, added, "
+                "revised, deleted) VALUES (?, ?, ?, ?, ?, ?)",
+                (kind, os.path.abspath(fp), file_hash, added, revised, deleted))
+        return cursor.lastrowid
+
+    def _apply_deltas(self, deltas):
+        deltas = {uid: delta for uid, delta in deltas.items() if delta != 0}
+
+        self.conn.executemany("INSERT INTO freqs (uid, freq) VALUES (?, ?) ON CONFLICT(uid) "
+                "DO UPDATE SET freq = freq + excluded.freq", deltas.items())
+        self.conn.executemany("INSERT OR IGNORE INTO changed_uids (uid) VALUES (?)",
+                ((uid,) for uid in deltas))
+
+        return set(deltas)
+
+    # adds a file of document rows. documents that are already stored with
+    # the same UIDs are skipped, revised ones replace the stored row. returns
+    # the UIDs whose frequency changed
+    def ingest(self, fp, delimiter=","):
+        logger = logging.getLogger(__name__)
+
+        file_hash = hash_file(fp)
+        if self.has_batch(file_hash):
+            logger.info(f"{fp} was already ingested, skipping")
+            return set()
+
+        # the first load doesn't have to be compared against anything, it is
+        # taken to have one row per PMID like the counts file
+        empty = self.num_docs() == 0
+
+        deltas = Counter()
+        added = 0
+        revised = 0
+        num_rows = 0
+
+        with self.conn:
+            batch_id = self._log_batch("rows", fp, file_hash, 0, 0, 0)
+
+            rows = []
+            for row in iter_doc_rows(fp, delimiter):
+                rows.append(row)
+                if len(rows) >= LOOKUP_CHUNK_SIZE:
+                    (num_added, num_revised) = self._ingest_rows(rows, batch_id, deltas, empty)
+                    added += num_added
+                    revised += num_revised
+                    num_rows += len(rows)
+                    rows = []
+            (num_added, num_revised) = self._ingest_rows(rows, batch_id, deltas, empty)
+            added += num_added
+            revised += num_revised
+            num_rows += len(rows)
+
+            changed = self._apply_deltas(deltas)
+            self.conn.execute("UPDATE batches SET added = ?, revised = ? WHERE id = ?",
+                    (added, revised, batch_id))
+
+        get_metrics().count("rows_parsed", num_rows)
+        logger.info(f"Ingested {fp}: {added} new, {revised} revised documents, "
+                f"{len(changed)} descriptor frequencies changed")
+
+        return changed
+
+    def _ingest_rows(self, rows, batch_id, deltas, empty):
+        stored = {} if empty else self.get_stored_rows([pmid for (pmid, _) in rows])
+
+        writes = []
+        added = 0
+        revised = 0
+        for (pmid, uids) in rows:
+            joined = ",".join(uids)
+            old = stored.get(pmid)
+
+            if old == joined:
+                continue
+            if old is None:
+                added += 1
+            else:
+                revised += 1
+                deltas.subtract(old.split(",") if old else [])
+
+            deltas.update(uids)
+            stored[pmid] = joined
+            writes.append((pmid, joined, batch_id))
+
+        self.conn.executemany("INSERT OR REPLACE INTO docs (pmid, uids, batch) VALUES (?, ?, ?)",
+                writes)
+
+        return (added, revised)
+
+    # removes the documents listed (one PMID per line) in fp. returns the
+    # UIDs whose frequency changed
+    def delete(self, fp):
+        logger = logging.getLogger(__name__)
+
+        file_hash = hash_file(fp)
+        if self.has_batch(file_hash):
+            logger.info(f"{fp} was already applied, skipping")
+            return set()
+
+        pmids = load_pmids(fp)
+        deltas = Counter()
+
+        with self.conn:
+            stored = self.get_stored_rows(pmids)
+            for uids in stored.values():
+                deltas.subtract(uids.split(",") if uids else [])
+
+            self.conn.executemany("DELETE FROM docs WHERE pmid = ?", ((pmid,) for pmid in stored))
+            changed = self._apply_deltas(deltas)
+            self._log_batch("deletions", fp, file_hash, 0, 0, len(stored))
+
+        logger.info(f"Applied {fp}: {len(stored)} documents deleted, "
+                f"{len(changed)} descriptor frequencies changed")
+
+        return changed
+
+    # same output as DocTermMatrix.term_freqs / load_term_freqs
+    def term_freqs(self, desc_uids=()):
+        term_freqs = {uid: 0 for uid in desc_uids}
+        term_freqs.update(self.conn.execute("SELECT uid, freq FROM freqs"))
+
+        return term_freqs
+
+    def get_changed_uids(self):
+        return {uid for (uid,) in self.conn.execute("SELECT uid FROM changed_uids")}
+
+    def get_meta(self, key):
+        row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return None if row is None else row[0]
+
+    def get_informative(self):
+        return {uid for (uid,) in self.conn.execute("SELECT uid FROM informative")}
+
+    # stores the informative terms computed for key (the cutoff and the
+    # descriptor file) and clears the changed UIDs, which are accounted for.
+    # with replace the set is replaced, otherwise added/removed are applied
+    def set_informative(self, key, added, removed=(), replace=False):
+        with self.conn:
+            if replace:
+                self.conn.execute("DELETE FROM informative")
+            self.conn.executemany("DELETE FROM informative WHERE uid = ?",
+                    ((uid,) for uid in removed))
+            self.conn.executemany("INSERT OR IGNORE INTO informative (uid) VALUES (?)",
+                    ((uid,) for uid in added))
+            self.conn.execute("DELETE FROM changed_uids")
+            self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES "
+                    "('informative_key', ?)", (key,))
@@ -0,0 +1,129 @@
+import numpy as np
+
+# number of set bits for every possible byte value, used to popcount
+# packed bitsets
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+# Interns terms (corpus terms, keywords, lemmatized MeSH terms) to dense
+# integer IDs so that they only need to be hashed once. Membership in MeSH
+# is stored as a packed bitset over the IDs, so checking a term is a single
+# array index and intersecting a candidate set with MeSH is an AND plus a
+# popcount
+class TermVocabulary:
+    __slots__ = ("term_ids", "terms", "mesh_bits", "_mesh_flags")
+
+    def __init__(self, terms=()):
+        self.term_ids = {}
+        self.terms = []
+        self.mesh_bits = np.zeros(0, dtype=np.uint8)
+        self._mesh_flags = b""
+
+        self.add_all(terms)
+
+    def __len__(self):
+        return len(self.terms)
+
+    def __contains__(self, term):
+        term_id = self.term_ids.get(term)
+        return term_id is not None and self.is_mesh_id(term_id)
+
+    def add(self, term):
+        term_id = self.term_ids.get(term)
+
+        if term_id is None:
+            term_id = len(self.terms)
+            self.term_ids[term] = term_id
+            self.terms.append(term)
+
+        return term_id
+
+    def add_all(self, terms):
+        for term in terms:
+            self.add(term)
+
+    # terms that are not in the vocabulary get -1
+    def get_id(self, term):
+        return self.term_ids.get(term, -1)
+
+    # returns a list rather than an array, python ints are cheaper to hash
+    # and to pick from in the trial loops
+    def encode(self, terms, add=False):
+        if add:
+            return [self.add(term) for term in terms]
+
+        return [self.term_ids.get(term, -1) for term in terms]
+
+    # builds the MeSH membership bitset. every interned term is checked against
+    # each of the mesh collections once, terms in mesh that were never interned
+    # can't take part in an intersection so they are not needed
+    def mark_mesh(self, *meshes):
+        flags = np.zeros(len(self.terms), dtype=bool)
+
+        for term_id, term in enumerate(self.terms):
+            for mesh in meshes:
+                if term in mesh:
+                    flags[term_id] = True
+                    break
+
+        self.mesh_bits = np.packbits(flags)
+        self._mesh_flags = flags.tobytes()
+
+        return self
+
+    # one byte per term, indexing the bytes object directly is the fastest
+    # membership check from a pure python loop
+    def mesh_flags(self):
+        return self._mesh_flags
+
+    def is_mesh_id(self, term_id):
+        if term_id < 0 or term_id >= len(self._mesh_flags):
+            return False
+
+        return (self.mesh_bits[term_id >> 3] >> (7 - (term_id & 7))) & 1 == 1
+
+    # packed bitset with the bits for term_ids set, same length as mesh_bits
+    def to_bitset(self, term_ids):
+        flags = np.zeros(len(self._mesh_flags), dtype=bool)
+        term_ids = np.asarray(term_ids, dtype=np.int64)
+        flags[term_ids[term_ids >= 0]] = True
+
+        return np.packbits(flags)
+
+    def count_mesh_bitset(self, bitset):
+        return int(_POPCOUNT[np.bitwise_and(bitset, self.mesh_bits)].sum())
+
+    # number of distinct terms in term_ids that are in mesh
+    def count_mesh(self, term_ids):
+        return self.count_mesh_bitset(self.to_bitset(term_ids))
+
+    # count_mesh for many lists of term IDs at once: the (list, term) pairs
+    # are deduplicated and the flags summed per list in a single pass
+    def count_mesh_many(self, term_id_lists):
+        num_terms = len(self._mesh_flags)
+        if num_terms == 0:
+            return np.zeros(len(term_id_lists), dtype=np.int64)
+
+        lengths = [len(term_ids) for term_ids in term_id_lists]
+        lists = np.repeat(np.arange(len(term_id_lists), dtype=np.int64), lengths)
+        term_ids = np.fromiter((term_id for term_ids in term_id_lists for term_id in term_ids),
+                dtype=np.int64, count=sum(lengths))
+
+        known = (term_ids >= 0) & (term_ids < num_terms)
+        pairs = np.unique(lists[known] * num_terms + term_ids[known])
+        flags = np.frombuffer(self._mesh_flags, dtype=np.uint8)
+
+        return np.bincount(pairs // num_terms, weights=flags[pairs % num_terms],
+                minlength=len(term_id_lists)).astype(np.int64)
+
+    # terms from elements that are in mesh, deduplicated, in element order
+    def mesh_members(self, elements):
+        flags = self._mesh_flags
+        term_ids = self.term_ids
+
+        members = []
+        for element in elements:
+            term_id = term_ids.get(element)
+            if term_id is not None and term_id < len(flags) and flags[term_id]:
+                members.append(element)
+
+        return list(dict.fromkeys(members))
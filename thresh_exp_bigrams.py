@@ -3,11 +3,22 @@ import math
 import logging
 import argparse
 from collections import Counter
-from time import perf_counter
 
-from multiprocessing import Pool
+from evaluate import (load_mesh, load_list, prepare_eval_data, check_intersection, 
+        get_worker_pool, init_trial_worker, evaluate_in_worker)
+from columnar_output import FORMATS, can_write_parquet, write_table, get_table_path
+from instrumentation import get_metrics, start_metrics, add_metrics_args
 
-from evaluate import evaluate, load_mesh, load_list
+# NOTE: this is not really a threshold, this means try sets of the top 1 to 400 bigrams
+MIN_THRESH = 1
+MAX_THRESH = 600
+
+NUM_TRIALS = 100000
+
+RESULTS_FP = "thresh_exp_res_bigrams"
+RESULTS_COLUMNS = [("top_n_bigrams", "int"), ("pval", "float"), ("result_intersect_len", "int"),
+        ("result_len", "int"), ("rand_inter_mean_len", "float"), ("rand_inter_max", "int")]
+RESULTS_HEADER = "\t".join([name for (name, _) in RESULTS_COLUMNS])
 
 def load_data(gen_kw_path, special_kw_path, min_spec_freq):
     special_keywords = {}
@@ -31,7 +42,9 @@ def load_data(gen_kw_path, special_kw_path, min_spec_freq):
             count = int(line[2])
             if count > min_spec_freq:
                 special_keywords[key] = count
-    
+
+    get_metrics().count("rows_parsed", len(general_keywords) + len(special_keywords))
+
     return (special_keywords, len_special, general_keywords, len_general)
 
 # Attribution note: this select_keywords function is mostly Jiahao Ma's 
@@ -134,34 +147,62 @@ def select_keywords(spec_freq_dic, len_special, gen_freq_dic, len_general, min_t
         #print(_result)
         yield ([it[0] for it in res[0:idx]], idx)
 
-def experiment_routine(gen_kw_path, special_kw_path, special_corpus_path, mesh_path, min_spec_freq):
+# the (keywords, thresh) sets the sweep evaluates, in order
+def get_keyword_sets(gen_kw_path, special_kw_path, min_spec_freq, min_thresh=MIN_THRESH, 
+        max_thresh=MAX_THRESH):
+    (spec_freq_dic, len_special, gen_freq_dic, len_general) = load_data(gen_kw_path, special_kw_path, min_spec_freq)
+
+    return list(select_keywords(spec_freq_dic, len_special, gen_freq_dic, len_general, min_thresh, max_thresh))
+
+# each point of a seeded sweep gets its own seed derived from (seed, thresh)
+def get_point_seed(seed, thresh):
+    return None if seed is None else [seed, thresh]
+
+# text writes fp, the columnar formats write a table next to it (see
+# columnar_output)
+def write_results(results, fp=RESULTS_FP, fmt="text"):
+    if fmt != "text":
+        write_table(results, get_table_path(fp, fmt), RESULTS_COLUMNS, fmt)
+        return
+
+    with open(fp, "w") as out:
+        out.write(f"{RESULTS_HEADER}\n")
+        for res in results:
+            out.write(f"{res[0]}\t{res[1]}\t{res[2]}\t{res[3]}\t{res[4]}\t{res[5]}\n")
+
+def experiment_routine(gen_kw_path, special_kw_path, special_corpus_path, mesh_path, min_spec_freq,
+        seed=None, output_format="text"):
     logger = logging.getLogger(__name__)
+    metrics = get_metrics()
+
     logger.info("Loading data")
-    (spec_freq_dic, len_special, gen_freq_dic, len_general) = load_data(gen_kw_path, special_kw_path, min_spec_freq)
-    
-    mesh = load_mesh(mesh_path)
-    special_corpus = load_list(special_corpus_path)
+    with metrics.stage("load"):
+        mesh = load_mesh(mesh_path)
+        special_corpus = load_list(special_corpus_path)
+        # encoded once here, the workers get it once each when they start
+        (mesh, corpus_ids, mesh_flags) = prepare_eval_data(special_corpus, mesh)
 
     results = []
-
-    # NOTE: this is not really a threshold, this means try sets of the top 1 to 400 bigrams
-    min_thresh = 1
-    max_thresh = 600
     
-    num_trials = 100000
-
-    logger.info(f"Min n bigrams: {min_thresh}")
-    logger.info(f"Max n bigrams: {max_thresh}")
+    logger.info(f"Min n bigrams: {MIN_THRESH}")
+    logger.info(f"Max n bigrams: {MAX_THRESH}")
     logger.info("Starting testing")
-    result_gen = select_keywords(spec_freq_dic, len_special, gen_freq_dic, len_general, min_thresh, max_thresh)
     
-    pool = Pool(processes=20)
+    pool = get_worker_pool(20, init_trial_worker, (corpus_ids, mesh_flags))
 
-    futures = [pool.apply_async(evaluate, (special_corpus, keywords, mesh, num_trials, thresh, False)) for (keywords, thresh) in result_gen]
+    with metrics.stage("select_keywords"):
+        keyword_sets = get_keyword_sets(gen_kw_path, special_kw_path, min_spec_freq)
+
+    # the trials run in the pool, so they are counted here
+    metrics.count("trials", NUM_TRIALS * len(keyword_sets))
+    metrics.count("set_lookups", sum(NUM_TRIALS * len(keywords) for (keywords, _) in keyword_sets))
+
+    with metrics.stage("trials"):
+        futures = [pool.apply_async(evaluate_in_worker, (check_intersection(keywords, mesh), len(keywords), NUM_TRIALS, thresh, get_point_seed(seed, thresh))) for (keywords, thresh) in keyword_sets]
     
-    results = []
-    for res in futures:
-        results.append(res.get())
+        results = []
+        for res in futures:
+            results.append(res.get())
     #for (keywords, thresh) in result_gen:
     #    (p_val, res_int_len, rand_int_mean, rand_int_max) = evaluate(special_corpus, keywords, 
     #            mesh, 1000, verbose=False)
@@ -173,10 +214,8 @@ def experiment_routine(gen_kw_path, special_kw_path, special_corpus_path, mesh_p
 
     results = sorted(results, key=lambda res: res[0])
 
-    with open("thresh_exp_res_bigrams", "w") as out:
-        out.write("top_n_bigrams\tpval\tresult_intersect_len\tresult_len\trand_inter_mean_len\trand_inter_max\n")
-        for res in results:
-            out.write(f"{res[0]}\t{res[1]}\t{res[2]}\t{res[3]}\t{res[4]}\t{res[5]}\n")
+    with metrics.stage("write"):
+        write_results(results, fmt=output_format)
 
 def get_args():
     logger = logging.getLogger(__name__)
@@ -190,7 +229,14 @@ def get_args():
             type=int, default=10000)
     parser.add_argument("-f", "--freq", help="Minimum occurrence frequency for special keywords, default=100",
             type=int, default=100)
-    
+    parser.add_argument("--seed", help="Seed for the random trials, each point of the sweep gets "
+            "its own stream derived from it. the same sweep run through sweep_queue.py gives the "
+            "same trials", type=int, default=None)
+    parser.add_argument("--output-format", help="Format of the results, text (tab separated) "
+            "or a columnar table (npy directory or parquet), default=text", choices=FORMATS,
+            default="text")
+    add_metrics_args(parser, "thresh_exp_bigrams")
+
     args = parser.parse_args()
    
     # log delimiter
@@ -202,6 +248,9 @@ def get_args():
     logger.info(f"Num. trials: {args.trials}")
     logger.info(f"Min spec freq: {args.freq}")
 
+    if args.output_format == "parquet" and not can_write_parquet():
+        parser.error("--output-format parquet needs pyarrow")
+
     return parser.parse_args()
 
 def initialize_logger(debug=False, quiet=False):
@@ -229,4 +278,10 @@ def initialize_logger(debug=False, quiet=False):
 if __name__ == "__main__":
     logger = initialize_logger()
     args = get_args()
-    experiment_routine(args.general, args.special, args.corpus, args.mesh, args.freq)
+    metrics = start_metrics("thresh_exp_bigrams", args.profile)
+    metrics.track_rate("trials", "trials")
+
+    experiment_routine(args.general, args.special, args.corpus, args.mesh, args.freq, args.seed, 
+            args.output_format)
+
+    metrics.finish(args.metrics, logger)